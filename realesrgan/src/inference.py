@@ -5,83 +5,125 @@ from pathlib import Path
 import numpy as np
 import cv2
 import os
-import boto3
 import io
 import time
 import logging
-import threading
+import importlib
+import tempfile
 import concurrent.futures
-import gzip
-from functools import lru_cache
-from botocore.exceptions import ClientError
-from botocore.config import Config
-from PIL import Image
 
-# Import the patch for torchvision before importing basicsr
 import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-import patch_torchvision
 
-from basicsr.archs.rrdbnet_arch import RRDBNet
-from basicsr.utils.download_util import load_file_from_url
+from compiled_models import CompiledModelCache, parse_buckets
+from image_cache import ImageCache
+from model_registry import ModelRegistry
+from pipeline import StagePipeline
+from request_codec import (FRAME_CONTENT_TYPES, RequestBatch, decode_frame, encode_frame, parse_content_type,
+                           parse_multipart_frames, serialize_prediction)
+from s3_transport import read_image, write_image
+from tile_calibration import TileCalibrator
+
+# basicsr (with its whole training stack), realesrgan and gfpgan/facexlib are imported on first use, so that
+# the server answers pings without paying for them. name -> (module, attribute)
+LAZY_IMPORTS = {
+    'RRDBNet': ('basicsr.archs.rrdbnet_arch', 'RRDBNet'),
+    'RealESRGANer': ('realesrgan.realesrgan', 'RealESRGANer'),
+    'SRVGGNetCompact': ('realesrgan.realesrgan.archs.srvgg_arch', 'SRVGGNetCompact'),
+    'GFPGANer': ('gfpgan', 'GFPGANer'),
+}
+
+
+def __getattr__(name):
+    """Import a heavy model class on first access of the module attribute"""
+    if name not in LAZY_IMPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name, attribute = LAZY_IMPORTS[name]
+    # Import the patch for torchvision before importing basicsr
+    import patch_torchvision  # noqa: F401
+    start_time = time.time()
+    value = getattr(importlib.import_module(module_name), attribute)
+    logger.info(f"Imported {module_name} in {time.time() - start_time:.2f} seconds")
+    globals()[name] = value
+    return value
+
+
+def lazy_import(name):
+    """Look up a heavy model class from a function, where module __getattr__ is not consulted"""
+    return globals()[name] if name in globals() else __getattr__(name)
 
-from realesrgan.realesrgan import RealESRGANer
-from realesrgan.realesrgan.archs.srvgg_arch import SRVGGNetCompact
-from gfpgan import GFPGANer
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# S3 client with optimized configuration
-s3_config = Config(
-    region_name=os.environ.get('AWS_REGION', 'us-east-1'),
-    retries={'max_attempts': 10, 'mode': 'adaptive'},
-    s3={'use_accelerate': os.environ.get('USE_S3_ACCELERATION', 'False').lower() == 'true'},
-    max_pool_connections=100,
-    tcp_keepalive=True
-)
-s3_client = boto3.client('s3', config=s3_config)
-
-# Constants for S3 transfer optimization
-MULTIPART_THRESHOLD = 100 * 1024 * 1024  # 100MB
-MULTIPART_CHUNKSIZE = 25 * 1024 * 1024   # 25MB
-MAX_CONCURRENCY = 10
 USE_COMPRESSION = os.environ.get('USE_COMPRESSION', 'False').lower() == 'true'
 
+# Outputs with more pixels than this are streamed into a memory-mapped file instead of memory (default: 8K)
+MEMMAP_OUTPUT_PIXELS = int(os.environ.get('MEMMAP_OUTPUT_PIXELS', 7680 * 4320))
+
 # RealESR-Gan configuration
 netscale = 4
 outscale = 4
 dni_weight = None
 
-# Cache directories
+# Cache directories, created when they are first written to
 MODEL_CACHE_DIR = '/tmp/model_cache'
 IMAGE_CACHE_DIR = '/tmp/image_cache'
-os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
-os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+
+# Inputs read from S3 are kept in a disk cache addressed by their S3 key and ETag, so retried frames are
+# revalidated instead of downloaded again. The least recently used inputs are deleted beyond the budget (0: no cache)
+IMAGE_CACHE_BUDGET = int(os.environ.get('IMAGE_CACHE_BUDGET_MB', 1024)) * 1024 * 1024
+image_cache = ImageCache(os.path.join(IMAGE_CACHE_DIR, 's3'), IMAGE_CACHE_BUDGET) if IMAGE_CACHE_BUDGET else None
+
+# Bytes of model weights kept loaded, least recently used models are evicted beyond it (0: no limit)
+MODEL_MEMORY_BUDGET = int(os.environ.get('MODEL_MEMORY_BUDGET_MB', 0)) * 1024 * 1024
+
+# Frames are padded into resolution buckets (COMPILE_BUCKETS, e.g. 480p,720p,1080p or 512x512) that each run one
+# graph compiled by COMPILE_BACKEND: 'compile' (torch.compile), 'trace' (frozen TorchScript) or 'none' (eager).
+# With COMPILE_WARMUP the buckets are compiled when a model is loaded, the default model is loaded at startup.
+COMPILE_BACKEND = os.environ.get('COMPILE_BACKEND', 'none').lower()
+COMPILE_BUCKETS = parse_buckets(os.environ.get('COMPILE_BUCKETS', '480p,720p,1080p'))
+COMPILE_WARMUP = os.environ.get('COMPILE_WARMUP', 'True').lower() == 'true'
+
+# With AUTO_TILE_CALIBRATION (the default on the GPU), candidate tile configurations of the standard and anime
+# models are timed for every COMPILE_BUCKETS resolution when the server starts, and the fastest one per (model,
+# device, precision, bucket) is kept in MODEL_CACHE_DIR, instead of a fixed tile size for every node type.
+# Calibrating a new node takes minutes, requests never calibrate. Frames larger than every bucket, or without a
+# calibrated configuration, are tiled by 1024 when their longest side exceeds 1500 pixels.
+AUTO_TILE_CALIBRATION = os.environ.get('AUTO_TILE_CALIBRATION', str(torch.cuda.is_available())).lower() == 'true'
+tile_calibrator = TileCalibrator(MODEL_CACHE_DIR, buckets=COMPILE_BUCKETS)
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+# The single-frame requests that TorchServe batches (see serve.py) are upscaled in forwards of up to
+# FRAME_BATCH_SIZE frames of the same model, shape and tiling. Stacking only pays off on the GPU.
+FRAME_BATCH_SIZE = int(os.environ.get('FRAME_BATCH_SIZE', 8 if torch.cuda.is_available() else 1))
+
+# Batch requests run as a pipeline of read (download and decode), inference and write (encode and upload) stages,
+# each with its own workers and at most PIPELINE_QUEUE_SIZE frames waiting in front of it.
+# PIPELINE_INFERENCE_WORKERS 0 derives the inference workers from the available memory.
+PIPELINE_READ_WORKERS = int(os.environ.get('PIPELINE_READ_WORKERS', 4))
+PIPELINE_INFERENCE_WORKERS = int(os.environ.get('PIPELINE_INFERENCE_WORKERS', 0))
+PIPELINE_WRITE_WORKERS = int(os.environ.get('PIPELINE_WRITE_WORKERS', 4))
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 8))
 realesr_gan_model_name = 'RealESRGAN_x4plus.pth'
 realesr_gan_face_enhance_model_name = "GFPGANv1.3.pth"
 realesr_gan_anime_video_model_name = "realesr-animevideov3.pth"
 
-@lru_cache(maxsize=1)
 def load_model(model_name, model_path, model_type):
-    """Load a model with caching to improve performance"""
-    cache_path = os.path.join(MODEL_CACHE_DIR, f"{model_name}.pt")
-
-    # Check if model exists in cache
-    if os.path.exists(cache_path):
-        logger.info(f"Using cached model: {cache_path}")
-        # For cached models, we'll still use the original model path for loading
-        # but log that we're using a cached version
+    """Load a RealESRGANer, called by the model registry the first time the model is used.
 
+    The weights are converted once into a memory-mappable safetensors file in MODEL_CACHE_DIR, later cold starts
+    map that file instead of unpickling and casting the checkpoint.
+    """
     logger.info(f"Loading model: {model_name} from {model_path}")
     start_time = time.time()
+    RealESRGANer = lazy_import('RealESRGANer')
 
     if model_type == "realesrgan":
-        model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
+        model = lazy_import('RRDBNet')(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
         upsampler = RealESRGANer(
             scale=netscale,
             model_path=model_path,
@@ -91,9 +133,10 @@ def load_model(model_name, model_path, model_type):
             tile_pad=10,
             pre_pad=0,
             half=True,
-            gpu_id=0)
+            gpu_id=0,
+            weight_cache_dir=MODEL_CACHE_DIR)
     elif model_type == "anime":
-        model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, upscale=4, act_type='prelu')
+        model = lazy_import('SRVGGNetCompact')(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, upscale=4, act_type='prelu')
         upsampler = RealESRGANer(
             scale=netscale,
             model_path=model_path,
@@ -103,27 +146,29 @@ def load_model(model_name, model_path, model_type):
             tile_pad=10,
             pre_pad=0,
             half=True,
-            gpu_id=0)
+            gpu_id=0,
+            weight_cache_dir=MODEL_CACHE_DIR)
     else:
         raise ValueError(f"Unknown model type: {model_type}")
+    upsampler.model = compile_model(upsampler.model)
 
     elapsed = time.time() - start_time
     logger.info(f"Model {model_name} loaded in {elapsed:.2f} seconds")
 
-    # Save model to cache if it doesn't exist
-    if not os.path.exists(cache_path):
-        try:
-            # Create a symbolic link to the original model file to save disk space
-            os.symlink(model_path, cache_path)
-            logger.info(f"Created symbolic link for model cache: {cache_path}")
-        except Exception as e:
-            logger.warning(f"Failed to create model cache: {e}")
-
     return upsampler
 
+def compile_model(model, pad_multiple=1):
+    """Wrap a network into the compiled graphs of the resolution buckets, compiled now if COMPILE_WARMUP is set"""
+    if COMPILE_BACKEND == 'none':
+        return model
+    model = CompiledModelCache(model, buckets=COMPILE_BUCKETS, backend=COMPILE_BACKEND, pad_multiple=pad_multiple)
+    if COMPILE_WARMUP:
+        model.warm()
+    return model
+
 def model_fn(model_dir):
-    """Load all models with caching for improved performance"""
-    logger.info(f"Loading models from {model_dir}")
+    """Register the models, each of them is loaded on first use and evicted when the memory budget is exceeded"""
+    logger.info(f"Registering models from {model_dir}")
 
     # Define model paths
     realesr_gan_model_path = os.path.join(model_dir, realesr_gan_model_name)
@@ -133,287 +178,142 @@ def model_fn(model_dir):
     # Create cache directory if it doesn't exist
     os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
 
-    # Load models with caching
-    try:
-        # Load standard model
-        real_esr_gan_upsampler = load_model(
-            "realesrgan_x4plus", 
-            realesr_gan_model_path, 
-            "realesrgan"
-        )
-        logger.info("Loaded RealESRGAN standard model")
-
-        # Load anime model
-        real_esr_gan_anime_video_upsampler = load_model(
-            "realesrgan_anime", 
-            realesr_gan_anime_model_path, 
-            "anime"
-        )
-        logger.info("Loaded RealESRGAN anime model")
-
-        # Load face enhancer model
-        face_enhancer = GFPGANer(
+    model = ModelRegistry(memory_budget=MODEL_MEMORY_BUDGET)
+    model.register(
+        'realesr_gan',
+        lambda: load_model("realesrgan_x4plus", realesr_gan_model_path, "realesrgan")
+    )
+    model.register(
+        'realesr_gan_anime',
+        lambda: load_model("realesrgan_anime", realesr_gan_anime_model_path, "anime")
+    )
+    # The face enhancer pastes the faces on a background upscaled by the standard model, share it
+    model.register(
+        'face_enhancer',
+        lambda bg_upsampler: lazy_import('GFPGANer')(
             model_path=realesr_gan_face_enhanced_model_path,
             upscale=4,
             arch='clean',
             channel_multiplier=2,
-            bg_upsampler=real_esr_gan_upsampler
-        )
-        logger.info("Loaded face enhancer model")
-
-        # Create model dictionary
-        model = {
-            'face_enhancer': face_enhancer,
-            'realesr_gan': real_esr_gan_upsampler,
-            'realesr_gan_anime': real_esr_gan_anime_video_upsampler
-        }
-
-        return model
-    except Exception as e:
-        logger.error(f"Error loading models: {e}")
-        raise
-
+            bg_upsampler=bg_upsampler
+        ),
+        dependencies=('realesr_gan', )
+    )
+    if COMPILE_BACKEND != 'none' and COMPILE_WARMUP:
+        # compile the graphs of the standard model before the first request
+        model['realesr_gan']
+    if AUTO_TILE_CALIBRATION:
+        # calibrate before the first request, a calibrated node only reads the table
+        for model_name in ('realesr_gan', 'realesr_gan_anime'):
+            tile_calibrator.warm(model_name, model[model_name])
+    return model
 
 def input_fn(request_body, request_content_type):
-    if request_content_type == "application/json":
+    """Deserialize a request: JSON with file paths, an inline frame (image/png, image/jpeg, application/x-npy) or a
+    multipart/form-data batch of inline frames. Inline frames are upscaled into the response body, in the format
+    they were sent in."""
+    content_type, _ = parse_content_type(request_content_type)
+    if content_type == "application/json":
         data = json.loads(request_body)
         return data
+    if content_type in FRAME_CONTENT_TYPES:
+        return {'image': decode_frame(request_body, content_type, cv2.IMREAD_UNCHANGED),
+                'output_format': content_type, 'job_id': 'inline', 'batch_id': 0}
+    if content_type == "multipart/form-data":
+        fields, frames = parse_multipart_frames(request_body, request_content_type, cv2.IMREAD_UNCHANGED)
+        batch = [{**fields, 'image': frame['image'], 'output_format': frame['output_format']} for frame in frames]
+        return {'batch': batch, 'job_id': fields.get('job_id', 'inline')}
     raise ValueError("Unsupported content type: {}".format(request_content_type))
 
 
-def download_from_s3(s3_uri, local_path):
-    """Download a file from S3 to a local path with caching, multipart and compression support"""
-    # Check if file already exists in cache
-    if os.path.exists(local_path):
-        logger.info(f"Using cached file: {local_path}")
-        return local_path
+def output_fn(prediction, accept):
+    """Serialize a prediction, inline outputs are returned as images instead of JSON"""
+    results = prediction['batch_results'] if 'batch_results' in prediction else [prediction]
+    return serialize_prediction(prediction, results)
 
-    try:
-        # Parse S3 URI
-        if s3_uri.startswith('s3://'):
-            parts = s3_uri[5:].split('/', 1)
-            bucket = parts[0]
-            key = parts[1] if len(parts) > 1 else ''
-        else:
-            # Assume it's a local file
-            return s3_uri
 
-        # Create directory if it doesn't exist
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+def predict_fn(input_data, model):
+    """Process an image or batch of images with Real-ESRGAN model, or the RequestBatch of the requests that the
+    model server batched"""
+    if isinstance(input_data, RequestBatch):
+        return process_requests(input_data, model)
 
-        # Get file size to determine if multipart download is needed
-        try:
-            response = s3_client.head_object(Bucket=bucket, Key=key)
-            file_size = response['ContentLength']
-            logger.info(f"File size: {file_size / (1024 * 1024):.2f} MB")
-        except ClientError as e:
-            logger.warning(f"Could not determine file size: {e}")
-            file_size = 0
-
-        # Download file
-        logger.info(f"Downloading {s3_uri} to {local_path}")
-        start_time = time.time()
-
-        if USE_COMPRESSION:
-            # Download with compression
-            logger.info("Using compression for download")
-            compressed_key = f"{key}.gz"
-
-            # Check if compressed version exists
-            try:
-                s3_client.head_object(Bucket=bucket, Key=compressed_key)
-                # Use compressed version
-                with open(local_path, 'wb') as f_out:
-                    s3_obj = s3_client.get_object(Bucket=bucket, Key=compressed_key)
-                    with gzip.GzipFile(fileobj=s3_obj['Body'], mode='rb') as f_in:
-                        f_out.write(f_in.read())
-            except ClientError:
-                # Compressed version doesn't exist, use regular download
-                if file_size > MULTIPART_THRESHOLD:
-                    # Use multipart download for large files
-                    transfer_config = boto3.s3.transfer.TransferConfig(
-                        multipart_threshold=MULTIPART_THRESHOLD,
-                        max_concurrency=MAX_CONCURRENCY,
-                        multipart_chunksize=MULTIPART_CHUNKSIZE
-                    )
-                    s3_client.download_file(
-                        bucket, key, local_path,
-                        Config=transfer_config
-                    )
-                else:
-                    # Use regular download for small files
-                    s3_client.download_file(bucket, key, local_path)
-        else:
-            # Regular download without compression
-            if file_size > MULTIPART_THRESHOLD:
-                # Use multipart download for large files
-                transfer_config = boto3.s3.transfer.TransferConfig(
-                    multipart_threshold=MULTIPART_THRESHOLD,
-                    max_concurrency=MAX_CONCURRENCY,
-                    multipart_chunksize=MULTIPART_CHUNKSIZE
-                )
-                s3_client.download_file(
-                    bucket, key, local_path,
-                    Config=transfer_config
-                )
-            else:
-                # Use regular download for small files
-                s3_client.download_file(bucket, key, local_path)
+    if is_batch_request(input_data):
+        return process_batch(input_data, model)
+    else:
+        return process_single_image(input_data, model)
 
-        elapsed = time.time() - start_time
-        logger.info(f"Download completed in {elapsed:.2f} seconds")
 
-        return local_path
-    except ClientError as e:
-        logger.error(f"Error downloading file from S3: {e}")
-        raise
+def is_batch_request(input_data):
+    """Check if this is a batch request"""
+    return 'batch' in input_data and isinstance(input_data['batch'], list)
 
-def upload_to_s3(local_path, s3_uri):
-    """Upload a file from a local path to S3 with multipart and compression support"""
-    try:
-        # Parse S3 URI
-        if s3_uri.startswith('s3://'):
-            parts = s3_uri[5:].split('/', 1)
-            bucket = parts[0]
-            key = parts[1] if len(parts) > 1 else ''
-        else:
-            # If not an S3 URI, just return the local path
-            return local_path
-
-        # Get file size to determine if multipart upload is needed
-        file_size = os.path.getsize(local_path)
-        logger.info(f"File size: {file_size / (1024 * 1024):.2f} MB")
-
-        # Upload file
-        logger.info(f"Uploading {local_path} to {s3_uri}")
-        start_time = time.time()
-
-        if USE_COMPRESSION:
-            # Upload with compression
-            logger.info("Using compression for upload")
-            compressed_key = f"{key}.gz"
-            compressed_path = f"{local_path}.gz"
-
-            # Compress the file
-            with open(local_path, 'rb') as f_in:
-                with gzip.open(compressed_path, 'wb') as f_out:
-                    f_out.writelines(f_in)
-
-            # Upload the compressed file
-            if file_size > MULTIPART_THRESHOLD:
-                # Use multipart upload for large files
-                transfer_config = boto3.s3.transfer.TransferConfig(
-                    multipart_threshold=MULTIPART_THRESHOLD,
-                    max_concurrency=MAX_CONCURRENCY,
-                    multipart_chunksize=MULTIPART_CHUNKSIZE
-                )
-                s3_client.upload_file(
-                    compressed_path, bucket, compressed_key,
-                    Config=transfer_config
-                )
-            else:
-                # Use regular upload for small files
-                s3_client.upload_file(compressed_path, bucket, compressed_key)
-
-            # Clean up the compressed file
-            os.remove(compressed_path)
-
-            # Also upload the original file for clients that don't support compression
-            if file_size > MULTIPART_THRESHOLD:
-                transfer_config = boto3.s3.transfer.TransferConfig(
-                    multipart_threshold=MULTIPART_THRESHOLD,
-                    max_concurrency=MAX_CONCURRENCY,
-                    multipart_chunksize=MULTIPART_CHUNKSIZE
-                )
-                s3_client.upload_file(
-                    local_path, bucket, key,
-                    Config=transfer_config
-                )
-            else:
-                s3_client.upload_file(local_path, bucket, key)
-        else:
-            # Regular upload without compression
-            if file_size > MULTIPART_THRESHOLD:
-                # Use multipart upload for large files
-                transfer_config = boto3.s3.transfer.TransferConfig(
-                    multipart_threshold=MULTIPART_THRESHOLD,
-                    max_concurrency=MAX_CONCURRENCY,
-                    multipart_chunksize=MULTIPART_CHUNKSIZE
-                )
-                s3_client.upload_file(
-                    local_path, bucket, key,
-                    Config=transfer_config
-                )
-            else:
-                # Use regular upload for small files
-                s3_client.upload_file(local_path, bucket, key)
 
-        elapsed = time.time() - start_time
-        logger.info(f"Upload completed in {elapsed:.2f} seconds")
+def process_requests(requests, model):
+    """Process the requests batched by the model server.
 
-        return s3_uri
-    except ClientError as e:
-        logger.error(f"Error uploading file to S3: {e}")
-        raise
+    The images of the single-image requests are read and written on a thread pool and upscaled together by
+    upscale_frames. Batch requests run through their own pipeline.
 
-def predict_fn(input_data, model):
-    """Process an image or batch of images with Real-ESRGAN model"""
-    # Check if this is a batch request
-    is_batch = 'batch' in input_data and isinstance(input_data['batch'], list)
-
-    if is_batch:
-        return process_batch(input_data, model)
-    else:
-        return process_single_image(input_data, model)
+    Returns:
+        list[dict]: One prediction per request, in the order of the requests.
+    """
+    predictions = [None] * len(requests)
+    single = [index for index, input_data in enumerate(requests) if not is_batch_request(input_data)]
+    if single:
+        logger.info(f"Processing {len(single)} single-image requests together")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(single), PIPELINE_READ_WORKERS)) as executor:
+            frames = list(executor.map(read_frame, [requests[index] for index in single]))
+            frames = upscale_frames(frames, model)
+            results = executor.map(lambda frame: frame if isinstance(frame, dict) else write_frame(frame), frames)
+            for index, result in zip(single, results):
+                predictions[index] = result
+    for index, input_data in enumerate(requests):
+        if is_batch_request(input_data):
+            predictions[index] = process_batch(input_data, model)
+    return predictions
 
 def process_batch(batch_data, model):
-    """Process a batch of images for better efficiency"""
+    """Process a batch of images through a download, inference and upload pipeline.
+
+    The items flow through three stages with their own workers, connected by bounded queues: reading and decoding
+    the input, upscaling it and encoding and writing the output. The inference workers never wait on S3.
+    """
     batch_items = batch_data['batch']
     job_id = batch_data.get('job_id', 'batch_job')
-    results = []
-
-    # Determine optimal batch size based on available memory
-    batch_size = determine_optimal_batch_size()
-    logger.info(f"Processing batch with {len(batch_items)} items using batch size of {batch_size}")
-
-    # Process in smaller batches to avoid memory issues
-    for i in range(0, len(batch_items), batch_size):
-        sub_batch = batch_items[i:i+batch_size]
-        logger.info(f"Processing sub-batch {i//batch_size + 1} with {len(sub_batch)} items")
-
-        # Use ThreadPoolExecutor for parallel processing
-        with concurrent.futures.ThreadPoolExecutor(max_workers=min(batch_size, MAX_CONCURRENCY)) as executor:
-            # Create a list of futures
-            future_to_item = {
-                executor.submit(process_single_image, 
-                                {**item, 'job_id': job_id, 'batch_id': idx + i}, 
-                                model): (idx, item) 
-                for idx, item in enumerate(sub_batch)
-            }
 
-            # Process results as they complete
-            for future in concurrent.futures.as_completed(future_to_item):
-                idx, item = future_to_item[future]
-                try:
-                    result = future.result()
-                    results.append(result)
-                    logger.info(f"Completed processing item {idx + i} in batch")
-                except Exception as e:
-                    logger.error(f"Error processing batch item {idx + i}: {e}")
-                    results.append({
-                        "status": 500,
-                        "error": str(e),
-                        "job_id": job_id,
-                        "batch_id": idx + i,
-                        "input_file_path": item.get('input_file_path', 'unknown')
-                    })
+    # Bound the frames upscaled at once by the available memory, unless configured
+    inference_workers = PIPELINE_INFERENCE_WORKERS or determine_optimal_batch_size()
+    logger.info(f"Processing batch with {len(batch_items)} items using {PIPELINE_READ_WORKERS} read, "
+                f"{inference_workers} inference and {PIPELINE_WRITE_WORKERS} write workers")
+
+    def on_error(item, error):
+        return {
+            "status": 500,
+            "error": str(error),
+            "job_id": job_id,
+            "batch_id": item['batch_id'],
+            "input_file_path": item.get('input_file_path', 'unknown')
+        }
+
+    pipeline = StagePipeline([
+        ('read', read_frame, PIPELINE_READ_WORKERS),
+        ('inference', lambda frame: upscale_frame(frame, model), inference_workers),
+        ('write', write_frame, PIPELINE_WRITE_WORKERS),
+    ], queue_size=PIPELINE_QUEUE_SIZE, on_error=on_error)
+    results, stats = pipeline.run(
+        [{**item, 'job_id': job_id, 'batch_id': idx} for idx, item in enumerate(batch_items)])
+
+    utilization = {name: round(stage['utilization'], 3) for name, stage in stats['stages'].items()}
+    logger.info(f"Processed {len(results)} items in {stats['seconds']:.2f} seconds, stage utilization: {utilization}")
 
     # Return batch results
     return {
         "status": 200,
         "batch_results": results,
         "job_id": job_id,
-        "total_processed": len(results)
+        "total_processed": len(results),
+        "stage_utilization": utilization
     }
 
 def determine_optimal_batch_size():
@@ -442,105 +342,227 @@ def determine_optimal_batch_size():
         logger.warning(f"Error determining optimal batch size: {e}, using default")
         return 4  # Default batch size
 
-def process_single_image(input_data, model):
-    """Process a single image with Real-ESRGAN model"""
-    # Extract input parameters
-    input_file_path = input_data['input_file_path']
-    output_file_path = input_data['output_file_path']
-    job_id = input_data['job_id']
-    batch_id = input_data['batch_id']
-
-    # Handle S3 paths
-    is_s3_input = input_file_path.startswith('s3://')
-    is_s3_output = output_file_path.startswith('s3://')
-
-    # Create local file paths for caching
-    imgname, extension = os.path.splitext(os.path.basename(input_file_path))
-    local_input_path = os.path.join(IMAGE_CACHE_DIR, f"{imgname}{extension}")
-    local_output_path = os.path.join(IMAGE_CACHE_DIR, f"{imgname}_upscaled{extension}")
+def read_frame(input_data):
+    """Read and decode the input image of a request, the first stage of the batch pipeline
 
-    # Download from S3 if needed
-    if is_s3_input:
-        try:
-            input_file_path = download_from_s3(input_file_path, local_input_path)
-        except Exception as e:
-            logger.error(f"Failed to download input file: {e}")
-            return {"status": 500, "error": str(e), "job_id": job_id, "batch_id": batch_id}
+    Returns:
+        tuple | dict: The request and the image, or the error result.
+    """
+    if 'image' in input_data:
+        # Decoded by input_fn from the request body
+        return input_data, input_data['image']
+    input_file_path = input_data['input_file_path']
 
-    # Read the image
+    # Read the image, S3 objects are decoded in memory
     try:
-        img = cv2.imread(input_file_path, cv2.IMREAD_UNCHANGED)
+        img = read_image(input_file_path, cv2.IMREAD_UNCHANGED, USE_COMPRESSION, image_cache)
         if img is None:
             raise ValueError(f"Failed to read image from {input_file_path}")
     except Exception as e:
         logger.error(f"Error reading image: {e}")
-        return {"status": 500, "error": str(e), "job_id": job_id, "batch_id": batch_id}
+        return {"status": 500, "error": str(e), "job_id": input_data['job_id'], "batch_id": input_data['batch_id']}
+    return input_data, img
+
+
+def upscale_frame(frame, model):
+    """Upscale a decoded image with the model the request selects, the second stage of the batch pipeline
+
+    Returns:
+        tuple | dict: The request, the output and the file backing a memory-mapped output (or None), or the error
+            result.
+    """
+    input_data, img = frame
+    job_id = input_data['job_id']
+    batch_id = input_data['batch_id']
 
     # Process the image
+    memmap_file = None
     try:
         # Select the appropriate model based on input parameters
-        if 'face_enhanced' in input_data and input_data['face_enhanced'].lower() == "yes":
+        if is_face_enhanced(input_data):
             logger.info("Using face enhancement model")
             face_enhancer = model['face_enhancer'] 
             _, _, output = face_enhancer.enhance(img, has_aligned=False, only_center_face=False, paste_back=True)
         else:
-            if ('is_anime' in input_data) and ((input_data['is_anime'].lower() == "yes") or (input_data['is_anime'].lower() == "true")):
-                logger.info("Using anime model")
-                upsampler = model['realesr_gan_anime']
+            _, upsampler, tile_size, tile_batch_size = select_upsampler(input_data, img, model)
+            if streams_output(upsampler, img, tile_size):
+                # Write the tile rows of very large outputs straight into a file-backed buffer
+                # so that the upscaled frame never has to fit in memory
+                output_shape = upsampler.get_output_shape(img)
+                logger.info(f"Streaming {output_shape} output into a memory-mapped buffer")
+                os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+                memmap_file = tempfile.NamedTemporaryFile(dir=IMAGE_CACHE_DIR, suffix='.raw')
+                out = np.memmap(memmap_file.name, dtype=np.uint8, mode='w+', shape=output_shape)
+                output, _ = upsampler.enhance(img, outscale=outscale, tile=tile_size, out=out,
+                                              tile_batch_size=tile_batch_size)
             else:
-                logger.info("Using standard model")
-                upsampler = model['realesr_gan'] 
-
-            # Use tile processing for large images to reduce memory usage
-            tile_size = input_data.get('tile_size', 0)
-            if tile_size == 0 and max(img.shape[0], img.shape[1]) > 1500:
-                # Automatically use tiling for large images
-                tile_size = 1024
-                logger.info(f"Using automatic tiling with size {tile_size} for large image")
-
-            output, _ = upsampler.enhance(img, outscale=outscale, tile=tile_size)
+                output, _ = upsampler.enhance(img, outscale=outscale, tile=tile_size,
+                                              tile_batch_size=tile_batch_size)
 
     except RuntimeError as error:
         logger.error(f"Runtime error during processing: {error}")
         logger.error("If you encounter CUDA out of memory, try to set --tile with a smaller number.")
+        if memmap_file is not None:
+            memmap_file.close()
         return {"status": 500, "error": str(error), "job_id": job_id, "batch_id": batch_id}
     except Exception as e:
         logger.error(f"Unexpected error during processing: {e}")
+        if memmap_file is not None:
+            memmap_file.close()
         return {"status": 500, "error": str(e), "job_id": job_id, "batch_id": batch_id}
+    return input_data, output, memmap_file
+
+
+def upscale_frames(frames, model):
+    """Upscale the decoded images of several requests. Images of the same model, shape and tiling are stacked into
+    forwards of up to FRAME_BATCH_SIZE images, face enhanced images and images whose output is streamed into a
+    memory-mapped buffer are upscaled one by one by upscale_frame.
+
+    Args:
+        frames (list): Per request the result of read_frame.
+
+    Returns:
+        list: Per request the result of upscale_frame.
+    """
+    results = list(frames)
+    groups = {}
+    for index, frame in enumerate(frames):
+        if isinstance(frame, dict):
+            # reading failed, frame is the error result
+            continue
+        input_data, img = frame
+        try:
+            if is_face_enhanced(input_data):
+                results[index] = upscale_frame(frame, model)
+                continue
+            model_name, upsampler, tile_size, tile_batch_size = select_upsampler(input_data, img, model)
+            if streams_output(upsampler, img, tile_size):
+                results[index] = upscale_frame(frame, model)
+                continue
+        except Exception as e:
+            logger.error(f"Unexpected error during processing: {e}")
+            results[index] = {"status": 500, "error": str(e), "job_id": input_data['job_id'],
+                              "batch_id": input_data['batch_id']}
+            continue
+        groups.setdefault((model_name, img.shape, img.dtype.str, tile_size, tile_batch_size), []).append(index)
+
+    for (model_name, shape, _, tile_size, tile_batch_size), indices in groups.items():
+        logger.info(f"Upscaling {len(indices)} images of shape {shape} in batches of {FRAME_BATCH_SIZE}")
+        for i in range(0, len(indices), FRAME_BATCH_SIZE):
+            chunk = indices[i:i + FRAME_BATCH_SIZE]
+            try:
+                outputs = model[model_name].enhance_batch([frames[index][1] for index in chunk], outscale=outscale,
+                                                          tile=tile_size, tile_batch_size=tile_batch_size)
+            except Exception as e:
+                if 'out of memory' in str(e) and len(chunk) > 1:
+                    # the stacked images do not fit, upscale them one by one
+                    logger.warning(f"Out of memory upscaling {len(chunk)} images at once, upscaling them one by one")
+                    if torch.cuda.is_available():
+                        torch.cuda.empty_cache()
+                    for index in chunk:
+                        results[index] = upscale_frame(frames[index], model)
+                    continue
+                logger.error(f"Error during batched processing: {e}")
+                for index in chunk:
+                    input_data = frames[index][0]
+                    results[index] = {"status": 500, "error": str(e), "job_id": input_data['job_id'],
+                                      "batch_id": input_data['batch_id']}
+                continue
+            for index, output in zip(chunk, outputs):
+                results[index] = (frames[index][0], output, None)
+    return results
+
+
+def is_face_enhanced(input_data):
+    """Whether a request asks for the face enhancement model"""
+    return 'face_enhanced' in input_data and input_data['face_enhanced'].lower() == "yes"
+
+
+def select_upsampler(input_data, img, model):
+    """Select the upsampler of a request and the tiling of its image
+
+    Returns:
+        tuple: The model name, the upsampler, the tile size (0 for none) and the tile batch size (None for the
+            default of the upsampler).
+    """
+    if ('is_anime' in input_data) and ((input_data['is_anime'].lower() == "yes") or (input_data['is_anime'].lower() == "true")):
+        logger.info("Using anime model")
+        model_name = 'realesr_gan_anime'
+    else:
+        logger.info("Using standard model")
+        model_name = 'realesr_gan'
+    upsampler = model[model_name]
+
+    # Use tile processing for large images to reduce memory usage
+    tile_size = input_data.get('tile_size', 0)
+    tile_batch_size = None
+    tile_config = None
+    if tile_size == 0 and AUTO_TILE_CALIBRATION:
+        tile_config = tile_calibrator.lookup(model_name, upsampler, img.shape[0], img.shape[1])
+    if tile_config is not None:
+        tile_size, tile_batch_size = tile_config
+        if tile_size:
+            logger.info(f"Using calibrated tiling with size {tile_size}")
+    elif tile_size == 0 and max(img.shape[0], img.shape[1]) > 1500:
+        # Automatically use tiling for large images
+        tile_size = 1024
+        logger.info(f"Using automatic tiling with size {tile_size} for large image")
+    return model_name, upsampler, tile_size, tile_batch_size
+
+
+def streams_output(upsampler, img, tile_size):
+    """Whether the output of a tiled image is too large to be held in memory, its tile rows are then written
+    into a memory-mapped buffer"""
+    output_shape = upsampler.get_output_shape(img)
+    return tile_size > 0 and img.dtype == np.uint8 and output_shape[0] * output_shape[1] > MEMMAP_OUTPUT_PIXELS
+
+
+def write_frame(frame):
+    """Encode and write the output of a request, the last stage of the batch pipeline
+
+    Returns:
+        dict: The result of the request.
+    """
+    input_data, output, memmap_file = frame
+    job_id = input_data['job_id']
+    batch_id = input_data['batch_id']
 
-    # Save the output locally
+    # Write the output, S3 objects are encoded in memory and uploaded from the buffer,
+    # inline frames are encoded into the response body
     try:
-        cv2.imwrite(local_output_path, output)
-        logger.info(f"Saved output to {local_output_path}")
+        if 'output_file_path' in input_data:
+            output_file_path = write_image(input_data['output_file_path'], output, USE_COMPRESSION)
+            logger.info(f"Saved output to {output_file_path}")
+            result = {"output_file_path": output_file_path}
+        else:
+            result = {"image": encode_frame(output, input_data['output_format']),
+                      "content_type": input_data['output_format']}
     except Exception as e:
         logger.error(f"Error saving output image: {e}")
         return {"status": 500, "error": str(e), "job_id": job_id, "batch_id": batch_id}
-
-    # Upload to S3 if needed
-    if is_s3_output:
-        try:
-            output_file_path = upload_to_s3(local_output_path, output_file_path)
-        except Exception as e:
-            logger.error(f"Failed to upload output file: {e}")
-            return {"status": 500, "error": str(e), "job_id": job_id, "batch_id": batch_id}
-    elif local_output_path != output_file_path:
-        # Copy to the specified output path if different from cache path
-        try:
-            import shutil
-            shutil.copy2(local_output_path, output_file_path)
-            logger.info(f"Copied output to {output_file_path}")
-        except Exception as e:
-            logger.error(f"Error copying output file: {e}")
-            return {"status": 500, "error": str(e), "job_id": job_id, "batch_id": batch_id}
+    finally:
+        if memmap_file is not None:
+            del output, frame
+            memmap_file.close()
 
     return {
         "status": 200,
-        "output_file_path": output_file_path,
+        **result,
         "job_id": job_id,
         "batch_id": batch_id
     }
 
 
+def process_single_image(input_data, model):
+    """Process a single image with Real-ESRGAN model"""
+    frame = read_frame(input_data)
+    if not isinstance(frame, dict):
+        frame = upscale_frame(frame, model)
+    if not isinstance(frame, dict):
+        frame = write_frame(frame)
+    return frame
+
+
 if __name__ == "__main__":
     # Configure logging
     logging.basicConfig(level=logging.INFO)
@@ -0,0 +1,148 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry(Mapping):
+    """Load models on first use and keep the loaded ones under a memory budget.
+
+    Every model is registered with a loader and is only loaded the first time it is looked up, so a container
+    that only serves one model never pays for the others. The registry is a read-only mapping, so it can be
+    used wherever the dict of models was used before.
+
+    A model may depend on other registered models, which are loaded first and passed to its loader, so that
+    e.g. the face enhancer shares the background upsampler of the standard path instead of loading its own.
+    The memory of a model is the size of the parameters and buffers it holds, without the ones of its
+    dependencies. When the loaded models exceed the budget, the least recently used ones are evicted. Models
+    that a loaded model depends on stay loaded, since the dependent keeps a reference to them anyway.
+    """
+
+    def __init__(self, memory_budget=None):
+        """Initialize the registry
+
+        Args:
+            memory_budget (int): Maximum bytes of loaded model weights. None or 0 never evicts.
+        """
+        self.memory_budget = memory_budget or None
+        self._loaders = {}
+        self._dependencies = {}
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.RLock()
+
+    def register(self, name, loader, dependencies=()):
+        """Register a model loader
+
+        Args:
+            name (str): Name the model is looked up with.
+            loader (callable): Called with the loaded dependencies as positional arguments, returns the model.
+            dependencies (tuple[str]): Names of registered models the loader needs.
+        """
+        with self._lock:
+            self._loaders[name] = loader
+            self._dependencies[name] = tuple(dependencies)
+
+    def __getitem__(self, name):
+        if name not in self._loaders:
+            raise KeyError(name)
+        with self._lock:
+            dependencies = [self[dependency] for dependency in self._dependencies[name]]
+            if name in self._models:
+                self._models.move_to_end(name)
+                return self._models[name]
+
+            logger.info(f"Loading model on first use: {name}")
+            start_time = time.time()
+            model = self._loaders[name](*dependencies)
+            self._models[name] = model
+            self._sizes[name] = self.get_model_size(model, exclude=dependencies)
+            logger.info(f"Model {name} loaded in {time.time() - start_time:.2f} seconds, "
+                        f"{self._sizes[name] / 1024**2:.1f}MB")
+            self.evict_to_budget(keep=name)
+            return model
+
+    def __iter__(self):
+        return iter(self._loaders)
+
+    def __len__(self):
+        return len(self._loaders)
+
+    @property
+    def loaded(self):
+        """Names of the loaded models, least recently used first"""
+        return list(self._models)
+
+    @property
+    def memory_used(self):
+        """Bytes of model weights held by the loaded models"""
+        return sum(self._sizes.values())
+
+    def get_memory_usage(self):
+        """Bytes of model weights held by every loaded model"""
+        return dict(self._sizes)
+
+    def evict(self, name):
+        """Unload a model, it is loaded again on its next lookup"""
+        with self._lock:
+            if self._models.pop(name, None) is None:
+                return
+            size = self._sizes.pop(name)
+            logger.info(f"Evicted model {name} ({size / 1024**2:.1f}MB)")
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def evict_to_budget(self, keep=None):
+        """Evict least recently used models until the loaded models fit in the memory budget"""
+        if self.memory_budget is None:
+            return
+        with self._lock:
+            pinned = self.get_all_dependencies(keep) if keep else set()
+            for name in self._models:
+                pinned.update(self.get_all_dependencies(name) - {name})
+            for name in list(self._models):
+                if self.memory_used <= self.memory_budget:
+                    break
+                if name not in pinned:
+                    self.evict(name)
+            if self.memory_used > self.memory_budget:
+                logger.warning(f"Loaded models use {self.memory_used / 1024**2:.1f}MB, more than the budget of "
+                               f"{self.memory_budget / 1024**2:.1f}MB")
+
+    def get_all_dependencies(self, name):
+        """The model itself and everything it depends on, directly or indirectly"""
+        names = {name}
+        for dependency in self._dependencies.get(name, ()):
+            names |= self.get_all_dependencies(dependency)
+        return names
+
+    @staticmethod
+    def get_model_size(model, exclude=(), max_depth=2):
+        """Bytes of the parameters and buffers of the torch modules a model holds.
+
+        Wrappers such as RealESRGANer or GFPGANer are searched for modules up to max_depth attributes deep.
+        Objects in exclude (the dependencies of the model) are not counted, and tensors shared between
+        modules are counted once.
+        """
+        excluded = {id(obj) for obj in exclude}
+        seen = set()
+        tensors = {}
+
+        def visit(obj, depth):
+            if id(obj) in excluded or id(obj) in seen:
+                return
+            seen.add(id(obj))
+            if isinstance(obj, torch.nn.Module):
+                for tensor in list(obj.parameters()) + list(obj.buffers()):
+                    tensors[tensor.data_ptr()] = tensor.numel() * tensor.element_size()
+            elif depth < max_depth and hasattr(obj, '__dict__'):
+                for value in vars(obj).values():
+                    visit(value, depth + 1)
+
+        visit(model, 0)
+        return sum(tensors.values())
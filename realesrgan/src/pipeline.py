@@ -0,0 +1,106 @@
+import time
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class StagePipeline:
+    """Run items through stages of worker threads connected by bounded queues.
+
+    Every stage is a (name, fn, workers) tuple. fn is called with the value the previous stage returned, the first
+    stage with the item itself. A stage that returns a dict finishes its item with that result, so a frame that
+    fails to download skips inference and upload, and the last stage returns the result of every item.
+
+    The queues between the stages hold at most queue_size values, which bounds the decoded frames waiting for
+    inference and the upscaled frames waiting for upload, while the stages still run concurrently: inference works
+    on one frame while the next ones are downloaded and the previous ones uploaded.
+    """
+
+    def __init__(self, stages, queue_size=8, on_error=None):
+        """Initialize the pipeline
+
+        Args:
+            stages (list[tuple]): (name, fn, workers) per stage, in order.
+            queue_size (int): Maximum number of values waiting in front of each stage.
+            on_error (callable): Called with the item and the exception a stage raised, returns the result of the
+                item. Default: a 500 result with the error.
+        """
+        self.stages = [(name, fn, max(1, int(workers))) for name, fn, workers in stages]
+        self.queue_size = max(1, int(queue_size))
+        self.on_error = on_error or self.default_error
+
+    @staticmethod
+    def default_error(item, error):
+        return {'status': 500, 'error': str(error)}
+
+    def run(self, items):
+        """Process the items through all stages
+
+        Returns:
+            tuple: The results in the order of the items, and the stats of the run.
+        """
+        items = list(items)
+        results = [None] * len(items)
+        queues = [queue.Queue(self.queue_size) for _ in self.stages]
+        busy = [0.0] * len(self.stages)
+        processed = [0] * len(self.stages)
+        lock = threading.Lock()
+
+        def work(stage_index):
+            _, fn, _ = self.stages[stage_index]
+            is_last = stage_index == len(self.stages) - 1
+            while True:
+                entry = queues[stage_index].get()
+                if entry is None:
+                    return
+                index, value = entry
+                start_time = time.perf_counter()
+                try:
+                    value = fn(value)
+                except Exception as e:
+                    logger.error(f"Error in pipeline stage {self.stages[stage_index][0]} for item {index}: {e}")
+                    try:
+                        value = self.on_error(items[index], e)
+                    except Exception as error:
+                        # the worker must survive, or the stages behind it never get the item and run() hangs
+                        logger.error(f"Error handler of pipeline stage {self.stages[stage_index][0]} failed for "
+                                     f"item {index}: {error}")
+                        value = self.default_error(items[index], e)
+                with lock:
+                    busy[stage_index] += time.perf_counter() - start_time
+                    processed[stage_index] += 1
+                if is_last or isinstance(value, dict):
+                    results[index] = value
+                else:
+                    queues[stage_index + 1].put((index, value))
+
+        start_time = time.perf_counter()
+        threads = []
+        for stage_index, (name, _, workers) in enumerate(self.stages):
+            threads.append([threading.Thread(target=work, args=(stage_index, ), name=f'pipeline-{name}-{i}',
+                                             daemon=True) for i in range(workers)])
+            for thread in threads[-1]:
+                thread.start()
+
+        # Feed the first stage, then stop every stage once the stage before it has drained into it
+        for entry in enumerate(items):
+            queues[0].put(entry)
+        for stage_index, stage_threads in enumerate(threads):
+            for _ in stage_threads:
+                queues[stage_index].put(None)
+            for thread in stage_threads:
+                thread.join()
+        wall_time = time.perf_counter() - start_time
+
+        stats = {'items': len(items), 'seconds': wall_time, 'stages': {}}
+        for (name, _, workers), busy_time, count in zip(self.stages, busy, processed):
+            stats['stages'][name] = {
+                'workers': workers,
+                'items': count,
+                'busy_seconds': busy_time,
+                # share of the wall time the workers of the stage spent processing
+                'utilization': busy_time / (workers * wall_time) if wall_time > 0 else 0.0
+            }
+        return results, stats
@@ -1,4 +1,5 @@
 import cv2
+import hashlib
 import math
 import numpy as np
 import os
@@ -8,9 +9,78 @@ import torch
 from basicsr.utils.download_util import load_file_from_url
 from torch.nn import functional as F
 
+try:
+    from safetensors.torch import load_file as load_safetensors
+    from safetensors.torch import save_file as save_safetensors
+except ImportError:
+    load_safetensors = save_safetensors = None
+
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
+def load_cached_state_dict(model_path, cache_dir=None, half=False, param_key=None):
+    """Load the weights of a checkpoint through a safetensors weight cache.
+
+    On the first load the selected weights are written to cache_dir as a safetensors file, already in the target
+    dtype. Later loads memory-map that file, so nothing is unpickled or cast and the pages are shared between
+    all processes on the node. The cache file name contains the size and mtime of the checkpoint, so a replaced
+    checkpoint is converted again. Without cache_dir or the safetensors package the checkpoint is loaded with
+    torch.load.
+
+    Args:
+        model_path (str): The path to the checkpoint.
+        cache_dir (str): Directory of the converted weights. None disables the cache. Default: None.
+        half (bool): Store and return floating point weights in half precision. Default: False.
+        param_key (str): Key of the weights in the checkpoint. None prefers params_ema over params. If the key is
+            missing, the whole checkpoint is used as the weights. Default: None.
+
+    Returns:
+        dict: The state dict.
+    """
+    dtype = torch.float16 if half else torch.float32
+    cache_path = None
+    if cache_dir is not None and save_safetensors is not None:
+        stat = os.stat(model_path)
+        digest = hashlib.sha1(
+            f'{os.path.abspath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}:{param_key}'.encode()).hexdigest()[:12]
+        name = os.path.splitext(os.path.basename(model_path))[0]
+        cache_path = os.path.join(cache_dir, f'{name}.{digest}.{"fp16" if half else "fp32"}.safetensors')
+        if os.path.exists(cache_path):
+            try:
+                return load_safetensors(cache_path)
+            except Exception as error:
+                print(f'Ignoring unreadable weight cache {cache_path}: {error}')
+
+    loadnet = torch.load(model_path, map_location=torch.device('cpu'))
+    if param_key is None:
+        # prefer to use params_ema
+        param_key = 'params_ema' if 'params_ema' in loadnet else 'params'
+    state_dict = loadnet[param_key] if param_key in loadnet else loadnet
+    state_dict = {k: v.to(dtype).contiguous() if v.is_floating_point() else v for k, v in state_dict.items()}
+
+    if cache_path is not None:
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            save_safetensors({k: v.clone() for k, v in state_dict.items()}, tmp_path)
+            os.replace(tmp_path, cache_path)
+        except Exception as error:
+            print(f'Failed to write weight cache {cache_path}: {error}')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return state_dict
+
+
+def load_weights(model, state_dict):
+    """Load a state dict into a model, taking over the (memory-mapped) tensors instead of copying them when
+    the installed torch supports it."""
+    try:
+        model.load_state_dict(state_dict, strict=True, assign=True)
+    except TypeError:
+        model.load_state_dict(state_dict, strict=True)
+    return model
+
+
 class RealESRGANer():
     """A helper class for upsampling images with RealESRGAN.
 
@@ -24,8 +94,22 @@ class RealESRGANer():
         tile_pad (int): The pad size for each tile, to remove border artifacts. Default: 10.
         pre_pad (int): Pad the input images to avoid border artifacts. Default: 10.
         half (float): Whether to use half precision during inference. Default: False.
+        tile_batch_size (int): Number of tiles stacked into a single forward in tile mode. 0 derives it from
+            tile_memory_budget. Default: 1.
+        tile_memory_budget (int): Memory budget in bytes used to derive the tile batch size when tile_batch_size
+            is 0. None uses half of the free GPU memory, or 2GB on CPU. Default: None.
+        weight_cache_dir (str): Directory of the safetensors weight cache, see load_cached_state_dict. None loads
+            the checkpoint with torch.load every time. Default: None.
+        tile_blend (str): How neighbouring tiles are merged. 'crop' discards the tile_pad border of every tile,
+            'linear' and 'cosine' keep the whole tile and feather the 2 * tile_pad overlap between neighbours,
+            which hides seams with a much smaller tile_pad. Default: 'crop'.
     """
 
+    TILE_BLEND_MODES = ('crop', 'linear', 'cosine')
+
+    # rough number of activation elements kept alive per output pixel during a forward
+    TILE_ACTIVATIONS_PER_OUTPUT_PIXEL = 128
+
     def __init__(self,
                  scale,
                  model_path,
@@ -36,14 +120,28 @@ class RealESRGANer():
                  pre_pad=10,
                  half=False,
                  device=None,
-                 gpu_id=None):
+                 gpu_id=None,
+                 tile_batch_size=1,
+                 tile_memory_budget=None,
+                 tile_blend='crop',
+                 weight_cache_dir=None):
+        assert tile_blend in self.TILE_BLEND_MODES, f'tile_blend should be one of {self.TILE_BLEND_MODES}.'
         self.scale = scale
         self.tile_size = tile
         self.tile_pad = tile_pad
+        self.tile_blend = tile_blend
+        self.tile_batch_size = tile_batch_size
+        self.tile_memory_budget = tile_memory_budget
         self.pre_pad = pre_pad
-        self.mod_scale = None
         self.half = half
 
+        # mod scale for divisible borders
+        self.mod_scale = None
+        if self.scale == 2:
+            self.mod_scale = 2
+        elif self.scale == 1:
+            self.mod_scale = 4
+
         # initialize model
         if gpu_id:
             self.device = torch.device(
@@ -55,19 +153,18 @@ class RealESRGANer():
             # dni
             assert len(model_path) == len(dni_weight), 'model_path and dni_weight should have the save length.'
             loadnet = self.dni(model_path[0], model_path[1], dni_weight)
+            # prefer to use params_ema
+            if 'params_ema' in loadnet:
+                keyname = 'params_ema'
+            else:
+                keyname = 'params'
+            model.load_state_dict(loadnet[keyname], strict=True)
         else:
             # if the model_path starts with https, it will first download models to the folder: weights
             if model_path.startswith('https://'):
                 model_path = load_file_from_url(
                     url=model_path, model_dir=os.path.join(ROOT_DIR, 'weights'), progress=True, file_name=None)
-            loadnet = torch.load(model_path, map_location=torch.device('cpu'))
-
-        # prefer to use params_ema
-        if 'params_ema' in loadnet:
-            keyname = 'params_ema'
-        else:
-            keyname = 'params'
-        model.load_state_dict(loadnet[keyname], strict=True)
+            load_weights(model, load_cached_state_dict(model_path, weight_cache_dir, half=self.half))
 
         model.eval()
         self.model = model.to(self.device)
@@ -87,180 +184,474 @@ class RealESRGANer():
 
     def pre_process(self, img):
         """Pre-process, such as pre-pad and mod pad, so that the images can be divisible
+
+        Args:
+            img (Tensor): Input image with shape (n, c, h, w) and range [0, 1] on the device.
+
+        Returns:
+            tuple: The padded image tensor and the (mod_pad_h, mod_pad_w) added for divisible borders.
         """
-        img = torch.from_numpy(np.transpose(img, (2, 0, 1))).float()
-        self.img = img.unsqueeze(0).to(self.device)
         if self.half:
-            self.img = self.img.half()
+            img = img.half()
 
         # pre_pad
         if self.pre_pad != 0:
-            self.img = F.pad(self.img, (0, self.pre_pad, 0, self.pre_pad), 'reflect')
+            img = F.pad(img, (0, self.pre_pad, 0, self.pre_pad), 'reflect')
         # mod pad for divisible borders
-        if self.scale == 2:
-            self.mod_scale = 2
-        elif self.scale == 1:
-            self.mod_scale = 4
+        mod_pad_h, mod_pad_w = 0, 0
         if self.mod_scale is not None:
-            self.mod_pad_h, self.mod_pad_w = 0, 0
-            _, _, h, w = self.img.size()
+            _, _, h, w = img.size()
             if (h % self.mod_scale != 0):
-                self.mod_pad_h = (self.mod_scale - h % self.mod_scale)
+                mod_pad_h = (self.mod_scale - h % self.mod_scale)
             if (w % self.mod_scale != 0):
-                self.mod_pad_w = (self.mod_scale - w % self.mod_scale)
-            self.img = F.pad(self.img, (0, self.mod_pad_w, 0, self.mod_pad_h), 'reflect')
+                mod_pad_w = (self.mod_scale - w % self.mod_scale)
+            img = F.pad(img, (0, mod_pad_w, 0, mod_pad_h), 'reflect')
+        return img, (mod_pad_h, mod_pad_w)
 
-    def process(self):
+    def process(self, img):
         # model inference
-        self.output = self.model(self.img)
+        return self.model(img)
 
-    def tile_process(self):
-        """It will first crop input images to tiles, and then process each tile.
+    def tile_process(self, img, tile_size=None, tile_batch_size=None):
+        """It will first crop input images to tiles, and then process the tiles in batches.
         Finally, all the processed tiles are merged into one images.
 
         Modified from: https://github.com/ata4/esrgan-launcher
         """
-        batch, channel, height, width = self.img.shape
-        output_height = height * self.scale
-        output_width = width * self.scale
-        output_shape = (batch, channel, output_height, output_width)
+        batch, channel, height, width = img.shape
+        output_shape = (batch, channel, height * self.scale, width * self.scale)
 
         # start with black image
-        self.output = self.img.new_zeros(output_shape)
-        tiles_x = math.ceil(width / self.tile_size)
-        tiles_y = math.ceil(height / self.tile_size)
-
-        # loop over all tiles
-        for y in range(tiles_y):
-            for x in range(tiles_x):
-                # extract tile from input image
-                ofs_x = x * self.tile_size
-                ofs_y = y * self.tile_size
-                # input tile area on total image
-                input_start_x = ofs_x
-                input_end_x = min(ofs_x + self.tile_size, width)
-                input_start_y = ofs_y
-                input_end_y = min(ofs_y + self.tile_size, height)
-
-                # input tile area on total image with padding
-                input_start_x_pad = max(input_start_x - self.tile_pad, 0)
-                input_end_x_pad = min(input_end_x + self.tile_pad, width)
-                input_start_y_pad = max(input_start_y - self.tile_pad, 0)
-                input_end_y_pad = min(input_end_y + self.tile_pad, height)
-
-                # input tile dimensions
-                input_tile_width = input_end_x - input_start_x
-                input_tile_height = input_end_y - input_start_y
-                tile_idx = y * tiles_x + x + 1
-                input_tile = self.img[:, :, input_start_y_pad:input_end_y_pad, input_start_x_pad:input_end_x_pad]
-
-                # upscale tile
-                try:
-                    with torch.no_grad():
-                        output_tile = self.model(input_tile)
-                except RuntimeError as error:
-                    print('Error', error)
-                print(f'\tTile {tile_idx}/{tiles_x * tiles_y}')
-
-                # output tile area on total image
-                output_start_x = input_start_x * self.scale
-                output_end_x = input_end_x * self.scale
-                output_start_y = input_start_y * self.scale
-                output_end_y = input_end_y * self.scale
-
-                # output tile area without padding
-                output_start_x_tile = (input_start_x - input_start_x_pad) * self.scale
-                output_end_x_tile = output_start_x_tile + input_tile_width * self.scale
-                output_start_y_tile = (input_start_y - input_start_y_pad) * self.scale
-                output_end_y_tile = output_start_y_tile + input_tile_height * self.scale
-
-                # put tile into output image
-                self.output[:, :, output_start_y:output_end_y,
-                            output_start_x:output_end_x] = output_tile[:, :, output_start_y_tile:output_end_y_tile,
-                                                                       output_start_x_tile:output_end_x_tile]
-
-    def post_process(self):
+        output = img.new_zeros(output_shape)
+        for start_row, rows in self.tile_rows(img, tile_size, tile_batch_size):
+            output[:, :, start_row:start_row + rows.shape[2]] = rows
+        return output
+
+    def tile_rows(self, img, tile_size=None, tile_batch_size=None):
+        """Process the image tile by tile and yield every tile row of the output as soon as it is complete.
+
+        All tiles are cropped with the same padded size, edge tiles take their padding from the inside of the
+        image, so that several tiles can be stacked into one forward. Only the rows touched by the current tile
+        batch are kept in memory.
+
+        With tile_blend 'crop' the padding of every output tile is cut away. Otherwise the whole output tile is
+        accumulated with feathered weights and the rows are normalized by the accumulated weights once no later
+        tile can touch them.
+
+        Yields:
+            tuple: The first output row and the (n, c, rows, width * scale) tensor of the finished tile row.
+        """
+        tile_size = tile_size or self.tile_size
+        batch, channel, height, width = img.shape
+
+        # every input tile (with padding) has the same size
+        tile_height = min(tile_size + 2 * self.tile_pad, height)
+        tile_width = min(tile_size + 2 * self.tile_pad, width)
+        tiles = self.get_tile_grid(height, width, tile_height, tile_width, tile_size)
+        tile_batch_size = tile_batch_size or self.get_tile_batch_size(tile_height, tile_width, batch)
+        tiles_x = math.ceil(width / tile_size)
+        blend = self.tile_blend != 'crop'
+
+        # output tile rows that are still being filled, keyed by their first input row
+        rows = {}
+        # feathered accumulator for the output rows from acc_start on, and the first padded row of every tile row
+        acc = acc_weight = None
+        acc_start = 0
+        row_pads = [pad_y for (pad_y, _), _ in tiles[::tiles_x]]
+        for start in range(0, len(tiles), tile_batch_size):
+            tile_batch = tiles[start:start + tile_batch_size]
+            input_tiles = torch.cat([
+                img[:, :, pad_y:pad_y + tile_height, pad_x:pad_x + tile_width] for (pad_y, pad_x), _ in tile_batch
+            ])
+
+            # upscale tiles
+            try:
+                with torch.no_grad():
+                    output_tiles = self.model(input_tiles)
+            except RuntimeError as error:
+                print('Error', error)
+                raise
+            print(f'\tTile {start + len(tile_batch)}/{len(tiles)}')
+
+            # put tiles into their output row
+            for i, ((pad_y, pad_x), (start_y, end_y, start_x, end_x)) in enumerate(tile_batch):
+                output_tile = output_tiles[i * batch:(i + 1) * batch]
+                if blend:
+                    row_end = (pad_y + tile_height) * self.scale
+                    if acc is None or acc_start + acc.shape[2] < row_end:
+                        # grow the accumulator down to the bottom of this tile row
+                        grown = output_tile.new_zeros((batch, channel, row_end - acc_start, width * self.scale),
+                                                      dtype=torch.float32)
+                        grown_weight = grown.new_zeros((1, 1, row_end - acc_start, width * self.scale))
+                        if acc is not None:
+                            grown[:, :, :acc.shape[2]] = acc
+                            grown_weight[:, :, :acc.shape[2]] = acc_weight
+                        acc, acc_weight = grown, grown_weight
+
+                    weight_y = self.get_tile_weights(tile_height, pad_y == 0, pad_y + tile_height == height,
+                                                     output_tile.device)
+                    weight_x = self.get_tile_weights(tile_width, pad_x == 0, pad_x + tile_width == width,
+                                                     output_tile.device)
+                    weight = weight_y[:, None] * weight_x[None, :]
+                    y0 = pad_y * self.scale - acc_start
+                    x0 = pad_x * self.scale
+                    region = (slice(None), slice(None), slice(y0, y0 + weight.shape[0]),
+                              slice(x0, x0 + weight.shape[1]))
+                    acc[region] += output_tile.float() * weight
+                    acc_weight[region] += weight
+                else:
+                    if start_y not in rows:
+                        rows[start_y] = img.new_empty((batch, channel, (end_y - start_y) * self.scale,
+                                                       width * self.scale))
+                    # output tile area without padding
+                    output_start_y_tile = (start_y - pad_y) * self.scale
+                    output_end_y_tile = (end_y - pad_y) * self.scale
+                    output_start_x_tile = (start_x - pad_x) * self.scale
+                    output_end_x_tile = (end_x - pad_x) * self.scale
+                    rows[start_y][:, :, :, start_x * self.scale:end_x * self.scale] = output_tile[
+                        :, :, output_start_y_tile:output_end_y_tile, output_start_x_tile:output_end_x_tile]
+
+                if (start + i + 1) % tiles_x != 0:
+                    continue
+                # last tile of the row
+                if not blend:
+                    yield start_y * self.scale, rows.pop(start_y)
+                    continue
+                # the rows above the next tile row are final
+                row_index = (start + i) // tiles_x
+                if row_index + 1 < len(row_pads):
+                    count = row_pads[row_index + 1] * self.scale - acc_start
+                else:
+                    count = acc.shape[2]
+                if count > 0:
+                    yield acc_start, acc[:, :, :count] / acc_weight[:, :, :count]
+                    acc, acc_weight = acc[:, :, count:].clone(), acc_weight[:, :, count:].clone()
+                    acc_start += count
+
+    def get_tile_weights(self, tile_length, start_border, end_border, device=None):
+        """Feathering weights along one axis of an output tile.
+
+        The weights ramp up over the 2 * tile_pad * scale output pixels that overlap with the neighbouring tile,
+        so that the ramps of two neighbours sum up to one. Sides on the image border keep the full weight.
+
+        Args:
+            tile_length (int): Length of the padded input tile.
+            start_border (bool): Whether the tile starts at the image border.
+            end_border (bool): Whether the tile ends at the image border.
+
+        Returns:
+            Tensor: The (tile_length * scale) weights.
+        """
+        length = tile_length * self.scale
+        ramp_length = min(2 * self.tile_pad * self.scale, length // 2)
+        weights = torch.ones(length, device=device)
+        if ramp_length == 0:
+            return weights
+        ramp = (torch.arange(ramp_length, device=device, dtype=torch.float32) + 0.5) / ramp_length
+        if self.tile_blend == 'cosine':
+            ramp = torch.sin(ramp * math.pi / 2)**2
+        if not start_border:
+            weights[:ramp_length] = ramp
+        if not end_border:
+            weights[length - ramp_length:] = torch.minimum(weights[length - ramp_length:], ramp.flip(0))
+        return weights
+
+    def get_tile_grid(self, height, width, tile_height, tile_width, tile_size=None):
+        """Split the image into tiles.
+
+        Returns:
+            list[tuple]: ((pad_y, pad_x), (start_y, end_y, start_x, end_x)) for every tile, the top-left corner
+                of the padded input tile and the tile area without padding on the total image.
+        """
+        tile_size = tile_size or self.tile_size
+        tiles = []
+        for start_y in range(0, height, tile_size):
+            end_y = min(start_y + tile_size, height)
+            pad_y = min(max(start_y - self.tile_pad, 0), height - tile_height)
+            for start_x in range(0, width, tile_size):
+                end_x = min(start_x + tile_size, width)
+                pad_x = min(max(start_x - self.tile_pad, 0), width - tile_width)
+                tiles.append(((pad_y, pad_x), (start_y, end_y, start_x, end_x)))
+        return tiles
+
+    def get_tile_batch_size(self, tile_height, tile_width, batch=1):
+        """Number of tiles stacked into one forward, derived from the memory budget if not set."""
+        if self.tile_batch_size > 0:
+            return self.tile_batch_size
+
+        memory_budget = self.tile_memory_budget
+        if memory_budget is None:
+            if self.device.type == 'cuda':
+                memory_budget = torch.cuda.mem_get_info(self.device)[0] // 2
+            else:
+                memory_budget = 2 * 1024**3
+        bytes_per_element = 2 if self.half else 4
+        tile_memory = (batch * tile_height * tile_width * self.scale**2 * self.TILE_ACTIVATIONS_PER_OUTPUT_PIXEL *
+                       bytes_per_element)
+        return max(1, int(memory_budget // tile_memory))
+
+    def post_process(self, output, mod_pad):
+        mod_pad_h, mod_pad_w = mod_pad
         # remove extra pad
         if self.mod_scale is not None:
-            _, _, h, w = self.output.size()
-            self.output = self.output[:, :, 0:h - self.mod_pad_h * self.scale, 0:w - self.mod_pad_w * self.scale]
+            _, _, h, w = output.size()
+            output = output[:, :, 0:h - mod_pad_h * self.scale, 0:w - mod_pad_w * self.scale]
         # remove prepad
         if self.pre_pad != 0:
-            _, _, h, w = self.output.size()
-            self.output = self.output[:, :, 0:h - self.pre_pad * self.scale, 0:w - self.pre_pad * self.scale]
-        return self.output
+            _, _, h, w = output.size()
+            output = output[:, :, 0:h - self.pre_pad * self.scale, 0:w - self.pre_pad * self.scale]
+        return output
+
+    def upscale(self, img, tile_size=None, tile_batch_size=None):
+        """Run pre_process, (tile) inference and post_process on an image without touching the instance state,
+        so that concurrent calls can share one loaded model.
+        """
+        tile_size = self.tile_size if tile_size is None else tile_size
+        img, mod_pad = self.pre_process(img)
+        if tile_size > 0:
+            output = self.tile_process(img, tile_size, tile_batch_size)
+        else:
+            output = self.process(img)
+        return self.post_process(output, mod_pad)
+
+    def upscale_rows(self, img, tile_size=None, tile_batch_size=None):
+        """Like upscale, but yield the output one tile row at a time, so that the whole upscaled image never has
+        to be held in memory. Without tiling the whole image is a single row.
+
+        Yields:
+            tuple: The first output row and the (n, c, rows, w * scale) tensor of the rows.
+        """
+        tile_size = self.tile_size if tile_size is None else tile_size
+        output_height, output_width = img.shape[2] * self.scale, img.shape[3] * self.scale
+        img, _ = self.pre_process(img)
+        if tile_size > 0:
+            rows = self.tile_rows(img, tile_size, tile_batch_size)
+        else:
+            rows = [(0, self.process(img))]
+        for start_row, output in rows:
+            if start_row >= output_height:
+                break
+            # remove the pre pad and mod pad at the bottom and right
+            yield start_row, output[:, :, :output_height - start_row, :output_width]
 
     @torch.no_grad()
-    def enhance(self, img, outscale=None, alpha_upsampler='realesrgan'):
+    def enhance(self, img, outscale=None, alpha_upsampler='realesrgan', tile=None, out=None, tile_batch_size=None):
+        """Upscale an image.
+
+        The raw 8/16-bit buffer is copied to the device once, normalization, BGR<->RGB, layout changes, the
+        outscale resize and quantization all run as tensor ops there, and the result is copied back once.
+        The per-call state lives in local variables only, so enhance can be called from several threads
+        against the same RealESRGANer.
+
+        Args:
+            alpha_upsampler (str): How to upscale the alpha channel of RGBA images. 'realesrgan' runs it through
+                the network in the same batch as the image, 'bicubic' and 'guided' (bicubic refined with a guided
+                filter on the upscaled image) are cheap alternatives, anything else uses bilinear interpolation.
+                Default: 'realesrgan'.
+            tile (int): Override the tile size for this call. None uses the tile size of the instance.
+            out (ndarray | callable): Stream the output instead of returning a new array. Either a preallocated
+                array (e.g. a np.memmap) of get_output_shape(img) that every finished tile row is written into,
+                or a callable that receives (start_row, rows) for every finished tile row. Peak memory is then
+                bounded by one tile row instead of the whole upscaled image. Requires outscale to be None or
+                equal to scale. Default: None.
+            tile_batch_size (int): Override the tile batch size for this call. None uses the tile batch size of
+                the instance.
+        """
         h_input, w_input = img.shape[0:2]
-        # img: numpy
-        img = img.astype(np.float32)
-        if np.max(img) > 256:  # 16-bit image
-            max_range = 65535
-            print('\tInput is a 16-bit image')
-        else:
-            max_range = 255
-        img = img / max_range
-        if len(img.shape) == 2:  # gray image
+        if out is not None:
+            if outscale is not None and outscale != float(self.scale):
+                raise ValueError(f'Streamed output does not support outscale {outscale} != scale {self.scale}')
+            output_shape = self.get_output_shape(img)
+            if not callable(out) and tuple(out.shape) != output_shape:
+                raise ValueError(f'Output array has shape {tuple(out.shape)}, expected {output_shape}')
+
+        img, max_range = self.img2tensor(img)
+        if img.dim() == 2:  # gray image
             img_mode = 'L'
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+            img = img.unsqueeze(2).expand(-1, -1, 3)
         elif img.shape[2] == 4:  # RGBA image with alpha channel
             img_mode = 'RGBA'
             alpha = img[:, :, 3]
-            img = img[:, :, 0:3]
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            if alpha_upsampler == 'realesrgan':
-                alpha = cv2.cvtColor(alpha, cv2.COLOR_GRAY2RGB)
+            img = img[:, :, [2, 1, 0]]
         else:
             img_mode = 'RGB'
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            img = img[:, :, [2, 1, 0]]
+        img = img.permute(2, 0, 1).unsqueeze(0)
 
-        # ------------------- process image (without the alpha channel) ------------------- #
-        self.pre_process(img)
-        if self.tile_size > 0:
-            self.tile_process()
-        else:
-            self.process()
-        output_img = self.post_process()
-        output_img = output_img.data.squeeze().float().cpu().clamp_(0, 1).numpy()
-        output_img = np.transpose(output_img[[2, 1, 0], :, :], (1, 2, 0))
+        alpha_img = None
+        if img_mode == 'RGBA':
+            alpha_img = alpha.view(1, 1, h_input, w_input)
+            if alpha_upsampler == 'realesrgan':
+                # batch the alpha plane with the colour image so that both go through the same forward
+                img = torch.cat((img, alpha_img.expand(-1, 3, -1, -1)))
+
+        # ------------------------ stream the output row by row ------------------------ #
+        if out is not None:
+            for start_row, rows in self.upscale_rows(img, tile, tile_batch_size):
+                rows = self.merge_output(rows, img_mode, alpha_img, alpha_upsampler, start_row)
+                rows = self.tensor2img(rows, max_range)
+                if callable(out):
+                    out(start_row, rows)
+                else:
+                    out[start_row:start_row + rows.shape[0]] = rows
+            return out, img_mode
+
+        # ------------------- process image (and the alpha plane) ------------------- #
+        output_img = self.merge_output(self.upscale(img, tile, tile_batch_size), img_mode, alpha_img, alpha_upsampler)
+
+        # ------------------------------ return ------------------------------ #
+        if outscale is not None and outscale != float(self.scale):
+            output_img = F.interpolate(
+                output_img,
+                size=(int(h_input * outscale), int(w_input * outscale)),
+                mode='bicubic',
+                align_corners=False,
+                antialias=True).clamp_(0, 1)
+
+        output = self.tensor2img(output_img, max_range)
+        return output, img_mode
+
+    @torch.no_grad()
+    def enhance_batch(self, imgs, outscale=None, tile=None, tile_batch_size=None):
+        """Upscale images of the same shape in one forward.
+
+        8-bit color images are stacked along the batch dimension and go through upscale together, other images
+        are enhanced one by one.
+
+        Args:
+            imgs (list[ndarray]): Images of the same shape and dtype.
+
+        Returns:
+            list[ndarray]: The upscaled images, as returned by enhance.
+        """
+        if len(imgs) == 1 or imgs[0].dtype != np.uint8 or imgs[0].ndim != 3 or imgs[0].shape[2] != 3:
+            return [self.enhance(img, outscale, tile=tile, tile_batch_size=tile_batch_size)[0] for img in imgs]
+
+        h_input, w_input = imgs[0].shape[0:2]
+        img = torch.stack([self.img2tensor(img)[0] for img in imgs])
+        img = img[:, :, :, [2, 1, 0]].permute(0, 3, 1, 2)
+        output = self.upscale(img, tile, tile_batch_size).float().clamp_(0, 1)[:, [2, 1, 0]]
+        if outscale is not None and outscale != float(self.scale):
+            output = F.interpolate(
+                output,
+                size=(int(h_input * outscale), int(w_input * outscale)),
+                mode='bicubic',
+                align_corners=False,
+                antialias=True).clamp_(0, 1)
+        return [self.tensor2img(output[i:i + 1], 255) for i in range(len(imgs))]
+
+    def get_output_shape(self, img, outscale=None):
+        """Shape of the image that enhance returns for the numpy image img."""
+        outscale = self.scale if outscale is None else outscale
+        output_shape = (int(img.shape[0] * outscale), int(img.shape[1] * outscale))
+        if img.ndim == 3:
+            output_shape += (img.shape[2], )
+        return output_shape
+
+    def merge_output(self, output, img_mode, alpha=None, alpha_upsampler='realesrgan', start_row=0):
+        """Turn (rows of) the network output into a (1, c, h, w) BGR, BGRA or gray tensor in [0, 1].
+
+        Args:
+            output (Tensor): Network output rows, with the alpha plane as second batch item for 'realesrgan'.
+            alpha (Tensor): The (1, 1, h, w) input alpha plane of RGBA images.
+            start_row (int): First output row of output, to pick the matching rows of the upscaled alpha.
+        """
+        output = output.float().clamp_(0, 1)
+        output_img = output[0:1, [2, 1, 0]]
         if img_mode == 'L':
-            output_img = cv2.cvtColor(output_img, cv2.COLOR_BGR2GRAY)
+            output_img = self.bgr2gray(output_img)
 
         # ------------------- process the alpha channel if necessary ------------------- #
         if img_mode == 'RGBA':
             if alpha_upsampler == 'realesrgan':
-                self.pre_process(alpha)
-                if self.tile_size > 0:
-                    self.tile_process()
-                else:
-                    self.process()
-                output_alpha = self.post_process()
-                output_alpha = output_alpha.data.squeeze().float().cpu().clamp_(0, 1).numpy()
-                output_alpha = np.transpose(output_alpha[[2, 1, 0], :, :], (1, 2, 0))
-                output_alpha = cv2.cvtColor(output_alpha, cv2.COLOR_BGR2GRAY)
-            else:  # use the cv2 resize for alpha channel
-                h, w = alpha.shape[0:2]
-                output_alpha = cv2.resize(alpha, (w * self.scale, h * self.scale), interpolation=cv2.INTER_LINEAR)
+                output_alpha = self.bgr2gray(output[1:2, [2, 1, 0]])
+            else:
+                output_alpha = self.upscale_alpha(alpha, alpha_upsampler, output_img, start_row)
 
             # merge the alpha channel
-            output_img = cv2.cvtColor(output_img, cv2.COLOR_BGR2BGRA)
-            output_img[:, :, 3] = output_alpha
+            output_img = torch.cat((output_img, output_alpha), 1)
+        return output_img
 
-        # ------------------------------ return ------------------------------ #
+    def upscale_alpha(self, alpha, alpha_upsampler, guide, start_row=0):
+        """Interpolate the output rows [start_row, start_row + guide rows) of the alpha plane.
+
+        Only the band of input rows needed for these rows, plus interpolation context, is resized.
+        """
+        num_rows = guide.shape[2]
+        context = 2
+        band_start = max(start_row // self.scale - context, 0)
+        band_end = min(math.ceil((start_row + num_rows) / self.scale) + context, alpha.shape[2])
+        offset = start_row - band_start * self.scale
+
+        if alpha_upsampler in ('bicubic', 'guided'):
+            output_alpha = F.interpolate(
+                alpha[:, :, band_start:band_end], scale_factor=self.scale, mode='bicubic', align_corners=False)
+            output_alpha = output_alpha[:, :, offset:offset + num_rows].clamp_(0, 1)
+            if alpha_upsampler == 'guided':
+                # snap the alpha edges to the edges of the upscaled image
+                output_alpha = self.guided_filter(
+                    self.bgr2gray(guide[:, 0:3]), output_alpha, radius=self.scale, eps=1e-4).clamp_(0, 1)
+        else:  # use bilinear interpolation for alpha channel
+            output_alpha = F.interpolate(
+                alpha[:, :, band_start:band_end], scale_factor=self.scale, mode='bilinear', align_corners=False)
+            output_alpha = output_alpha[:, :, offset:offset + num_rows]
+        return output_alpha
+
+    def img2tensor(self, img):
+        """Copy a numpy image (h, w[, c]) to the device as a float tensor in [0, 1].
+
+        Returns:
+            tuple: The float image tensor and its max range (255 or 65535).
+        """
+        if img.dtype == np.uint16:
+            # torch has no uint16 tensors before 2.3, widen on the host
+            img = img.astype(np.int32)
+        is_8bit = img.dtype == np.uint8
+        img = torch.from_numpy(np.ascontiguousarray(img)).to(self.device, non_blocking=True).float()
+        if not is_8bit and img.max() > 256:  # 16-bit image
+            max_range = 65535
+            print('\tInput is a 16-bit image')
+        else:
+            max_range = 255
+        # out of place, for a float32 input on the CPU img still shares the memory of the caller's array
+        return img.div(max_range), max_range
+
+    @staticmethod
+    def bgr2gray(img):
+        """Convert a (n, 3, h, w) BGR tensor to (n, 1, h, w) gray, with the weights of cv2.COLOR_BGR2GRAY."""
+        return img[:, 0:1] * 0.114 + img[:, 1:2] * 0.587 + img[:, 2:3] * 0.299
+
+    @staticmethod
+    def guided_filter(guide, src, radius, eps):
+        """Edge-preserving guided filter (He et al.) of a (n, 1, h, w) src with a (n, 1, h, w) guide."""
+
+        def box(x):
+            return F.avg_pool2d(x, 2 * radius + 1, stride=1, padding=radius, count_include_pad=False)
+
+        mean_guide = box(guide)
+        mean_src = box(src)
+        cov = box(guide * src) - mean_guide * mean_src
+        var = box(guide * guide) - mean_guide * mean_guide
+        a = cov / (var + eps)
+        b = mean_src - a * mean_guide
+        return box(a) * guide + box(b)
+
+    @staticmethod
+    def tensor2img(img, max_range):
+        """Quantize a (1, c, h, w) tensor in [0, 1] on the device and copy it to a numpy (h, w[, c]) image."""
+        img = img.mul(max_range).round_()
         if max_range == 65535:  # 16-bit image
-            output = (output_img * 65535.0).round().astype(np.uint16)
+            # wrap to int16 on the device and reinterpret the bits as uint16 on the host
+            img = img.to(torch.int32).to(torch.int16)
         else:
-            output = (output_img * 255.0).round().astype(np.uint8)
-
-        if outscale is not None and outscale != float(self.scale):
-            output = cv2.resize(
-                output, (
-                    int(w_input * outscale),
-                    int(h_input * outscale),
-                ), interpolation=cv2.INTER_LANCZOS4)
-
-        return output, img_mode
+            img = img.to(torch.uint8)
+        img = img[0].permute(1, 2, 0).contiguous()
+        if img.shape[2] == 1:
+            img = img[:, :, 0]
+        output = img.cpu().numpy()
+        if max_range == 65535:
+            output = output.view(np.uint16)
+        return output
 
 
 class PrefetchReader(threading.Thread):
@@ -0,0 +1,201 @@
+import io
+import ast
+import json
+import math
+import uuid
+import mimetypes
+from email.message import Message
+from email.parser import BytesHeaderParser
+
+import cv2
+import numpy as np
+
+# Request and response content types of inline frames -> file extension
+FRAME_CONTENT_TYPES = {
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'application/x-npy': '.npy',
+}
+
+NPY_MAGIC = b'\x93NUMPY'
+
+
+class RequestBatch(list):
+    """The inputs of the requests that the model server batched into one predict_fn call, one per request in the
+    order of the requests. predict_fn returns a list with one prediction per request for it."""
+
+
+def parse_content_type(content_type):
+    """Split a Content-Type header into its lower-case media type and its parameters"""
+    message = Message()
+    message['Content-Type'] = content_type or ''
+    return message.get_content_type(), dict((message.get_params() or [])[1:])
+
+
+def decode_npy(data):
+    """Map a .npy buffer into an array without copying its data
+
+    The header is parsed as by np.load, the array is a view of the buffer (read-only for bytes).
+    """
+    view = memoryview(data)
+    if bytes(view[:len(NPY_MAGIC)]) != NPY_MAGIC:
+        raise ValueError("Invalid .npy payload")
+    header_length_size = 2 if view[6] == 1 else 4
+    header_start = len(NPY_MAGIC) + 2 + header_length_size
+    header_length = int.from_bytes(view[len(NPY_MAGIC) + 2:header_start], 'little')
+    header = ast.literal_eval(bytes(view[header_start:header_start + header_length]).decode('latin1'))
+    dtype = np.lib.format.descr_to_dtype(header['descr'])
+    if dtype.hasobject:
+        raise ValueError("Object arrays are not supported")
+    shape = tuple(header['shape'])
+    return np.frombuffer(view, dtype=dtype, count=math.prod(shape), offset=header_start + header_length).reshape(
+        shape, order='F' if header['fortran_order'] else 'C')
+
+
+def decode_frame(data, content_type, flags=cv2.IMREAD_UNCHANGED):
+    """Decode an inline frame of one of FRAME_CONTENT_TYPES, encoded images are decoded straight from the buffer
+
+    Returns:
+        np.ndarray: The frame in the layout of cv2.imread (HxW, HxWx3 BGR or HxWx4 BGRA).
+    """
+    if content_type == 'application/x-npy':
+        return decode_npy(data)
+    if content_type not in FRAME_CONTENT_TYPES:
+        raise ValueError(f"Unsupported frame content type: {content_type}")
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    if img is None:
+        raise ValueError(f"Failed to decode {content_type} frame")
+    return img
+
+
+def encode_frame(img, content_type):
+    """Encode an output frame as one of FRAME_CONTENT_TYPES
+
+    Returns:
+        bytes: The encoded frame.
+    """
+    if content_type == 'application/x-npy':
+        buffer = io.BytesIO()
+        np.save(buffer, img)
+        return buffer.getvalue()
+    if content_type not in FRAME_CONTENT_TYPES:
+        raise ValueError(f"Unsupported frame content type: {content_type}")
+    success, buffer = cv2.imencode(FRAME_CONTENT_TYPES[content_type], img)
+    if not success:
+        raise ValueError(f"Failed to encode {content_type} frame")
+    return buffer.tobytes()
+
+
+def parse_multipart(data, content_type):
+    """Split a multipart/form-data body into its parts, the part bodies are views of the request buffer
+
+    Returns:
+        list[tuple]: (headers, body) per part, headers as an email.message.Message and body as a memoryview.
+    """
+    boundary = parse_content_type(content_type)[1].get('boundary')
+    if not boundary:
+        raise ValueError("Missing multipart boundary")
+    delimiter = b'--' + boundary.encode('latin1')
+    view = memoryview(data)
+    parts = []
+    start = data.find(delimiter)
+    if start < 0:
+        raise ValueError("Multipart body without parts")
+    while True:
+        start += len(delimiter)
+        if data[start:start + 2] == b'--':
+            return parts
+        end = data.find(b'\r\n' + delimiter, start)
+        header_end = data.find(b'\r\n\r\n', start, end)
+        if end < 0 or header_end < 0:
+            raise ValueError("Malformed multipart body")
+        headers = BytesHeaderParser().parsebytes(bytes(view[start:header_end]).lstrip(b'\r\n'))
+        parts.append((headers, view[header_end + 4:end]))
+        start = end + 2
+
+
+def parse_multipart_frames(data, content_type, flags=cv2.IMREAD_UNCHANGED):
+    """Decode the frames of a multipart/form-data batch
+
+    Every file part is a frame, decoded by its Content-Type or else the extension of its file name. The other
+    fields are request parameters shared by the frames, JSON values (e.g. numbers) are decoded.
+
+    Returns:
+        tuple: The fields as a dict, and per frame a dict with its field name, image and content type.
+    """
+    fields = {}
+    frames = []
+    for headers, body in parse_multipart(data, content_type):
+        name = headers.get_param('name', header='content-disposition')
+        filename = headers.get_filename()
+        if filename is None:
+            value = bytes(body).decode('utf-8')
+            try:
+                fields[name] = json.loads(value)
+            except ValueError:
+                fields[name] = value
+            continue
+        frame_type = headers.get_content_type()
+        if frame_type not in FRAME_CONTENT_TYPES:
+            extension = '.' + filename.rsplit('.', 1)[-1].lower()
+            frame_type = next((content_type for content_type, frame_extension in FRAME_CONTENT_TYPES.items()
+                               if frame_extension == extension), mimetypes.guess_type(filename)[0])
+        frames.append({'name': name, 'image': decode_frame(body, frame_type, flags), 'output_format': frame_type})
+    return fields, frames
+
+
+def encode_multipart(parts):
+    """Build a multipart/form-data body
+
+    Args:
+        parts (list[tuple]): (name, content type, body, file name or None) per part.
+
+    Returns:
+        tuple: The body and its Content-Type with the boundary.
+    """
+    boundary = uuid.uuid4().hex
+    chunks = []
+    for name, content_type, body, filename in parts:
+        disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else '')
+        chunks.append(f'--{boundary}\r\nContent-Disposition: {disposition}\r\n'
+                      f'Content-Type: {content_type}\r\n\r\n'.encode('latin1'))
+        chunks.append(body)
+        chunks.append(b'\r\n')
+    chunks.append(f'--{boundary}--\r\n'.encode('latin1'))
+    return b''.join(chunks), f'multipart/form-data; boundary={boundary}'
+
+
+def strip_images(prediction):
+    """Copy a prediction without the inline output images of its results"""
+    if isinstance(prediction, dict):
+        return {key: strip_images(value) for key, value in prediction.items() if key != 'image'}
+    if isinstance(prediction, list):
+        return [strip_images(value) for value in prediction]
+    return prediction
+
+
+def serialize_prediction(prediction, results):
+    """Serialize a prediction whose results may hold inline output images
+
+    A single successful inline result is returned as the image itself. Otherwise, when results hold inline images,
+    a multipart/form-data body with the prediction as a JSON "results" part and one part per image named by its
+    batch_id, and else the prediction as JSON.
+
+    Args:
+        prediction: The output of predict_fn.
+        results (list[dict]): The per-item results of the prediction.
+
+    Returns:
+        tuple: The response body and its content type.
+    """
+    if isinstance(prediction, dict) and 'image' in prediction:
+        return prediction['image'], prediction['content_type']
+    if not any('image' in result for result in results):
+        return json.dumps(prediction), 'application/json'
+    parts = [('results', 'application/json', json.dumps(strip_images(prediction)).encode('utf-8'), None)]
+    for result in results:
+        if 'image' in result:
+            name = str(result['batch_id'])
+            parts.append((name, result['content_type'], result['image'],
+                          name + FRAME_CONTENT_TYPES[result['content_type']]))
+    return encode_multipart(parts)
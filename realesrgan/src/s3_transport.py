@@ -0,0 +1,171 @@
+import io
+import os
+import gzip
+import time
+import logging
+import mimetypes
+import threading
+
+import boto3
+import boto3.s3.transfer  # not imported by "import boto3" alone
+import cv2
+import numpy as np
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+# One S3 client per process with a connection pool shared by all request threads
+S3_CONFIG = Config(
+    region_name=os.environ.get('AWS_REGION', 'us-east-1'),
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+    s3={'use_accelerate': os.environ.get('USE_S3_ACCELERATION', 'False').lower() == 'true'},
+    max_pool_connections=int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 100)),
+    tcp_keepalive=True
+)
+
+# Constants for S3 transfer optimization
+MULTIPART_THRESHOLD = 100 * 1024 * 1024  # 100MB
+MULTIPART_CHUNKSIZE = 25 * 1024 * 1024   # 25MB
+MAX_CONCURRENCY = 10
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """Create the shared S3 client on first use instead of at import time"""
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                _s3_client = boto3.client('s3', config=S3_CONFIG)
+    return _s3_client
+
+
+def parse_s3_uri(s3_uri):
+    """Split an s3://bucket/key URI into its bucket and key"""
+    parts = s3_uri[5:].split('/', 1)
+    return parts[0], parts[1] if len(parts) > 1 else ''
+
+
+def get_transfer_config():
+    """Transfer configuration of the multipart uploads"""
+    return boto3.s3.transfer.TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD,
+        max_concurrency=MAX_CONCURRENCY,
+        multipart_chunksize=MULTIPART_CHUNKSIZE
+    )
+
+
+def get_object(bucket, key, cache=None):
+    """Read the content of an S3 object, from the cache if the cached entry is still current
+
+    The cached entry is revalidated with a conditional GET on its ETag, S3 answers 304 without the content
+    when the object is unchanged.
+    """
+    s3_client = get_s3_client()
+    s3_uri = f"s3://{bucket}/{key}"
+    etag = cache.get_etag(s3_uri) if cache is not None else None
+    if etag is not None:
+        try:
+            response = s3_client.get_object(Bucket=bucket, Key=key, IfNoneMatch=f'"{etag}"')
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('304', 'NotModified'):
+                raise
+            data = cache.get(s3_uri, etag)
+            if data is not None:
+                logger.info(f"Using cached {s3_uri}")
+                return data
+            # evicted since the lookup
+            response = s3_client.get_object(Bucket=bucket, Key=key)
+    else:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+
+    data = response['Body'].read()
+    if cache is not None:
+        cache.put(s3_uri, response['ETag'], data)
+    return data
+
+
+def get_object_bytes(s3_uri, use_compression=False, cache=None):
+    """Read an S3 object into memory
+
+    Args:
+        s3_uri (str): The s3://bucket/key URI of the object.
+        use_compression (bool): Read the gzip compressed <key>.gz instead if it exists.
+        cache (ImageCache): Disk cache of the objects, None to always download them.
+
+    Returns:
+        bytes: The content of the object.
+    """
+    bucket, key = parse_s3_uri(s3_uri)
+    start_time = time.time()
+    data = None
+    if use_compression:
+        try:
+            data = gzip.decompress(get_object(bucket, f"{key}.gz", cache))
+        except ClientError:
+            # Compressed version doesn't exist, use the original
+            pass
+    if data is None:
+        data = get_object(bucket, key, cache)
+    logger.info(f"Read {len(data) / (1024 * 1024):.2f} MB from {s3_uri} in {time.time() - start_time:.2f} seconds")
+    return data
+
+
+def put_object_bytes(data, s3_uri, use_compression=False):
+    """Write a buffer to an S3 object, with a multipart upload for large buffers
+
+    Args:
+        data (bytes): The content of the object.
+        s3_uri (str): The s3://bucket/key URI of the object.
+        use_compression (bool): Also write a gzip compressed copy to <key>.gz.
+
+    Returns:
+        str: The S3 URI.
+    """
+    bucket, key = parse_s3_uri(s3_uri)
+    s3_client = get_s3_client()
+    start_time = time.time()
+    content_type = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+    objects = [(key, data)]
+    if use_compression:
+        objects.append((f"{key}.gz", gzip.compress(data)))
+    for object_key, object_data in objects:
+        if len(object_data) > MULTIPART_THRESHOLD:
+            s3_client.upload_fileobj(io.BytesIO(object_data), bucket, object_key, Config=get_transfer_config(),
+                                     ExtraArgs={'ContentType': content_type})
+        else:
+            s3_client.put_object(Bucket=bucket, Key=object_key, Body=object_data, ContentType=content_type)
+    logger.info(f"Wrote {len(data) / (1024 * 1024):.2f} MB to {s3_uri} in {time.time() - start_time:.2f} seconds")
+    return s3_uri
+
+
+def read_image(path, flags=cv2.IMREAD_UNCHANGED, use_compression=False, cache=None):
+    """Read an image from S3 or a local path, S3 objects are decoded in memory without a temporary file
+
+    Returns:
+        np.ndarray: The image as read by cv2.imread, None if it can not be decoded.
+    """
+    if path.startswith('s3://'):
+        return cv2.imdecode(np.frombuffer(get_object_bytes(path, use_compression, cache), dtype=np.uint8), flags)
+    return cv2.imread(path, flags)
+
+
+def write_image(path, img, use_compression=False):
+    """Write an image to S3 or a local path, S3 objects are encoded in memory without a temporary file
+
+    The image format follows the extension of the path, as for cv2.imwrite.
+
+    Returns:
+        str: The path.
+    """
+    if path.startswith('s3://'):
+        success, buffer = cv2.imencode(os.path.splitext(path)[1] or '.png', img)
+        if not success:
+            raise ValueError(f"Failed to encode image for {path}")
+        return put_object_bytes(buffer.tobytes(), path, use_compression)
+    if not cv2.imwrite(path, img):
+        raise ValueError(f"Failed to write image to {path}")
+    return path
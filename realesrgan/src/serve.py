@@ -0,0 +1,46 @@
+"""Entrypoint of the server image: `serve` starts TorchServe with batch_handler_service, other commands are run
+by the entrypoint of the base image.
+
+TorchServe gathers concurrent /invocations requests into batches of up to SAGEMAKER_TS_BATCH_SIZE requests,
+waiting at most SAGEMAKER_TS_MAX_BATCH_DELAY milliseconds for them, and predict_fn processes each batch at once.
+SAGEMAKER_TS_BATCH_SIZE=1 serves every request on its own.
+"""
+import os
+import sys
+
+HANDLER_SERVICE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'batch_handler_service.py')
+BASE_ENTRYPOINT = '/usr/local/bin/dockerd-entrypoint.py'
+
+# TorchServe batching of the SageMaker toolkit, unless set in the environment
+BATCHING_DEFAULTS = {
+    'SAGEMAKER_TS_BATCH_SIZE': '8',
+    'SAGEMAKER_TS_MAX_BATCH_DELAY': '20',
+}
+
+
+def configure_batching(environ):
+    """Set the TorchServe batching defaults in environ
+
+    With one of the SAGEMAKER_TS_* variables set, the toolkit configures the model from all of them, so the
+    response timeout and the workers default to SAGEMAKER_MODEL_SERVER_TIMEOUT and SAGEMAKER_MODEL_SERVER_WORKERS
+    as without batching.
+    """
+    for name, value in BATCHING_DEFAULTS.items():
+        environ.setdefault(name, value)
+    environ.setdefault('SAGEMAKER_TS_RESPONSE_TIMEOUT', environ.get('SAGEMAKER_MODEL_SERVER_TIMEOUT', '60'))
+    workers = environ.get('SAGEMAKER_MODEL_SERVER_WORKERS')
+    if workers:
+        environ.setdefault('SAGEMAKER_TS_MIN_WORKERS', workers)
+        environ.setdefault('SAGEMAKER_TS_MAX_WORKERS', workers)
+
+
+def main(args):
+    if args[:1] != ['serve']:
+        os.execv(sys.executable, [sys.executable, BASE_ENTRYPOINT] + args)
+    configure_batching(os.environ)
+    from sagemaker_pytorch_serving_container import torchserve
+    torchserve.start_torchserve(handler_service=HANDLER_SERVICE)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,195 @@
+import os
+import json
+import math
+import time
+import logging
+import tempfile
+import threading
+
+import torch
+
+from compiled_models import parse_buckets
+
+logger = logging.getLogger(__name__)
+
+
+class TileCalibrator:
+    """Pick the fastest tile size and tile batch size for a RealESRGANer and persist the choice.
+
+    Configurations are calibrated per (model, device, precision, resolution bucket). The first time a combination
+    is calibrated, every candidate (tile size, tile batch size) pair is timed on random tiles and the per-frame time
+    of the bucket resolution is extrapolated from the number of tile batches the frame needs. The whole frame in a
+    single forward is a candidate too, so small buckets are only tiled where that is faster. Candidates that run out
+    of memory are skipped. The fastest configuration is stored in a small JSON table, so that other worker
+    processes and restarted containers on the same node reuse it without timing again.
+
+    Frames use the configuration of the smallest bucket they fit in, in either orientation. Calibrating takes a few
+    dozen large forwards per bucket, so it is meant to run when the server starts (warm), not in a request. The CPU
+    gets a much smaller candidate set, its forwards are slow and batching tiles does not pay off there.
+    """
+
+    DEFAULT_TILE_SIZES = (256, 384, 512, 768, 1024)
+    DEFAULT_BATCH_SIZES = (1, 2, 4)
+    DEFAULT_CPU_TILE_SIZES = (256, 512)
+    DEFAULT_CPU_BATCH_SIZES = (1, )
+
+    def __init__(self, cache_dir, tile_sizes=None, batch_sizes=None, iterations=2, buckets=None,
+                 table_name='tile_calibration.json'):
+        """Initialize the calibrator
+
+        Args:
+            cache_dir (str): Directory of the calibration table, usually MODEL_CACHE_DIR.
+            tile_sizes (tuple[int]): Candidate tile sizes, None for the defaults of the device.
+            batch_sizes (tuple[int]): Candidate numbers of tiles per forward, None for the defaults of the device.
+            iterations (int): Timed forwards per candidate after one warm-up forward.
+            buckets (list[tuple[int]]): (height, width) of the resolution buckets. Default: 480p, 720p and 1080p.
+            table_name (str): File name of the calibration table.
+        """
+        self.path = os.path.join(cache_dir, table_name)
+        self.tile_sizes = tuple(tile_sizes) if tile_sizes is not None else None
+        self.batch_sizes = tuple(batch_sizes) if batch_sizes is not None else None
+        self.iterations = iterations
+        buckets = buckets or parse_buckets('480p,720p,1080p')
+        # landscape, the tiling of a frame does not depend on its orientation
+        self.buckets = sorted({(min(bucket), max(bucket)) for bucket in buckets},
+                              key=lambda bucket: (bucket[0] * bucket[1], bucket))
+        self._lock = threading.Lock()
+        self._table = None
+
+    def get_key(self, model_name, upsampler, bucket):
+        """Key of the calibration table entry for a model, device, precision and resolution bucket"""
+        device = upsampler.device
+        if device.type == 'cuda':
+            device_name = torch.cuda.get_device_name(device).replace(' ', '_')
+        else:
+            device_name = device.type
+        precision = 'fp16' if upsampler.half else 'fp32'
+        return f"{model_name}/{device_name}/{precision}/{bucket[0]}x{bucket[1]}"
+
+    def get_bucket(self, height, width):
+        """The smallest bucket a frame of height x width fits in, in either orientation, None if it fits in none"""
+        short_side, long_side = sorted((height, width))
+        for bucket in self.buckets:
+            if bucket[0] >= short_side and bucket[1] >= long_side:
+                return bucket
+        return None
+
+    def lookup(self, model_name, upsampler, height, width):
+        """Return the (tile_size, tile_batch_size) calibrated for the bucket of a frame, tile size 0 for no tiling,
+        or None if the frame fits in no bucket or its bucket was not calibrated"""
+        bucket = self.get_bucket(height, width)
+        if bucket is None:
+            return None
+        key = self.get_key(model_name, upsampler, bucket)
+        with self._lock:
+            entry = self.load().get(key)
+        if entry is None:
+            return None
+        return entry['tile_size'], entry['tile_batch_size']
+
+    def get_tile_config(self, model_name, upsampler, bucket):
+        """Return the calibrated (tile_size, tile_batch_size) of a bucket, calibrating the combination on first use"""
+        key = self.get_key(model_name, upsampler, bucket)
+        with self._lock:
+            table = self.load()
+            entry = table.get(key)
+            if entry is None:
+                entry = self.calibrate(upsampler, *bucket)
+                self.save(key, entry)
+                logger.info(f"Calibrated tiling for {key}: tile size {entry['tile_size']}, "
+                            f"batch size {entry['tile_batch_size']}")
+        return entry['tile_size'], entry['tile_batch_size']
+
+    def warm(self, model_name, upsampler):
+        """Calibrate the buckets of a model that are not calibrated yet"""
+        for bucket in self.buckets:
+            self.get_tile_config(model_name, upsampler, bucket)
+
+    def get_search_space(self, device):
+        """Candidate tile sizes and tile batch sizes for a device"""
+        if device.type == 'cuda':
+            tile_sizes, batch_sizes = self.DEFAULT_TILE_SIZES, self.DEFAULT_BATCH_SIZES
+        else:
+            tile_sizes, batch_sizes = self.DEFAULT_CPU_TILE_SIZES, self.DEFAULT_CPU_BATCH_SIZES
+        return self.tile_sizes or tile_sizes, self.batch_sizes or batch_sizes
+
+    def get_candidates(self, tile_sizes, height, width):
+        """Candidate tile sizes for a resolution: 0 for the whole frame, and the tile sizes that split the frame"""
+        longest_side = max(height, width)
+        return [0] + [tile_size for tile_size in tile_sizes if tile_size < longest_side]
+
+    def calibrate(self, upsampler, height, width):
+        """Time every candidate configuration and return the fastest one that fits in memory"""
+        height, width = height + upsampler.pre_pad, width + upsampler.pre_pad
+        tile_sizes, batch_sizes = self.get_search_space(upsampler.device)
+        best = None
+        for tile_size in self.get_candidates(tile_sizes, height, width):
+            if tile_size == 0:
+                tile_height, tile_width, tiles = height, width, 1
+            else:
+                tile_height = min(tile_size + 2 * upsampler.tile_pad, height)
+                tile_width = min(tile_size + 2 * upsampler.tile_pad, width)
+                tiles = math.ceil(height / tile_size) * math.ceil(width / tile_size)
+            for tile_batch_size in batch_sizes:
+                if tile_batch_size > tiles:
+                    break
+                try:
+                    batch_time = self.time_forward(upsampler, tile_batch_size, tile_height, tile_width)
+                except RuntimeError as error:
+                    if 'out of memory' not in str(error):
+                        raise
+                    logger.info(f"Tile size {tile_size} with batch size {tile_batch_size} does not fit in memory")
+                    if upsampler.device.type == 'cuda':
+                        torch.cuda.empty_cache()
+                    break
+                frame_time = math.ceil(tiles / tile_batch_size) * batch_time
+                if best is None or frame_time < best['frame_time']:
+                    best = {'tile_size': tile_size, 'tile_batch_size': tile_batch_size, 'frame_time': frame_time}
+
+        if best is None:
+            raise RuntimeError(f"No tile configuration fits in memory for a {height}x{width} input")
+        return best
+
+    def time_forward(self, upsampler, tile_batch_size, tile_height, tile_width):
+        """Mean time of one forward over a batch of random tiles"""
+        dtype = torch.float16 if upsampler.half else torch.float32
+        tiles = torch.rand(tile_batch_size, 3, tile_height, tile_width, device=upsampler.device, dtype=dtype)
+        times = []
+        with torch.no_grad():
+            for i in range(self.iterations + 1):
+                if upsampler.device.type == 'cuda':
+                    torch.cuda.synchronize(upsampler.device)
+                start_time = time.perf_counter()
+                upsampler.model(tiles)
+                if upsampler.device.type == 'cuda':
+                    torch.cuda.synchronize(upsampler.device)
+                if i > 0:  # the first forward is a warm-up
+                    times.append(time.perf_counter() - start_time)
+        return sum(times) / len(times)
+
+    def load(self):
+        """Read the calibration table from disk once, an unreadable table is treated as empty"""
+        if self._table is None:
+            try:
+                with open(self.path) as f:
+                    self._table = json.load(f)
+            except FileNotFoundError:
+                self._table = {}
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable tile calibration table {self.path}: {e}")
+                self._table = {}
+        return self._table
+
+    def save(self, key, entry):
+        """Add an entry and atomically replace the table on disk, keeping entries written by other processes"""
+        self._table = None
+        table = self.load()
+        table[key] = entry
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(table, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Failed to persist tile calibration table {self.path}: {e}")
@@ -0,0 +1,92 @@
+import unittest
+import os
+from unittest.mock import MagicMock, patch
+
+import torch
+import torch.nn.functional as F
+
+# Add the src directory to the path so we can import the compiled_models module
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import patch_torchvision  # noqa: F401
+from basicsr.archs.rrdbnet_arch import RRDBNet
+from compiled_models import CompiledModelCache, parse_buckets
+
+
+def create_model():
+    """Create a small randomly initialized RRDBNet"""
+    torch.manual_seed(0)
+    return RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=8, num_block=1, num_grow_ch=4, scale=4).eval()
+
+
+class TestCompiledModelCache(unittest.TestCase):
+    """Test cases for the shape-bucketed compiled model cache"""
+
+    def test_parse_buckets(self):
+        """Test that buckets are parsed from resolution names and sizes"""
+        self.assertEqual(parse_buckets('480p, 1080P,512x256,'), [(480, 854), (1080, 1920), (512, 256)])
+
+    def test_bucket_selection(self):
+        """Test that inputs go to the smallest fitting bucket, rounded up to the pad multiple"""
+        model = CompiledModelCache(create_model(), buckets=parse_buckets('480p,720p'), pad_multiple=8)
+        self.assertEqual(model.get_bucket(480, 854), (480, 856))
+        self.assertEqual(model.get_bucket(470, 850), (480, 856))
+        self.assertEqual(model.get_bucket(650, 1000), (720, 1280))
+        # portrait frames use the transposed buckets
+        self.assertEqual(model.get_bucket(850, 470), (856, 480))
+        # too small or too large for the buckets
+        self.assertIsNone(model.get_bucket(240, 427))
+        self.assertIsNone(model.get_bucket(1080, 1920))
+
+    def test_one_graph_per_bucket(self):
+        """Test that frames of different sizes in one bucket share a traced graph and match the eager model"""
+        network = create_model()
+        model = CompiledModelCache(network, buckets=[(24, 40)], backend='trace')
+        self.assertEqual(model.scale, 4)
+        with torch.no_grad(), patch('torch.jit.trace', wraps=torch.jit.trace) as mock_trace:
+            for height, width in [(24, 40), (22, 37), (20, 36)]:
+                img = torch.rand(2, 3, height, width)
+                output = model(img)
+                self.assertEqual(output.shape, (2, 3, height * 4, width * 4))
+                expected = network(F.pad(img, (0, 40 - width, 0, 24 - height), mode='reflect'))
+                torch.testing.assert_close(output, expected[..., :height * 4, :width * 4])
+            self.assertEqual(mock_trace.call_count, 1)
+
+            # a new batch size compiles a new graph, sizes outside the buckets run eagerly
+            model(torch.rand(1, 3, 24, 40))
+            img = torch.rand(1, 3, 8, 8)
+            torch.testing.assert_close(model(img), network(img))
+            self.assertEqual(mock_trace.call_count, 2)
+
+    def test_warm_and_graph_limit(self):
+        """Test that warm compiles the landscape buckets and the least recently used graphs are dropped"""
+        model = CompiledModelCache(create_model(), buckets=[(8, 16), (16, 24), (24, 32)], backend='trace',
+                                   max_graphs=2)
+        model.warm(batch_size=lambda height, width: height // 8)
+        self.assertEqual(list(model._graphs), [((2, 3, 16, 24), torch.float32, 'cpu'),
+                                               ((3, 3, 24, 32), torch.float32, 'cpu')])
+
+        eager = CompiledModelCache(create_model(), backend='none')
+        eager.warm()
+        self.assertEqual(len(eager._graphs), 0)
+
+
+    def test_compile_graphs_are_cached_by_dynamo(self):
+        """Test that the model is wrapped by torch.compile once for all buckets, which leaves its graphs to dynamo"""
+        network = create_model()
+        with patch('torch.compile', return_value=MagicMock(wraps=network)) as mock_compile, \
+                torch._dynamo.config.patch(cache_size_limit=8):
+            model = CompiledModelCache(network, buckets=[(8, 16), (16, 24)], backend='compile', max_graphs=32)
+            self.assertEqual(torch._dynamo.config.cache_size_limit, 32)
+        compiled = mock_compile.return_value
+        with torch.no_grad():
+            model.warm(batch_size=2)
+            model(torch.rand(2, 3, 16, 24))
+        mock_compile.assert_called_once_with(network, dynamic=False)
+        # one run per warmed bucket and one for the frame, the cache keeps no graphs of its own
+        self.assertEqual(compiled.call_count, 3)
+        self.assertEqual(len(model._graphs), 0)
+        self.assertIs(model.get_graph(torch.rand(2, 3, 8, 16)), compiled)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+import os
+import tempfile
+import boto3
+from unittest.mock import patch
+from moto import mock_aws
+
+# Add the src directory to the path so we can import the image_cache module
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import s3_transport
+from image_cache import PARTIAL_PREFIX, ImageCache
+
+
+class TestImageCache(unittest.TestCase):
+    """Test cases for the content-addressed disk cache of S3 inputs"""
+
+    def setUp(self):
+        self.cache_dir = os.path.join(tempfile.mkdtemp(), 's3')
+
+    def test_entries_are_addressed_by_key_and_etag(self):
+        """Test that objects with the same file name in different jobs and overwritten objects never collide"""
+        cache = ImageCache(self.cache_dir, 100)
+        cache.put('s3://frames/job_1/frame_0001.png', '"aaa"', b'job 1')
+        cache.put('s3://frames/job_2/frame_0001.png', '"bbb"', b'job 2')
+        self.assertEqual(cache.get('s3://frames/job_1/frame_0001.png', '"aaa"'), b'job 1')
+        self.assertEqual(cache.get('s3://frames/job_2/frame_0001.png', 'bbb'), b'job 2')
+        self.assertEqual(cache.get_etag('s3://frames/job_1/frame_0001.png'), 'aaa')
+        # an object overwritten in S3 replaces its entry
+        self.assertIsNone(cache.get('s3://frames/job_1/frame_0001.png', '"ccc"'))
+        cache.put('s3://frames/job_1/frame_0001.png', '"ccc"', b'job 1 again')
+        self.assertEqual(cache.get('s3://frames/job_1/frame_0001.png', 'ccc'), b'job 1 again')
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 3, 'evictions': 0, 'size': 2, 'bytes': 16,
+                                         'max_bytes': 100})
+
+    def test_least_recently_used_entries_are_evicted(self):
+        """Test that the entries stay within the byte budget, dropping the least recently used ones"""
+        cache = ImageCache(self.cache_dir, 25)
+        for i in range(3):
+            cache.put(f's3://frames/frame_{i}.png', f'etag{i}', bytes(10))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertIsNone(cache.get_etag('s3://frames/frame_0.png'))
+
+        cache.get('s3://frames/frame_1.png', 'etag1')
+        cache.put('s3://frames/frame_3.png', 'etag3', bytes(10))
+        self.assertEqual(cache.get_etag('s3://frames/frame_1.png'), 'etag1')
+        self.assertIsNone(cache.get_etag('s3://frames/frame_2.png'))
+        # objects larger than the budget are not cached
+        cache.put('s3://frames/large.png', 'etag', bytes(30))
+        self.assertIsNone(cache.get_etag('s3://frames/large.png'))
+        self.assertEqual(sum(os.path.getsize(entry.path) for entry in os.scandir(self.cache_dir)), 20)
+
+    def test_entries_survive_a_restart(self):
+        """Test that a new cache picks up the complete entries and deletes interrupted writes"""
+        cache = ImageCache(self.cache_dir, 100)
+        cache.put('s3://frames/frame_0.png', 'etag0', b'frame 0')
+        with open(os.path.join(self.cache_dir, f'{PARTIAL_PREFIX}interrupted'), 'wb') as f:
+            f.write(b'frame')
+
+        cache = ImageCache(self.cache_dir, 100)
+        self.assertEqual(cache.get('s3://frames/frame_0.png', 'etag0'), b'frame 0')
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(cache.get_path(
+            cache.get_name('s3://frames/frame_0.png'), 'etag0'))])
+
+    @mock_aws
+    def test_cached_objects_are_revalidated(self):
+        """Test that a cached object is read from disk while its ETag is current and downloaded when it changes"""
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+        s3_transport._s3_client = None
+        self.addCleanup(setattr, s3_transport, '_s3_client', None)
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='frames')
+        s3.put_object(Bucket='frames', Key='frame.png', Body=b'frame')
+
+        cache = ImageCache(self.cache_dir, 100)
+        for _ in range(3):
+            self.assertEqual(s3_transport.get_object_bytes('s3://frames/frame.png', cache=cache), b'frame')
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+        s3.put_object(Bucket='frames', Key='frame.png', Body=b'new frame')
+        self.assertEqual(s3_transport.get_object_bytes('s3://frames/frame.png', cache=cache), b'new frame')
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        # an entry deleted between the lookup and the read is downloaded again
+        with patch.object(cache, 'get', return_value=None):
+            self.assertEqual(s3_transport.get_object_bytes('s3://frames/frame.png', cache=cache), b'new frame')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+# Packages that must only be imported once a request needs a model
+LAZY_PACKAGES = ('basicsr', 'gfpgan', 'facexlib', 'realesrgan', 'patch_torchvision', 'torchvision')
+
+
+def import_time_report(module):
+    """Import a module in a fresh interpreter with -X importtime.
+
+    Returns:
+        dict: Cumulative import time in microseconds of every imported module.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=SRC_DIR,
+                            capture_output=True, text=True, check=True)
+    report = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        report[name.strip()] = int(cumulative)
+    return report
+
+
+class TestImportTime(unittest.TestCase):
+    """Test that importing the inference module stays cheap"""
+
+    def test_heavy_packages_are_imported_lazily(self):
+        """Test that basicsr, gfpgan/facexlib and realesrgan are not imported with the inference module"""
+        report = import_time_report('inference')
+        self.assertIn('inference', report)
+
+        eager = sorted(name for name in report if name.split('.')[0] in LAZY_PACKAGES)
+        slowest = sorted(report.items(), key=lambda item: item[1], reverse=True)[:10]
+        self.assertEqual(eager, [], f'imported with inference: {eager}, slowest imports (cumulative us): {slowest}')
+
+    def test_lazy_model_classes_resolve(self):
+        """Test that the lazily imported model classes resolve on first access"""
+        sys.path.insert(0, SRC_DIR)
+        import inference
+
+        self.assertEqual(inference.lazy_import('SRVGGNetCompact').__name__, 'SRVGGNetCompact')
+        self.assertEqual(inference.RRDBNet.__name__, 'RRDBNet')
+        with self.assertRaises(AttributeError):
+            inference.NotAModel
+
+
+if __name__ == '__main__':
+    unittest.main()
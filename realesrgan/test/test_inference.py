@@ -4,16 +4,21 @@ import os
 import numpy as np
 import cv2
 import torch
-from unittest.mock import patch, MagicMock, mock_open
+from unittest.mock import patch, MagicMock, mock_open, ANY
 
 # Add the src directory to the path so we can import the inference module
 import sys
 sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
 import inference
+import s3_transport
 
 class TestInference(unittest.TestCase):
     """Test cases for the inference.py module"""
 
+    def setUp(self):
+        # the shared S3 client is created by the boto3.client mock of each test
+        s3_transport._s3_client = None
+
     @patch('inference.torch.cuda.is_available')
     def test_device_selection(self, mock_cuda_available):
         """Test device selection based on CUDA availability"""
@@ -29,77 +34,13 @@ class TestInference(unittest.TestCase):
             importlib.reload(inference)
             self.assertEqual(inference.device, torch.device('cpu'))
 
-    @patch('inference.boto3.client')
-    @patch('inference.os.path.exists')
-    def test_download_from_s3_cached(self, mock_exists, mock_boto3_client):
-        """Test download_from_s3 when file is already cached"""
-        # Setup mocks
-        mock_exists.return_value = True
-        local_path = '/tmp/test_file.png'
-        s3_uri = 's3://test-bucket/test_file.png'
-        
-        # Call the function
-        result = inference.download_from_s3(s3_uri, local_path)
-        
-        # Verify the result
-        self.assertEqual(result, local_path)
-        
-        # Verify S3 client was not called
-        mock_boto3_client.assert_not_called()
-
-    @patch('inference.boto3.client')
-    @patch('inference.os.path.exists')
-    @patch('inference.os.makedirs')
-    def test_download_from_s3_not_cached(self, mock_makedirs, mock_exists, mock_boto3_client):
-        """Test download_from_s3 when file is not cached"""
-        # Setup mocks
-        mock_exists.return_value = False
-        mock_s3 = MagicMock()
-        mock_boto3_client.return_value = mock_s3
-        
-        local_path = '/tmp/test_file.png'
-        s3_uri = 's3://test-bucket/test_file.png'
-        
-        # Call the function
-        result = inference.download_from_s3(s3_uri, local_path)
-        
-        # Verify the result
-        self.assertEqual(result, local_path)
-        
-        # Verify S3 client was called correctly
-        mock_boto3_client.assert_called_once()
-        mock_s3.download_file.assert_called_once_with('test-bucket', 'test_file.png', local_path)
-
-    @patch('inference.boto3.client')
-    def test_upload_to_s3(self, mock_boto3_client):
-        """Test upload_to_s3 function"""
-        # Setup mocks
-        mock_s3 = MagicMock()
-        mock_boto3_client.return_value = mock_s3
-        
-        local_path = '/tmp/test_file.png'
-        s3_uri = 's3://test-bucket/test_file.png'
-        
-        # Call the function
-        result = inference.upload_to_s3(local_path, s3_uri)
-        
-        # Verify the result
-        self.assertEqual(result, s3_uri)
-        
-        # Verify S3 client was called correctly
-        mock_boto3_client.assert_called_once()
-        mock_s3.upload_file.assert_called_once_with(local_path, 'test-bucket', 'test_file.png')
-
-    @patch('inference.cv2.imread')
-    @patch('inference.download_from_s3')
-    @patch('inference.upload_to_s3')
-    @patch('inference.cv2.imwrite')
-    def test_process_single_image(self, mock_imwrite, mock_upload, mock_download, mock_imread):
+    @patch('inference.read_image')
+    @patch('inference.write_image')
+    def test_process_single_image(self, mock_write_image, mock_read_image):
         """Test process_single_image function"""
         # Setup mocks
-        mock_download.return_value = '/tmp/test_file.png'
-        mock_imread.return_value = np.zeros((64, 64, 3), dtype=np.uint8)  # Create a dummy image
-        mock_upload.return_value = 's3://test-bucket/output.png'
+        mock_read_image.return_value = np.zeros((64, 64, 3), dtype=np.uint8)  # Create a dummy image
+        mock_write_image.return_value = 's3://test-bucket/output.png'
         
         # Create a mock model
         mock_upsampler = MagicMock()
@@ -129,20 +70,22 @@ class TestInference(unittest.TestCase):
         self.assertEqual(result['batch_id'], 'test-batch')
         
         # Verify mocks were called correctly
-        mock_download.assert_called_once_with('s3://test-bucket/test_file.png', '/tmp/test_file.png')
-        mock_imread.assert_called_once_with('/tmp/test_file.png', cv2.IMREAD_UNCHANGED)
+        mock_read_image.assert_called_once_with('s3://test-bucket/test_file.png', cv2.IMREAD_UNCHANGED, False,
+                                                inference.image_cache)
         mock_upsampler.enhance.assert_called_once()
-        mock_imwrite.assert_called_once()
-        mock_upload.assert_called_once()
+        mock_write_image.assert_called_once()
 
-    @patch('inference.process_single_image')
-    def test_process_batch(self, mock_process_single):
+    @patch('inference.write_frame')
+    @patch('inference.upscale_frame')
+    @patch('inference.read_frame')
+    def test_process_batch(self, mock_read_frame, mock_upscale_frame, mock_write_frame):
         """Test process_batch function"""
         # Setup mocks
-        mock_process_single.side_effect = [
-            {'status': 200, 'output_file_path': 's3://test-bucket/output1.png', 'job_id': 'test-job', 'batch_id': '1'},
-            {'status': 200, 'output_file_path': 's3://test-bucket/output2.png', 'job_id': 'test-job', 'batch_id': '2'}
-        ]
+        mock_read_frame.side_effect = lambda item: (item, np.zeros((4, 4, 3), dtype=np.uint8))
+        mock_upscale_frame.side_effect = lambda frame, model: (frame[0], frame[1], None)
+        mock_write_frame.side_effect = lambda frame: {
+            'status': 200, 'output_file_path': frame[0]['output_file_path'], 'job_id': frame[0]['job_id'],
+            'batch_id': frame[0]['batch_id']}
         
         # Create input data
         batch_data = {
@@ -168,9 +111,15 @@ class TestInference(unittest.TestCase):
         self.assertEqual(result['job_id'], 'test-job')
         self.assertEqual(result['total_processed'], 2)
         self.assertEqual(len(result['batch_results']), 2)
-        
-        # Verify process_single_image was called correctly
-        self.assertEqual(mock_process_single.call_count, 2)
+        self.assertEqual([r['output_file_path'] for r in result['batch_results']],
+                         ['s3://test-bucket/output1.png', 's3://test-bucket/output2.png'])
+        self.assertEqual(set(result['stage_utilization']), {'read', 'inference', 'write'})
+        
+        # Verify every item went through each stage
+        self.assertEqual(mock_read_frame.call_count, 2)
+        self.assertEqual(mock_upscale_frame.call_count, 2)
+        self.assertEqual(mock_write_frame.call_count, 2)
+        mock_upscale_frame.assert_called_with(ANY, mock_model)
 
     @patch('inference.torch.cuda.get_device_properties')
     @patch('inference.torch.cuda.memory_reserved')
@@ -16,188 +16,14 @@ sys.path.append(src_path)
 sys.path.insert(0, src_path)
 import patch_torchvision
 import inference
+import s3_transport
 
 class TestInferenceExtended(unittest.TestCase):
     """Extended test cases for the inference.py module"""
 
-    @patch('inference.boto3.client')
-    @patch('inference.os.path.exists')
-    @patch('inference.os.makedirs')
-    def test_download_from_s3_with_compression(self, mock_makedirs, mock_exists, mock_boto3_client):
-        """Test download_from_s3 with compression enabled"""
-        # Setup mocks
-        mock_exists.return_value = False
-        mock_s3 = MagicMock()
-        mock_boto3_client.return_value = mock_s3
-
-        # Mock head_object to indicate compressed file exists
-        mock_s3.head_object.return_value = {}
-
-        # Mock get_object for compressed file
-        mock_s3_obj = {'Body': MagicMock()}
-        mock_s3.get_object.return_value = mock_s3_obj
-
-        # Setup test parameters
-        local_path = '/tmp/test_file.png'
-        s3_uri = 's3://test-bucket/test_file.png'
-
-        # Enable compression
-        with patch.dict(os.environ, {'USE_COMPRESSION': 'true'}):
-            # Reload the module to apply the environment variable
-            import importlib
-            importlib.reload(inference)
-
-            # Mock gzip file object
-            mock_gzip_file = MagicMock()
-            mock_gzip_file.read.return_value = b'test data'
-
-            # Patch gzip.GzipFile to return our mock
-            with patch('inference.gzip.GzipFile', return_value=mock_gzip_file):
-                # Call the function
-                result = inference.download_from_s3(s3_uri, local_path)
-
-                # Verify the result
-                self.assertEqual(result, local_path)
-
-                # Verify S3 client was called correctly
-                mock_boto3_client.assert_called_once()
-                mock_s3.head_object.assert_called_once_with(Bucket='test-bucket', Key='test_file.png.gz')
-                mock_s3.get_object.assert_called_once_with(Bucket='test-bucket', Key='test_file.png.gz')
-
-    @patch('inference.boto3.client')
-    @patch('inference.os.path.exists')
-    @patch('inference.os.makedirs')
-    @patch('inference.boto3.s3.transfer.TransferConfig')
-    def test_download_from_s3_with_multipart(self, mock_transfer_config, mock_makedirs, mock_exists, mock_boto3_client):
-        """Test download_from_s3 with multipart download"""
-        # Setup mocks
-        mock_exists.return_value = False
-        mock_s3 = MagicMock()
-        mock_boto3_client.return_value = mock_s3
-
-        # Mock head_object to return a large file size
-        mock_s3.head_object.return_value = {'ContentLength': inference.MULTIPART_THRESHOLD + 1}
-
-        # Setup test parameters
-        local_path = '/tmp/test_file.png'
-        s3_uri = 's3://test-bucket/test_file.png'
-
-        # Disable compression
-        with patch.dict(os.environ, {'USE_COMPRESSION': 'false'}):
-            # Reload the module to apply the environment variable
-            import importlib
-            importlib.reload(inference)
-
-            # Call the function
-            result = inference.download_from_s3(s3_uri, local_path)
-
-            # Verify the result
-            self.assertEqual(result, local_path)
-
-            # Verify S3 client was called correctly
-            mock_boto3_client.assert_called_once()
-            mock_s3.head_object.assert_called_once_with(Bucket='test-bucket', Key='test_file.png')
-            mock_transfer_config.assert_called_once()
-            mock_s3.download_file.assert_called_once_with(
-                'test-bucket', 'test_file.png', local_path,
-                Config=mock_transfer_config.return_value
-            )
-
-    @patch('inference.boto3.client')
-    @patch('inference.os.path.exists')
-    def test_download_from_s3_error_handling(self, mock_exists, mock_boto3_client):
-        """Test download_from_s3 error handling"""
-        # Setup mocks
-        mock_exists.return_value = False
-        mock_s3 = MagicMock()
-        mock_boto3_client.return_value = mock_s3
-
-        # Mock head_object to raise an error
-        mock_s3.head_object.side_effect = boto3.exceptions.ClientError(
-            {'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'}},
-            'HeadObject'
-        )
-
-        # Setup test parameters
-        local_path = '/tmp/test_file.png'
-        s3_uri = 's3://test-bucket/test_file.png'
-
-        # Call the function and expect an exception
-        with self.assertRaises(boto3.exceptions.ClientError):
-            inference.download_from_s3(s3_uri, local_path)
-
-    @patch('inference.boto3.client')
-    @patch('inference.os.path.getsize')
-    @patch('inference.gzip.open')
-    @patch('inference.open', new_callable=mock_open, read_data=b'test data')
-    def test_upload_to_s3_with_compression(self, mock_file_open, mock_gzip_open, mock_getsize, mock_boto3_client):
-        """Test upload_to_s3 with compression enabled"""
-        # Setup mocks
-        mock_s3 = MagicMock()
-        mock_boto3_client.return_value = mock_s3
-        mock_getsize.return_value = 1024  # Small file size
-
-        # Setup test parameters
-        local_path = '/tmp/test_file.png'
-        s3_uri = 's3://test-bucket/test_file.png'
-
-        # Enable compression
-        with patch.dict(os.environ, {'USE_COMPRESSION': 'true'}):
-            # Reload the module to apply the environment variable
-            import importlib
-            importlib.reload(inference)
-
-            # Mock os.remove to avoid actual file deletion
-            with patch('inference.os.remove'):
-                # Call the function
-                result = inference.upload_to_s3(local_path, s3_uri)
-
-                # Verify the result
-                self.assertEqual(result, s3_uri)
-
-                # Verify S3 client was called correctly
-                mock_boto3_client.assert_called_once()
-                mock_file_open.assert_called_once_with(local_path, 'rb')
-                mock_gzip_open.assert_called_once_with(f"{local_path}.gz", 'wb')
-
-                # Should upload both compressed and original files
-                self.assertEqual(mock_s3.upload_file.call_count, 2)
-                mock_s3.upload_file.assert_any_call(f"{local_path}.gz", 'test-bucket', 'test_file.png.gz')
-                mock_s3.upload_file.assert_any_call(local_path, 'test-bucket', 'test_file.png')
-
-    @patch('inference.boto3.client')
-    @patch('inference.os.path.getsize')
-    @patch('inference.boto3.s3.transfer.TransferConfig')
-    def test_upload_to_s3_with_multipart(self, mock_transfer_config, mock_getsize, mock_boto3_client):
-        """Test upload_to_s3 with multipart upload"""
-        # Setup mocks
-        mock_s3 = MagicMock()
-        mock_boto3_client.return_value = mock_s3
-        mock_getsize.return_value = inference.MULTIPART_THRESHOLD + 1  # Large file size
-
-        # Setup test parameters
-        local_path = '/tmp/test_file.png'
-        s3_uri = 's3://test-bucket/test_file.png'
-
-        # Disable compression
-        with patch.dict(os.environ, {'USE_COMPRESSION': 'false'}):
-            # Reload the module to apply the environment variable
-            import importlib
-            importlib.reload(inference)
-
-            # Call the function
-            result = inference.upload_to_s3(local_path, s3_uri)
-
-            # Verify the result
-            self.assertEqual(result, s3_uri)
-
-            # Verify S3 client was called correctly
-            mock_boto3_client.assert_called_once()
-            mock_transfer_config.assert_called_once()
-            mock_s3.upload_file.assert_called_once_with(
-                local_path, 'test-bucket', 'test_file.png',
-                Config=mock_transfer_config.return_value
-            )
+    def setUp(self):
+        # the shared S3 client is created by the boto3.client mock of each test
+        s3_transport._s3_client = None
 
     @patch('inference.process_batch')
     @patch('inference.process_single_image')
@@ -279,15 +105,12 @@ class TestInferenceExtended(unittest.TestCase):
         mock_process_batch.assert_called_once_with(input_data, mock_model)
         mock_process_single.assert_not_called()
 
-    @patch('inference.cv2.imread')
-    @patch('inference.download_from_s3')
-    @patch('inference.upload_to_s3')
-    @patch('inference.cv2.imwrite')
-    def test_process_single_image_error_handling(self, mock_imwrite, mock_upload, mock_download, mock_imread):
+    @patch('inference.read_image')
+    @patch('inference.write_image')
+    def test_process_single_image_error_handling(self, mock_write_image, mock_read_image):
         """Test process_single_image error handling"""
         # Setup mocks to simulate an error during image reading
-        mock_download.return_value = '/tmp/test_file.png'
-        mock_imread.return_value = None  # Simulate failure to read image
+        mock_read_image.return_value = None  # Simulate failure to read image
 
         # Create a mock model
         mock_model = {
@@ -314,21 +137,16 @@ class TestInferenceExtended(unittest.TestCase):
         self.assertEqual(result['batch_id'], 'test-batch')
 
         # Verify mocks were called correctly
-        mock_download.assert_called_once()
-        mock_imread.assert_called_once()
-        mock_imwrite.assert_not_called()
-        mock_upload.assert_not_called()
-
-    @patch('inference.cv2.imread')
-    @patch('inference.download_from_s3')
-    @patch('inference.upload_to_s3')
-    @patch('inference.cv2.imwrite')
-    def test_process_single_image_with_face_enhancement(self, mock_imwrite, mock_upload, mock_download, mock_imread):
+        mock_read_image.assert_called_once()
+        mock_write_image.assert_not_called()
+
+    @patch('inference.read_image')
+    @patch('inference.write_image')
+    def test_process_single_image_with_face_enhancement(self, mock_write_image, mock_read_image):
         """Test process_single_image with face enhancement"""
         # Setup mocks
-        mock_download.return_value = '/tmp/test_file.png'
-        mock_imread.return_value = np.zeros((64, 64, 3), dtype=np.uint8)  # Create a dummy image
-        mock_upload.return_value = 's3://test-bucket/output.png'
+        mock_read_image.return_value = np.zeros((64, 64, 3), dtype=np.uint8)  # Create a dummy image
+        mock_write_image.return_value = 's3://test-bucket/output.png'
 
         # Create a mock face enhancer
         mock_face_enhancer = MagicMock()
@@ -361,21 +179,16 @@ class TestInferenceExtended(unittest.TestCase):
         mock_face_enhancer.enhance.assert_called_once_with(ANY, has_aligned=False, only_center_face=False, paste_back=True)
 
         # Verify other mocks were called correctly
-        mock_download.assert_called_once()
-        mock_imread.assert_called_once()
-        mock_imwrite.assert_called_once()
-        mock_upload.assert_called_once()
-
-    @patch('inference.cv2.imread')
-    @patch('inference.download_from_s3')
-    @patch('inference.upload_to_s3')
-    @patch('inference.cv2.imwrite')
-    def test_process_single_image_with_anime_model(self, mock_imwrite, mock_upload, mock_download, mock_imread):
+        mock_read_image.assert_called_once()
+        mock_write_image.assert_called_once_with('s3://test-bucket/output.png', ANY, False)
+
+    @patch('inference.read_image')
+    @patch('inference.write_image')
+    def test_process_single_image_with_anime_model(self, mock_write_image, mock_read_image):
         """Test process_single_image with anime model"""
         # Setup mocks
-        mock_download.return_value = '/tmp/test_file.png'
-        mock_imread.return_value = np.zeros((64, 64, 3), dtype=np.uint8)  # Create a dummy image
-        mock_upload.return_value = 's3://test-bucket/output.png'
+        mock_read_image.return_value = np.zeros((64, 64, 3), dtype=np.uint8)  # Create a dummy image
+        mock_write_image.return_value = 's3://test-bucket/output.png'
 
         # Create mock upsamplers
         mock_anime_upsampler = MagicMock()
@@ -408,10 +221,8 @@ class TestInferenceExtended(unittest.TestCase):
         mock_anime_upsampler.enhance.assert_called_once()
 
         # Verify other mocks were called correctly
-        mock_download.assert_called_once()
-        mock_imread.assert_called_once()
-        mock_imwrite.assert_called_once()
-        mock_upload.assert_called_once()
+        mock_read_image.assert_called_once()
+        mock_write_image.assert_called_once_with('s3://test-bucket/output.png', ANY, False)
 
 if __name__ == '__main__':
     unittest.main()
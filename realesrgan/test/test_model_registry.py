@@ -0,0 +1,93 @@
+import unittest
+import os
+from unittest.mock import MagicMock
+
+import torch
+
+# Add the src directory to the path so we can import the model_registry module
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from model_registry import ModelRegistry
+
+
+class Upsampler:
+    """Stand-in for RealESRGANer, a wrapper holding a network"""
+
+    def __init__(self, num_params):
+        self.model = torch.nn.Linear(num_params, 1, bias=False)
+
+
+class FaceEnhancer:
+    """Stand-in for GFPGANer, holding its own network and the background upsampler"""
+
+    def __init__(self, bg_upsampler):
+        self.gfpgan = torch.nn.Linear(10, 1, bias=False)
+        self.bg_upsampler = bg_upsampler
+
+
+class TestModelRegistry(unittest.TestCase):
+    """Test cases for the lazy model registry"""
+
+    def create_registry(self, memory_budget=None):
+        registry = ModelRegistry(memory_budget=memory_budget)
+        self.loaders = {
+            'realesr_gan': MagicMock(side_effect=lambda: Upsampler(100)),
+            'realesr_gan_anime': MagicMock(side_effect=lambda: Upsampler(50)),
+            'face_enhancer': MagicMock(side_effect=FaceEnhancer),
+        }
+        registry.register('realesr_gan', self.loaders['realesr_gan'])
+        registry.register('realesr_gan_anime', self.loaders['realesr_gan_anime'])
+        registry.register('face_enhancer', self.loaders['face_enhancer'], dependencies=('realesr_gan', ))
+        return registry
+
+    def test_models_load_on_first_use(self):
+        """Test that models are loaded on first lookup only"""
+        registry = self.create_registry()
+        self.assertEqual(sorted(registry), ['face_enhancer', 'realesr_gan', 'realesr_gan_anime'])
+        self.assertEqual(registry.loaded, [])
+
+        anime = registry['realesr_gan_anime']
+        self.assertIs(registry['realesr_gan_anime'], anime)
+        self.assertEqual(registry.loaded, ['realesr_gan_anime'])
+        self.loaders['realesr_gan_anime'].assert_called_once_with()
+        self.loaders['realesr_gan'].assert_not_called()
+        self.assertIsNone(registry.get('unknown'))
+
+    def test_face_enhancer_shares_background_upsampler(self):
+        """Test that the face enhancer gets the registered standard upsampler"""
+        registry = self.create_registry()
+        face_enhancer = registry['face_enhancer']
+
+        self.assertIs(face_enhancer.bg_upsampler, registry['realesr_gan'])
+        self.loaders['realesr_gan'].assert_called_once_with()
+        # the shared upsampler is only accounted to the standard model
+        self.assertEqual(registry.get_memory_usage(), {'realesr_gan': 400, 'face_enhancer': 40})
+
+    def test_least_recently_used_models_are_evicted(self):
+        """Test that the least recently used model is evicted once the budget is exceeded"""
+        registry = self.create_registry(memory_budget=620)
+        registry['realesr_gan_anime']
+        registry['realesr_gan']
+        self.assertEqual(registry.loaded, ['realesr_gan_anime', 'realesr_gan'])
+
+        registry['realesr_gan_anime']
+        registry['face_enhancer']
+        self.assertEqual(registry.loaded, ['realesr_gan', 'face_enhancer'])
+        self.assertEqual(registry.memory_used, 440)
+
+        # the standard model is pinned by the loaded face enhancer
+        registry['realesr_gan_anime']
+        self.assertEqual(registry.loaded, ['realesr_gan', 'realesr_gan_anime'])
+        self.assertEqual(self.loaders['realesr_gan_anime'].call_count, 2)
+
+    def test_model_size_counts_shared_tensors_once(self):
+        """Test that the model size sums the parameters and buffers of the wrapped modules"""
+        upsampler = Upsampler(100)
+        upsampler.copy = upsampler.model
+        upsampler.model.register_buffer('running', torch.zeros(10, dtype=torch.float16))
+        self.assertEqual(ModelRegistry.get_model_size(upsampler), 100 * 4 + 10 * 2)
+        self.assertEqual(ModelRegistry.get_model_size(FaceEnhancer(upsampler), exclude=[upsampler]), 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import unittest
+import os
+import time
+import threading
+import tempfile
+import numpy as np
+import cv2
+from unittest.mock import patch
+
+# Add the src directory to the path so we can import the pipeline module
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import inference
+from pipeline import StagePipeline
+from test_realesrganer import create_upsampler
+
+
+class TestStagePipeline(unittest.TestCase):
+    """Test cases for the bounded-queue pipeline of batch requests"""
+
+    def test_results_keep_item_order(self):
+        """Test that items go through every stage and their results keep the order of the items"""
+        pipeline = StagePipeline([
+            ('double', lambda item: item * 2, 3),
+            ('increment', lambda value: value + 1, 2),
+            ('finish', lambda value: {'status': 200, 'value': value}, 3),
+        ], queue_size=2)
+        results, stats = pipeline.run(range(20))
+
+        self.assertEqual([result['value'] for result in results], [2 * i + 1 for i in range(20)])
+        self.assertEqual(stats['items'], 20)
+        self.assertEqual([stage['items'] for stage in stats['stages'].values()], [20, 20, 20])
+        self.assertEqual(stats['stages']['increment']['workers'], 2)
+
+    def test_dict_and_errors_finish_an_item(self):
+        """Test that a dict returned or an exception raised by a stage skips the remaining stages"""
+        def read(item):
+            if item == 1:
+                return {'status': 500, 'error': 'missing'}
+            if item == 2:
+                raise ValueError('broken')
+            return item
+
+        finished = []
+        pipeline = StagePipeline([
+            ('read', read, 2),
+            ('write', lambda value: finished.append(value) or {'status': 200}, 1),
+        ], on_error=lambda item, error: {'status': 500, 'error': str(error), 'item': item})
+        results, stats = pipeline.run(range(4))
+
+        self.assertEqual(results, [{'status': 200}, {'status': 500, 'error': 'missing'},
+                                   {'status': 500, 'error': 'broken', 'item': 2}, {'status': 200}])
+        self.assertEqual(sorted(finished), [0, 3])
+        self.assertEqual(stats['stages']['write']['items'], 2)
+
+    def test_failing_error_handler_finishes_the_item(self):
+        """Test that an exception raised by on_error finishes the item instead of stopping the worker"""
+        def read(item):
+            if item % 2:
+                raise ValueError('broken')
+            return item
+
+        def on_error(item, error):
+            raise KeyError('job_id')
+
+        pipeline = StagePipeline([('read', read, 1), ('write', lambda value: {'status': 200}, 1)],
+                                 queue_size=1, on_error=on_error)
+        with self.assertLogs('pipeline', level='ERROR') as logs:
+            results, stats = pipeline.run(range(6))
+
+        self.assertEqual(results, [{'status': 200}, {'status': 500, 'error': 'broken'}] * 3)
+        self.assertEqual(stats['stages']['write']['items'], 3)
+        self.assertTrue(any('Error handler' in message for message in logs.output))
+
+    def test_queues_are_bounded(self):
+        """Test that a slow stage holds back the stage in front of it by at most the queue size"""
+        lock = threading.Lock()
+        read = []
+        written = []
+
+        def read_item(item):
+            with lock:
+                # items read but not yet written: one per queue slot, the write worker and the read worker
+                self.assertLessEqual(len(read) - len(written), 2 + 1 + 1)
+                read.append(item)
+            return item
+
+        def write_item(value):
+            time.sleep(0.005)
+            with lock:
+                written.append(value)
+            return {'status': 200}
+
+        pipeline = StagePipeline([('read', read_item, 1), ('write', write_item, 1)], queue_size=2)
+        results, stats = pipeline.run(range(20))
+
+        self.assertEqual(len(results), 20)
+        self.assertGreater(stats['stages']['write']['utilization'], stats['stages']['read']['utilization'])
+        self.assertLessEqual(stats['stages']['write']['utilization'], 1.0)
+
+    def test_inference_overlaps_downloads(self):
+        """Test that frames are upscaled while the following ones are still being downloaded"""
+        tmp_dir = tempfile.mkdtemp()
+        upsampler = create_upsampler(tmp_dir)
+        rng = np.random.default_rng(0)
+        items = []
+        for i in range(6):
+            input_path = os.path.join(tmp_dir, f'frame_{i}.png')
+            cv2.imwrite(input_path, rng.integers(0, 256, (20, 28, 3), dtype=np.uint8))
+            items.append({'input_file_path': input_path, 'output_file_path': os.path.join(tmp_dir, f'out_{i}.png')})
+
+        events = []
+        read_frame = inference.read_frame
+        upscale_frame = inference.upscale_frame
+
+        def slow_read(item):
+            time.sleep(0.05)
+            frame = read_frame(item)
+            events.append(('read', item['batch_id']))
+            return frame
+
+        def upscale(frame, model):
+            events.append(('inference', frame[0]['batch_id']))
+            return upscale_frame(frame, model)
+
+        with patch.object(inference, 'read_frame', side_effect=slow_read), \
+                patch.object(inference, 'upscale_frame', side_effect=upscale), \
+                patch.object(inference, 'PIPELINE_READ_WORKERS', 1), \
+                patch.object(inference, 'PIPELINE_INFERENCE_WORKERS', 1), \
+                patch.object(inference, 'image_cache', None):
+            response = inference.predict_fn({'batch': items, 'job_id': 'job'}, {'realesr_gan': upsampler})
+
+        self.assertEqual([result['status'] for result in response['batch_results']], [200] * 6)
+        self.assertEqual([result['batch_id'] for result in response['batch_results']], list(range(6)))
+        # the first frame is upscaled before the last one is read
+        self.assertLess(events.index(('inference', 0)), events.index(('read', 5)))
+        self.assertEqual(set(response['stage_utilization']), {'read', 'inference', 'write'})
+        self.assertGreater(response['stage_utilization']['read'], 0.5)
+        for item in items:
+            self.assertEqual(cv2.imread(item['output_file_path']).shape, (80, 112, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
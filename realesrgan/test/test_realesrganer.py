@@ -0,0 +1,328 @@
+import unittest
+import os
+import tempfile
+import concurrent.futures
+import numpy as np
+import cv2
+import torch
+from torch.nn import functional as F
+from unittest.mock import patch
+
+# Add the src directory to the path so we can import the realesrgan package
+import sys
+src_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, src_path)
+import patch_torchvision
+from realesrgan.realesrgan import RealESRGANer, load_cached_state_dict
+from realesrgan.realesrgan.archs.srvgg_arch import SRVGGNetCompact
+
+
+def create_upsampler(model_dir, **kwargs):
+    """Create a RealESRGANer around a small randomly initialized SRVGGNetCompact"""
+    torch.manual_seed(0)
+    model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=8, num_conv=2, upscale=4, act_type='prelu')
+    model_path = os.path.join(model_dir, 'srvgg_test.pth')
+    if not os.path.exists(model_path):
+        torch.save({'params': model.state_dict()}, model_path)
+    options = {'tile': 0, 'tile_pad': 10, 'pre_pad': 0, 'half': False, 'device': torch.device('cpu')}
+    options.update(kwargs)
+    return RealESRGANer(scale=4, model_path=model_path, model=model, **options)
+
+
+def legacy_enhance(upsampler, img, outscale=None):
+    """Reference implementation of the former NumPy/cv2 pre and post-processing around the model"""
+    h_input, w_input = img.shape[0:2]
+    img = img.astype(np.float32)
+    max_range = 65535 if np.max(img) > 256 else 255
+    img = img / max_range
+    if len(img.shape) == 2:
+        img_mode = 'L'
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+    else:
+        img_mode = 'RGB'
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    img = torch.from_numpy(np.transpose(img, (2, 0, 1))).float().unsqueeze(0)
+    with torch.no_grad():
+        output_img = upsampler.upscale(img)
+    output_img = output_img.squeeze().float().cpu().clamp_(0, 1).numpy()
+    output_img = np.transpose(output_img[[2, 1, 0], :, :], (1, 2, 0))
+    if img_mode == 'L':
+        output_img = cv2.cvtColor(output_img, cv2.COLOR_BGR2GRAY)
+    if max_range == 65535:
+        output = (output_img * 65535.0).round().astype(np.uint16)
+    else:
+        output = (output_img * 255.0).round().astype(np.uint8)
+    if outscale is not None and outscale != float(upsampler.scale):
+        output = cv2.resize(output, (int(w_input * outscale), int(h_input * outscale)),
+                            interpolation=cv2.INTER_LANCZOS4)
+    return output
+
+
+class TestRealESRGANer(unittest.TestCase):
+    """Test cases for the RealESRGANer helper"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.model_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        cls.img = rng.integers(0, 256, (45, 70, 3), dtype=np.uint8)
+
+    def test_tile_grid_uses_uniform_tile_size(self):
+        """Test that edge tiles are cropped with the same padded size as inner tiles"""
+        upsampler = create_upsampler(self.model_dir, tile=16, tile_pad=4)
+        tiles = upsampler.get_tile_grid(45, 70, 24, 24)
+
+        self.assertEqual(len(tiles), 3 * 5)
+        for (pad_y, pad_x), (start_y, end_y, start_x, end_x) in tiles:
+            self.assertTrue(0 <= pad_y <= 45 - 24)
+            self.assertTrue(0 <= pad_x <= 70 - 24)
+            self.assertTrue(pad_y <= start_y and end_y <= pad_y + 24)
+            self.assertTrue(pad_x <= start_x and end_x <= pad_x + 24)
+
+    def test_batched_tiles_match_whole_image(self):
+        """Test that batched tile processing matches a single forward of the whole image"""
+        expected, _ = create_upsampler(self.model_dir).enhance(self.img)
+
+        for tile_batch_size in (1, 4, 32):
+            upsampler = create_upsampler(self.model_dir, tile=16, tile_pad=8, tile_batch_size=tile_batch_size)
+            output, img_mode = upsampler.enhance(self.img)
+            self.assertEqual(img_mode, 'RGB')
+            self.assertEqual(output.shape, (45 * 4, 70 * 4, 3))
+            np.testing.assert_allclose(output.astype(np.int16), expected.astype(np.int16), atol=1)
+
+    def test_tile_batch_size_from_memory_budget(self):
+        """Test that the tile batch size is derived from the memory budget"""
+        upsampler = create_upsampler(self.model_dir, tile=64, tile_batch_size=0)
+        tile_memory = 64 * 64 * 16 * RealESRGANer.TILE_ACTIVATIONS_PER_OUTPUT_PIXEL * 4
+
+        upsampler.tile_memory_budget = 3 * tile_memory
+        self.assertEqual(upsampler.get_tile_batch_size(64, 64), 3)
+
+        upsampler.tile_memory_budget = tile_memory // 2
+        self.assertEqual(upsampler.get_tile_batch_size(64, 64), 1)
+
+        upsampler.tile_batch_size = 5
+        self.assertEqual(upsampler.get_tile_batch_size(64, 64), 5)
+
+    def test_feathered_tile_weights_sum_to_one(self):
+        """Test that the feathering ramps of two neighbouring tiles sum up to one in their overlap"""
+        for tile_blend in ('linear', 'cosine'):
+            upsampler = create_upsampler(self.model_dir, tile=16, tile_pad=3, tile_blend=tile_blend)
+            weights = upsampler.get_tile_weights(22, False, False)
+            ramp = 2 * 3 * 4
+            self.assertEqual(weights.shape, (22 * 4, ))
+            torch.testing.assert_close(weights[-ramp:] + weights[:ramp], torch.ones(ramp))
+            torch.testing.assert_close(weights[ramp:-ramp], torch.ones(22 * 4 - 2 * ramp))
+            torch.testing.assert_close(upsampler.get_tile_weights(22, True, True), torch.ones(22 * 4))
+
+    def test_feathered_tiles_match_whole_image(self):
+        """Test that feathered tiles reproduce the whole image for a model without spatial context"""
+        for tile_blend in ('linear', 'cosine'):
+            upsampler = create_upsampler(self.model_dir, tile=16, tile_pad=3, tile_batch_size=4,
+                                         tile_blend=tile_blend)
+            upsampler.model = lambda x: F.interpolate(x, scale_factor=4, mode='nearest')
+            img = torch.rand(1, 3, 45, 70)
+
+            rows = list(upsampler.tile_rows(img))
+            start_rows = [start_row for start_row, _ in rows]
+            ends = [start_row + output.shape[2] for start_row, output in rows]
+            self.assertEqual(start_rows, [0] + ends[:-1])
+            torch.testing.assert_close(torch.cat([output for _, output in rows], dim=2), upsampler.model(img))
+
+    def test_feathered_tiles_stream_into_memmap(self):
+        """Test that feathered tile rows streamed into a np.memmap match the in-memory output"""
+        upsampler = create_upsampler(self.model_dir, tile=16, tile_pad=2, pre_pad=2, tile_blend='cosine')
+        expected, _ = upsampler.enhance(self.img)
+        with tempfile.NamedTemporaryFile(dir=self.model_dir) as f:
+            out = np.memmap(f.name, dtype=np.uint8, mode='w+', shape=upsampler.get_output_shape(self.img))
+            upsampler.enhance(self.img, out=out)
+            np.testing.assert_array_equal(np.asarray(out), expected)
+
+    def test_weight_cache_is_written_once_and_memory_mapped(self):
+        """Test that the converted weights are cached as safetensors and loaded without torch.load"""
+        cache_dir = tempfile.mkdtemp()
+        expected, _ = create_upsampler(self.model_dir).enhance(self.img)
+
+        upsampler = create_upsampler(self.model_dir, weight_cache_dir=cache_dir)
+        cache_files = os.listdir(cache_dir)
+        self.assertEqual(len(cache_files), 1)
+        self.assertTrue(cache_files[0].startswith('srvgg_test.') and cache_files[0].endswith('.fp32.safetensors'))
+        np.testing.assert_array_equal(upsampler.enhance(self.img)[0], expected)
+
+        with patch('torch.load', side_effect=AssertionError('checkpoint should not be unpickled')):
+            cached = create_upsampler(self.model_dir, weight_cache_dir=cache_dir)
+        np.testing.assert_array_equal(cached.enhance(self.img)[0], expected)
+        self.assertEqual(os.listdir(cache_dir), cache_files)
+
+        state_dict = load_cached_state_dict(os.path.join(self.model_dir, 'srvgg_test.pth'), cache_dir, half=True)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        self.assertTrue(all(v.dtype == torch.float16 for v in state_dict.values()))
+
+    def test_concurrent_enhance_matches_serial(self):
+        """Test that concurrent enhance calls against one upsampler do not share per-call state"""
+        upsampler = create_upsampler(self.model_dir, pre_pad=2)
+        rng = np.random.default_rng(1)
+        images = [rng.integers(0, 256, (20 + 3 * i, 30 + 5 * i, 3), dtype=np.uint8) for i in range(6)]
+        tiles = [0, 8, 0, 16, 0, 8]
+        expected = [upsampler.enhance(img, tile=tile)[0] for img, tile in zip(images, tiles)]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            outputs = list(executor.map(lambda args: upsampler.enhance(args[0], tile=args[1])[0], zip(images, tiles)))
+
+        for img, output, expected_output in zip(images, outputs, expected):
+            self.assertEqual(output.shape, (img.shape[0] * 4, img.shape[1] * 4, 3))
+            np.testing.assert_array_equal(output, expected_output)
+        self.assertFalse(hasattr(upsampler, 'img'))
+        self.assertFalse(hasattr(upsampler, 'output'))
+
+    def test_tensor_pipeline_matches_legacy_processing(self):
+        """Test that the tensor pre/post-processing matches the former NumPy/cv2 implementation"""
+        upsampler = create_upsampler(self.model_dir, pre_pad=2)
+        rng = np.random.default_rng(2)
+        gray = rng.integers(0, 256, (24, 32), dtype=np.uint8)
+        deep = rng.integers(0, 65536, (24, 32, 3), dtype=np.uint16)
+
+        for img, expected_mode in ((self.img, 'RGB'), (gray, 'L'), (deep, 'RGB')):
+            output, img_mode = upsampler.enhance(img)
+            expected = legacy_enhance(upsampler, img)
+            self.assertEqual(img_mode, expected_mode)
+            self.assertEqual(output.dtype, expected.dtype)
+            self.assertEqual(output.shape, expected.shape)
+            self.assertTrue(output.flags['C_CONTIGUOUS'])
+            np.testing.assert_allclose(output.astype(np.int64), expected.astype(np.int64), atol=1)
+
+    def test_float_input_left_unchanged(self):
+        """Test that a float32 input, which the CPU tensor shares memory with, is not modified"""
+        upsampler = create_upsampler(self.model_dir)
+        img = self.img.astype(np.float32)
+        original = img.copy()
+        upsampler.enhance(img)
+        np.testing.assert_array_equal(img, original)
+
+        # a read-only buffer, e.g. an npy frame decoded from a request body
+        img = np.frombuffer(original.tobytes(), dtype=np.float32).reshape(original.shape)
+        self.assertFalse(img.flags['WRITEABLE'])
+        output, _ = upsampler.enhance(img)
+        self.assertEqual(output.shape, (180, 280, 3))
+
+    def test_outscale_resize(self):
+        """Test that the outscale resize runs on the tensor and stays close to the LANCZOS resize"""
+        upsampler = create_upsampler(self.model_dir)
+        img = cv2.GaussianBlur(self.img, (9, 9), 3)
+        for outscale in (2, 5):
+            output, _ = upsampler.enhance(img, outscale=outscale)
+            expected = legacy_enhance(upsampler, img, outscale=outscale)
+            self.assertEqual(output.shape, expected.shape)
+            self.assertLess(abs(output.mean() - expected.mean()), 1.0)
+            if outscale > upsampler.scale:
+                # when downscaling the antialiased bicubic resize intentionally differs from LANCZOS
+                self.assertLess(np.abs(output.astype(np.float32) - expected.astype(np.float32)).mean(), 2.5)
+
+    def test_enhance_batch_matches_enhance(self):
+        """Test that images stacked into one forward match enhancing them one by one"""
+        rng = np.random.default_rng(1)
+        imgs = [self.img, rng.integers(0, 256, self.img.shape, dtype=np.uint8)]
+        for options in ({}, {'tile': 16, 'outscale': 2}):
+            upsampler = create_upsampler(self.model_dir, tile_pad=3)
+            with patch.object(upsampler, 'enhance', wraps=upsampler.enhance) as mock_enhance:
+                outputs = upsampler.enhance_batch(imgs, **options)
+                mock_enhance.assert_not_called()
+            for img, output in zip(imgs, outputs):
+                expected, _ = upsampler.enhance(img, **options)
+                np.testing.assert_allclose(output, expected, atol=1)
+
+        # gray images are enhanced one by one
+        gray = [cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) for img in imgs]
+        outputs = upsampler.enhance_batch(gray)
+        self.assertEqual([output.shape for output in outputs], [(180, 280)] * 2)
+
+    def test_rgba_with_bilinear_alpha(self):
+        """Test that RGBA input keeps an upscaled alpha channel"""
+        upsampler = create_upsampler(self.model_dir)
+        img = np.dstack([self.img, np.full(self.img.shape[:2], 200, dtype=np.uint8)])
+        output, img_mode = upsampler.enhance(img, alpha_upsampler='bilinear')
+        self.assertEqual(img_mode, 'RGBA')
+        self.assertEqual(output.shape, (45 * 4, 70 * 4, 4))
+        self.assertTrue(np.all(output[:, :, 3] == 200))
+
+    def test_rgba_alpha_in_same_forward(self):
+        """Test that the alpha plane is upscaled in the same forward as the colour image"""
+        upsampler = create_upsampler(self.model_dir)
+        rng = np.random.default_rng(3)
+        alpha = rng.integers(0, 256, self.img.shape[:2], dtype=np.uint8)
+        img = np.dstack([self.img, alpha])
+        calls = []
+        hook = upsampler.model.register_forward_hook(lambda module, inputs, output: calls.append(inputs[0].shape))
+        try:
+            output, img_mode = upsampler.enhance(img, alpha_upsampler='realesrgan')
+        finally:
+            hook.remove()
+
+        self.assertEqual(img_mode, 'RGBA')
+        self.assertEqual(calls, [torch.Size([2, 3, 45, 70])])
+        expected_rgb, _ = upsampler.enhance(self.img)
+        expected_alpha, _ = upsampler.enhance(alpha)
+        np.testing.assert_allclose(output[:, :, :3].astype(np.int16), expected_rgb.astype(np.int16), atol=1)
+        np.testing.assert_allclose(output[:, :, 3].astype(np.int16), expected_alpha.astype(np.int16), atol=1)
+
+        # the batched alpha plane also goes through batched tiles
+        tiled_output, _ = upsampler.enhance(img, alpha_upsampler='realesrgan', tile=16)
+        np.testing.assert_allclose(tiled_output.astype(np.int16), output.astype(np.int16), atol=1)
+
+    def test_rgba_with_cheap_alpha_upsamplers(self):
+        """Test that the bicubic and guided alpha upsamplers skip the network for the alpha plane"""
+        upsampler = create_upsampler(self.model_dir)
+        alpha = np.zeros(self.img.shape[:2], dtype=np.uint8)
+        alpha[:, 35:] = 255
+        img = np.dstack([self.img, alpha])
+        for alpha_upsampler in ('bicubic', 'guided'):
+            calls = []
+            hook = upsampler.model.register_forward_hook(lambda module, inputs, output: calls.append(inputs[0].shape))
+            try:
+                output, _ = upsampler.enhance(img, alpha_upsampler=alpha_upsampler)
+            finally:
+                hook.remove()
+            self.assertEqual(calls, [torch.Size([1, 3, 45, 70])])
+            self.assertEqual(output.shape, (45 * 4, 70 * 4, 4))
+            self.assertTrue(np.all(output[:, :120, 3] < 16))
+            self.assertTrue(np.all(output[:, 160:, 3] > 239))
+
+    def test_streamed_output_into_memmap(self):
+        """Test that tile rows streamed into a np.memmap match the in-memory output"""
+        upsampler = create_upsampler(self.model_dir, tile=16, tile_pad=8, pre_pad=2, tile_batch_size=3)
+        rng = np.random.default_rng(4)
+        rgba = np.dstack([self.img, rng.integers(0, 256, self.img.shape[:2], dtype=np.uint8)])
+        gray = self.img[:, :, 0].copy()
+
+        cases = ((self.img, 'realesrgan'), (gray, 'realesrgan'), (rgba, 'realesrgan'), (rgba, 'bicubic'),
+                 (rgba, 'bilinear'))
+        for img, alpha_upsampler in cases:
+            expected, expected_mode = upsampler.enhance(img, alpha_upsampler=alpha_upsampler)
+            with tempfile.NamedTemporaryFile(dir=self.model_dir) as f:
+                out = np.memmap(f.name, dtype=np.uint8, mode='w+', shape=upsampler.get_output_shape(img))
+                output, img_mode = upsampler.enhance(img, alpha_upsampler=alpha_upsampler, out=out)
+                self.assertIs(output, out)
+                self.assertEqual(img_mode, expected_mode)
+                np.testing.assert_array_equal(np.asarray(out), expected)
+
+    def test_streamed_output_to_callable(self):
+        """Test that a callable receives every finished tile row in order"""
+        upsampler = create_upsampler(self.model_dir, tile=16, tile_pad=8)
+        expected, _ = upsampler.enhance(self.img)
+        chunks = []
+        upsampler.enhance(self.img, out=lambda start_row, rows: chunks.append((start_row, rows.copy())))
+
+        self.assertEqual([start_row for start_row, _ in chunks], [0, 64, 128])
+        np.testing.assert_array_equal(np.concatenate([rows for _, rows in chunks]), expected)
+
+    def test_streamed_output_validation(self):
+        """Test that streamed output rejects a resize and a wrongly shaped array"""
+        upsampler = create_upsampler(self.model_dir, tile=16)
+        with self.assertRaises(ValueError):
+            upsampler.enhance(self.img, outscale=2, out=lambda start_row, rows: None)
+        with self.assertRaises(ValueError):
+            upsampler.enhance(self.img, out=np.zeros((10, 10, 3), dtype=np.uint8))
+
+
+if __name__ == '__main__':
+    unittest.main()
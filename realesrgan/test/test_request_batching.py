@@ -0,0 +1,182 @@
+import unittest
+import os
+import json
+import tempfile
+import numpy as np
+import cv2
+from unittest.mock import patch
+
+# Add the src directory to the path so we can import the inference module
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import inference
+import serve
+from request_codec import RequestBatch
+from test_realesrganer import create_upsampler
+
+try:
+    import batch_handler_service
+    from sagemaker_inference.environment import Environment
+except ImportError:
+    # the SageMaker inference toolkit comes with the serving image
+    batch_handler_service = None
+
+
+class RequestProcessor:
+    def __init__(self, properties):
+        self.properties = properties
+
+    def get_request_properties(self):
+        return self.properties
+
+
+class Context:
+    """The parts of the TorchServe context used by the handler service"""
+
+    def __init__(self, content_types):
+        self.system_properties = {'model_dir': '/opt/ml/model'}
+        self.request_processor = [RequestProcessor({'Content-Type': content_type}) for content_type in content_types]
+        self.content_types = {}
+        self.statuses = {}
+
+    def set_response_content_type(self, idx, value):
+        self.content_types[idx] = value
+
+    def set_response_status(self, code=200, phrase="", idx=0):
+        self.statuses[idx] = code
+
+
+class TestRequestBatching(unittest.TestCase):
+    """Test cases for the requests batched by the model server"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.upsampler = create_upsampler(self.tmp_dir)
+        rng = np.random.default_rng(0)
+        self.requests = RequestBatch()
+        for i, (height, width) in enumerate([(20, 28), (20, 28), (17, 24), (20, 28)]):
+            input_path = os.path.join(self.tmp_dir, f'frame_{i}.png')
+            cv2.imwrite(input_path, rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+            self.requests.append({'input_file_path': input_path,
+                                  'output_file_path': os.path.join(self.tmp_dir, f'out_{i}.png'),
+                                  'job_id': f'job_{i}', 'batch_id': 0})
+
+    def count_forwards(self):
+        batch_sizes = []
+        forward = self.upsampler.model.forward
+        return batch_sizes, patch.object(self.upsampler.model, 'forward',
+                                         side_effect=lambda x: batch_sizes.append(len(x)) or forward(x))
+
+    def test_single_frame_requests_share_forwards(self):
+        """Test that the single-image requests of a batch are upscaled together per frame shape"""
+        expected = [self.upsampler.enhance(cv2.imread(request['input_file_path']))[0] for request in self.requests]
+        self.requests.append({**self.requests[0], 'input_file_path': os.path.join(self.tmp_dir, 'missing.png'),
+                              'job_id': 'missing'})
+
+        batch_sizes, forward = self.count_forwards()
+        with forward, patch.object(inference, 'FRAME_BATCH_SIZE', 8), patch.object(inference, 'image_cache', None):
+            predictions = inference.predict_fn(self.requests, {'realesr_gan': self.upsampler})
+
+        self.assertEqual([prediction['status'] for prediction in predictions], [200, 200, 200, 200, 500])
+        self.assertEqual([prediction['job_id'] for prediction in predictions],
+                         ['job_0', 'job_1', 'job_2', 'job_3', 'missing'])
+        self.assertEqual(sorted(batch_sizes), [1, 3])
+        for request, expected_output in zip(self.requests, expected):
+            np.testing.assert_allclose(cv2.imread(request['output_file_path']), expected_output, atol=1)
+
+    def test_forwards_are_bounded_by_the_frame_batch_size(self):
+        """Test that frames of the same shape are split into forwards of at most FRAME_BATCH_SIZE frames"""
+        batch_sizes, forward = self.count_forwards()
+        with forward, patch.object(inference, 'FRAME_BATCH_SIZE', 2), patch.object(inference, 'image_cache', None):
+            predictions = inference.predict_fn(self.requests, {'realesr_gan': self.upsampler})
+
+        self.assertEqual([prediction['status'] for prediction in predictions], [200] * 4)
+        self.assertEqual(sorted(batch_sizes), [1, 1, 2])
+
+    def test_out_of_memory_falls_back_to_single_frames(self):
+        """Test that stacked frames that do not fit in memory are upscaled one by one"""
+        enhance_batch = self.upsampler.enhance_batch
+
+        def out_of_memory(imgs, **kwargs):
+            if len(imgs) > 1:
+                raise RuntimeError('CUDA out of memory')
+            return enhance_batch(imgs, **kwargs)
+
+        with patch.object(self.upsampler, 'enhance_batch', side_effect=out_of_memory), \
+                patch.object(self.upsampler, 'enhance', wraps=self.upsampler.enhance) as mock_enhance, \
+                patch.object(inference, 'FRAME_BATCH_SIZE', 8), patch.object(inference, 'image_cache', None):
+            predictions = inference.predict_fn(self.requests, {'realesr_gan': self.upsampler})
+        self.assertEqual([prediction['status'] for prediction in predictions], [200] * 4)
+        self.assertEqual(mock_enhance.call_count, 4)
+
+        with patch.object(self.upsampler, 'enhance_batch', side_effect=RuntimeError('shape mismatch')), \
+                patch.object(inference, 'FRAME_BATCH_SIZE', 8), patch.object(inference, 'image_cache', None):
+            predictions = inference.predict_fn(self.requests, {'realesr_gan': self.upsampler})
+        self.assertEqual([prediction['status'] for prediction in predictions], [500] * 4)
+
+    def test_batch_requests_keep_their_pipeline(self):
+        """Test that a batch request batched with single-image requests gets its own batch prediction"""
+        batch = [{'input_file_path': request['input_file_path'],
+                  'output_file_path': request['output_file_path'] + '.batch.png'} for request in self.requests[:2]]
+        requests = RequestBatch([self.requests[2], {'batch': batch, 'job_id': 'batch_job'}])
+        with patch.object(inference, 'image_cache', None):
+            predictions = inference.predict_fn(requests, {'realesr_gan': self.upsampler})
+
+        self.assertEqual(predictions[0]['job_id'], 'job_2')
+        self.assertEqual(predictions[0]['status'], 200)
+        self.assertEqual(predictions[1]['job_id'], 'batch_job')
+        self.assertEqual([result['status'] for result in predictions[1]['batch_results']], [200, 200])
+
+    @unittest.skipIf(batch_handler_service is None, "the SageMaker inference toolkit is not installed")
+    def test_handler_predicts_the_requests_of_a_batch_at_once(self):
+        """Test that the handler service decodes each request, predicts them in one call and encodes each result"""
+        handler = batch_handler_service.BatchHandlerService()
+        transformer = handler._service
+        transformer._initialized = True
+        transformer._environment = Environment()
+        transformer._model = {'realesr_gan': self.upsampler}
+        transformer._input_fn = inference.input_fn
+        transformer._output_fn = inference.output_fn
+
+        png = cv2.imencode('.png', cv2.imread(self.requests[1]['input_file_path']))[1].tobytes()
+        data = [{'body': json.dumps(self.requests[0]).encode('utf-8')}, {'body': b'{not json'}, {'body': png}]
+        context = Context(['application/json', 'application/json', 'image/png'])
+
+        batch_sizes, forward = self.count_forwards()
+        with forward, patch.object(inference, 'predict_fn', wraps=inference.predict_fn) as predict_fn, \
+                patch.object(inference, 'FRAME_BATCH_SIZE', 8), patch.object(inference, 'image_cache', None):
+            transformer._predict_fn = predict_fn
+            responses = handler.handle(data, context)
+
+        predict_fn.assert_called_once()
+        self.assertEqual(batch_sizes, [2])
+        self.assertEqual(json.loads(responses[0])['status'], 200)
+        self.assertEqual(context.statuses, {1: 500})
+        self.assertEqual(context.content_types, {0: 'application/json', 2: 'image/png'})
+        output = cv2.imdecode(np.frombuffer(responses[2], dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        self.assertEqual(output.shape, (80, 112, 3))
+
+
+class TestServe(unittest.TestCase):
+    """Test cases for the TorchServe settings of the entrypoint"""
+
+    def test_batching_is_on_by_default(self):
+        """Test that TorchServe batches requests and keeps the timeout and workers of the model server"""
+        environ = {'SAGEMAKER_MODEL_SERVER_TIMEOUT': '600', 'SAGEMAKER_MODEL_SERVER_WORKERS': '2'}
+        serve.configure_batching(environ)
+        self.assertEqual(environ['SAGEMAKER_TS_BATCH_SIZE'], '8')
+        self.assertEqual(environ['SAGEMAKER_TS_MAX_BATCH_DELAY'], '20')
+        self.assertEqual(environ['SAGEMAKER_TS_RESPONSE_TIMEOUT'], '600')
+        self.assertEqual((environ['SAGEMAKER_TS_MIN_WORKERS'], environ['SAGEMAKER_TS_MAX_WORKERS']), ('2', '2'))
+
+    def test_settings_from_the_environment_are_kept(self):
+        """Test that batching settings set in the environment are not overridden"""
+        environ = {'SAGEMAKER_TS_BATCH_SIZE': '1', 'SAGEMAKER_TS_RESPONSE_TIMEOUT': '30'}
+        serve.configure_batching(environ)
+        self.assertEqual(environ['SAGEMAKER_TS_BATCH_SIZE'], '1')
+        self.assertEqual(environ['SAGEMAKER_TS_RESPONSE_TIMEOUT'], '30')
+        self.assertNotIn('SAGEMAKER_TS_MIN_WORKERS', environ)
+
+
+if __name__ == '__main__':
+    unittest.main()
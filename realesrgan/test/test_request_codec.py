@@ -0,0 +1,134 @@
+import unittest
+import io
+import os
+import json
+import tempfile
+import numpy as np
+import cv2
+
+# Add the src directory to the path so we can import the inference module
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import inference
+from request_codec import decode_npy, encode_multipart, parse_multipart, parse_multipart_frames
+from test_realesrganer import create_upsampler
+
+
+def encode_npy(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    return bytearray(buffer.getvalue())
+
+
+class TestRequestCodec(unittest.TestCase):
+    """Test cases for the inline frame request and response bodies"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.model_dir = tempfile.mkdtemp()
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.img = rng.integers(0, 256, (20, 28, 3), dtype=np.uint8)
+
+    def test_npy_is_decoded_without_copy(self):
+        """Test that an .npy body is mapped as a view of the request buffer"""
+        for array in (self.img, np.asfortranarray(self.img), np.arange(6, dtype='>u2').reshape(2, 3)):
+            body = encode_npy(array)
+            decoded = decode_npy(body)
+            np.testing.assert_array_equal(decoded, array)
+            self.assertTrue(np.shares_memory(decoded, np.frombuffer(body, dtype=np.uint8)))
+
+        with self.assertRaises(ValueError):
+            decode_npy(b'not an array')
+        with self.assertRaises(ValueError):
+            decode_npy(encode_npy(np.array([{}], dtype=object)))
+
+    def test_multipart_round_trip(self):
+        """Test that multipart parts are split into views of the body and fields are JSON decoded"""
+        png = cv2.imencode('.png', self.img)[1].tobytes()
+        body, content_type = encode_multipart([
+            ('job_id', 'text/plain', b'job-1', None),
+            ('tile_size', 'text/plain', b'0', None),
+            ('first', 'image/png', png, 'first.png'),
+            ('second', 'application/octet-stream', bytes(encode_npy(self.img)), 'second.npy'),
+        ])
+        body = bytearray(body)
+
+        parts = parse_multipart(body, content_type)
+        self.assertEqual([headers.get_param('name', header='content-disposition') for headers, _ in parts],
+                         ['job_id', 'tile_size', 'first', 'second'])
+        self.assertEqual(bytes(parts[2][1]), png)
+
+        fields, frames = parse_multipart_frames(body, content_type)
+        self.assertEqual(fields, {'job_id': 'job-1', 'tile_size': 0})
+        self.assertEqual([(frame['name'], frame['output_format']) for frame in frames],
+                         [('first', 'image/png'), ('second', 'application/x-npy')])
+        for frame in frames:
+            np.testing.assert_array_equal(frame['image'], self.img)
+
+        with self.assertRaises(ValueError):
+            parse_multipart(body, 'multipart/form-data')
+
+    def test_inline_frame_request(self):
+        """Test that a PNG request body is upscaled into a PNG response body"""
+        upsampler = create_upsampler(self.model_dir)
+        expected, _ = upsampler.enhance(self.img)
+        input_data = inference.input_fn(bytearray(cv2.imencode('.png', self.img)[1]), 'image/png')
+        prediction = inference.predict_fn(input_data, {'realesr_gan': upsampler})
+        body, content_type = inference.output_fn(prediction, 'application/json')
+
+        self.assertEqual(content_type, 'image/png')
+        output = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        np.testing.assert_allclose(output, expected, atol=1)
+
+        # an npy request is answered with an npy body
+        input_data = inference.input_fn(encode_npy(self.img), 'application/x-npy')
+        body, content_type = inference.output_fn(inference.predict_fn(input_data, {'realesr_gan': upsampler}), None)
+        self.assertEqual(content_type, 'application/x-npy')
+        np.testing.assert_allclose(np.load(io.BytesIO(body)), expected, atol=1)
+
+    def test_multipart_batch_request(self):
+        """Test that a multipart batch is answered with the results and one part per upscaled frame"""
+        upsampler = create_upsampler(self.model_dir)
+        expected, _ = upsampler.enhance(self.img)
+        body, content_type = encode_multipart([
+            ('job_id', 'text/plain', b'job-1', None),
+            ('a', 'image/png', cv2.imencode('.png', self.img)[1].tobytes(), 'a.png'),
+            ('b', 'image/jpeg', b'not a jpeg', 'b.jpg'),
+        ])
+        with self.assertRaises(ValueError):
+            inference.input_fn(bytearray(body), content_type)
+
+        body, content_type = encode_multipart([
+            ('job_id', 'text/plain', b'job-1', None),
+            ('a', 'image/png', cv2.imencode('.png', self.img)[1].tobytes(), 'a.png'),
+            ('b', 'image/png', cv2.imencode('.png', self.img[:, :, 0])[1].tobytes(), 'b.png'),
+        ])
+        input_data = inference.input_fn(bytearray(body), content_type)
+        self.assertEqual(input_data['job_id'], 'job-1')
+        prediction = inference.predict_fn(input_data, {'realesr_gan': upsampler})
+        body, content_type = inference.output_fn(prediction, 'application/json')
+
+        self.assertTrue(content_type.startswith('multipart/form-data; boundary='))
+        parts = parse_multipart(body, content_type)
+        names = [headers.get_param('name', header='content-disposition') for headers, _ in parts]
+        self.assertEqual(names, ['results', '0', '1'])
+        results = json.loads(bytes(parts[0][1]))
+        self.assertEqual([result['status'] for result in results['batch_results']], [200, 200])
+        self.assertNotIn('image', results['batch_results'][0])
+        output = cv2.imdecode(np.frombuffer(parts[1][1], dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        np.testing.assert_allclose(output, expected, atol=1)
+        self.assertEqual(cv2.imdecode(np.frombuffer(parts[2][1], dtype=np.uint8), cv2.IMREAD_UNCHANGED).shape,
+                         (80, 112))
+
+    def test_json_requests_are_unchanged(self):
+        """Test that a JSON request keeps its JSON response"""
+        self.assertEqual(inference.input_fn('{"a": 1}', 'application/json; charset=utf-8'), {'a': 1})
+        prediction = {'status': 200, 'output_file_path': 's3://bucket/out.png', 'job_id': 1, 'batch_id': 0}
+        self.assertEqual(inference.output_fn(prediction, 'application/json'), (json.dumps(prediction),
+                                                                              'application/json'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+import os
+import gzip
+import numpy as np
+import cv2
+import boto3
+from unittest.mock import MagicMock, patch
+from moto import mock_aws
+
+# Add the src directory to the path so we can import the inference module
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import inference
+import s3_transport
+
+
+@mock_aws
+class TestS3Transport(unittest.TestCase):
+    """Test cases for the in-memory S3 frame transport"""
+
+    def setUp(self):
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+        # the shared client is created inside the moto mock
+        s3_transport._s3_client = None
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        self.s3.create_bucket(Bucket='frames')
+        self.img = np.random.default_rng(0).integers(0, 256, (16, 24, 3), dtype=np.uint8)
+        self.s3.put_object(Bucket='frames', Key='job/frame_0001.png', Body=cv2.imencode('.png', self.img)[1].tobytes())
+
+    def tearDown(self):
+        s3_transport._s3_client = None
+
+    def test_images_round_trip_in_memory(self):
+        """Test that images are decoded from and encoded to S3 objects without temporary files"""
+        with patch('cv2.imread') as mock_imread, patch('cv2.imwrite') as mock_imwrite:
+            np.testing.assert_array_equal(s3_transport.read_image('s3://frames/job/frame_0001.png'), self.img)
+            s3_transport.write_image('s3://frames/out/frame_0001.png', self.img)
+            mock_imread.assert_not_called()
+            mock_imwrite.assert_not_called()
+
+        response = self.s3.get_object(Bucket='frames', Key='out/frame_0001.png')
+        self.assertEqual(response['ContentType'], 'image/png')
+        output = cv2.imdecode(np.frombuffer(response['Body'].read(), dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        np.testing.assert_array_equal(output, self.img)
+
+    def test_compressed_objects(self):
+        """Test that the gzip compressed copy is written and preferred on read"""
+        s3_transport.write_image('s3://frames/out/frame_0001.png', self.img, use_compression=True)
+        compressed = self.s3.get_object(Bucket='frames', Key='out/frame_0001.png.gz')['Body'].read()
+        self.assertEqual(gzip.decompress(compressed),
+                         self.s3.get_object(Bucket='frames', Key='out/frame_0001.png')['Body'].read())
+
+        self.s3.delete_object(Bucket='frames', Key='out/frame_0001.png')
+        np.testing.assert_array_equal(
+            s3_transport.read_image('s3://frames/out/frame_0001.png', use_compression=True), self.img)
+        # without a compressed copy the original is read
+        np.testing.assert_array_equal(
+            s3_transport.read_image('s3://frames/job/frame_0001.png', use_compression=True), self.img)
+
+    def test_large_buffers_use_multipart_upload(self):
+        """Test that buffers above the multipart threshold are uploaded in parts from memory"""
+        data = os.urandom(6 * 1024 * 1024)
+        with patch.object(s3_transport, 'MULTIPART_THRESHOLD', 5 * 1024 * 1024), \
+                patch.object(s3_transport, 'MULTIPART_CHUNKSIZE', 5 * 1024 * 1024):
+            s3_transport.put_object_bytes(data, 's3://frames/out/large.bin')
+        self.assertEqual(s3_transport.get_object_bytes('s3://frames/out/large.bin'), data)
+
+    def test_shared_client(self):
+        """Test that all transfers share one configured client"""
+        client = s3_transport.get_s3_client()
+        self.assertIs(s3_transport.get_s3_client(), client)
+        self.assertEqual(client.meta.config.max_pool_connections, s3_transport.S3_CONFIG.max_pool_connections)
+
+    def test_process_single_image_from_s3_to_s3(self):
+        """Test that a frame goes from S3 to S3 without passing through the image cache directory"""
+        upsampler = MagicMock()
+        upsampler.get_output_shape.return_value = (64, 96, 3)
+        upsampler.enhance.side_effect = lambda img, **kwargs: (cv2.resize(img, None, fx=4, fy=4), None)
+        input_data = {
+            'input_file_path': 's3://frames/job/frame_0001.png',
+            'output_file_path': 's3://frames/out/frame_0001.png',
+            'job_id': 'job',
+            'batch_id': 1
+        }
+        with patch('cv2.imwrite') as mock_imwrite:
+            result = inference.process_single_image(input_data, {'realesr_gan': upsampler})
+            mock_imwrite.assert_not_called()
+
+        self.assertEqual(result['status'], 200)
+        self.assertEqual(result['output_file_path'], 's3://frames/out/frame_0001.png')
+        body = self.s3.get_object(Bucket='frames', Key='out/frame_0001.png')['Body'].read()
+        self.assertEqual(cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_UNCHANGED).shape, (64, 96, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import unittest
+import os
+import json
+import tempfile
+import numpy as np
+import torch
+from unittest.mock import patch
+
+# Add the src directory to the path so we can import the tile_calibration module
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import inference
+from tile_calibration import TileCalibrator
+from test_realesrganer import create_upsampler
+
+
+class TestTileCalibrator(unittest.TestCase):
+    """Test cases for the tile size calibration"""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.upsampler = create_upsampler(self.cache_dir, tile_pad=2)
+
+    def test_calibrates_once_and_persists(self):
+        """Test that a new combination is timed once, stored on disk and reused by a fresh calibrator"""
+        calibrator = TileCalibrator(self.cache_dir, tile_sizes=(16, 32, 128), batch_sizes=(1, 2), iterations=1,
+                                    buckets=[(40, 70)])
+        self.assertIsNone(calibrator.lookup('srvgg', self.upsampler, 40, 70))
+        with patch.object(calibrator, 'time_forward', wraps=calibrator.time_forward) as mock_time_forward:
+            tile_size, tile_batch_size = calibrator.get_tile_config('srvgg', self.upsampler, (40, 70))
+            self.assertEqual(calibrator.get_tile_config('srvgg', self.upsampler, (40, 70)),
+                             (tile_size, tile_batch_size))
+        # the whole frame in one forward, 128 covers the whole frame and is no tile size, 3 * 5 and 2 * 3 tiles
+        # allow batches of 1 and 2
+        self.assertEqual(mock_time_forward.call_count, 5)
+        self.assertIn(tile_size, (0, 16, 32))
+        self.assertIn(tile_batch_size, (1, 2))
+
+        with open(calibrator.path) as f:
+            table = json.load(f)
+        key = calibrator.get_key('srvgg', self.upsampler, (40, 70))
+        self.assertEqual(key, 'srvgg/cpu/fp32/40x70')
+        self.assertEqual((table[key]['tile_size'], table[key]['tile_batch_size']), (tile_size, tile_batch_size))
+
+        reloaded = TileCalibrator(self.cache_dir, buckets=[(40, 70)])
+        with patch.object(reloaded, 'calibrate') as mock_calibrate:
+            self.assertEqual(reloaded.get_tile_config('srvgg', self.upsampler, (40, 70)),
+                             (tile_size, tile_batch_size))
+            # smaller and portrait frames of the bucket use its configuration
+            self.assertEqual(reloaded.lookup('srvgg', self.upsampler, 70, 33), (tile_size, tile_batch_size))
+        mock_calibrate.assert_not_called()
+
+    def test_buckets_are_calibrated_at_startup(self):
+        """Test that warm calibrates every bucket once and frames beyond the buckets are not looked up"""
+        calibrator = TileCalibrator(self.cache_dir, buckets=[(720, 1280), (1080, 1920), (1280, 720)])
+        self.assertEqual(calibrator.buckets, [(720, 1280), (1080, 1920)])
+        self.assertEqual(calibrator.get_bucket(1080, 1440), (1080, 1920))
+        self.assertEqual(calibrator.get_bucket(1280, 700), (720, 1280))
+        self.assertIsNone(calibrator.get_bucket(2160, 3840))
+
+        entries = {720: {'tile_size': 0, 'tile_batch_size': 1}, 1080: {'tile_size': 512, 'tile_batch_size': 2}}
+        with patch.object(calibrator, 'calibrate', side_effect=lambda upsampler, height, width: entries[height]) \
+                as mock_calibrate:
+            calibrator.warm('srvgg', self.upsampler)
+            calibrator.warm('srvgg', self.upsampler)
+        self.assertEqual([call.args[1:] for call in mock_calibrate.call_args_list], [(720, 1280), (1080, 1920)])
+        self.assertEqual(calibrator.lookup('srvgg', self.upsampler, 480, 854), (0, 1))
+        self.assertEqual(calibrator.lookup('srvgg', self.upsampler, 1080, 1920), (512, 2))
+        self.assertIsNone(calibrator.lookup('srvgg', self.upsampler, 2160, 3840))
+        self.assertIsNone(calibrator.lookup('anime', self.upsampler, 1080, 1920))
+
+    def test_requests_use_the_configuration_of_their_bucket(self):
+        """Test that the tiling of a request comes from its bucket, and else from the fixed rule for large frames"""
+        calibrator = TileCalibrator(self.cache_dir, buckets=[(720, 1280), (1080, 1920)])
+        calibrator.save(calibrator.get_key('realesr_gan', self.upsampler, (720, 1280)),
+                        {'tile_size': 384, 'tile_batch_size': 4, 'frame_time': 1.0})
+        calibrator.save(calibrator.get_key('realesr_gan', self.upsampler, (1080, 1920)),
+                        {'tile_size': 0, 'tile_batch_size': 1, 'frame_time': 1.0})
+        model = {'realesr_gan': self.upsampler}
+        with patch.object(inference, 'tile_calibrator', calibrator), \
+                patch.object(inference, 'AUTO_TILE_CALIBRATION', True):
+            def tiling(height, width, **input_data):
+                img = np.zeros((height, width, 3), dtype=np.uint8)
+                return inference.select_upsampler(input_data, img, model)[2:]
+
+            self.assertEqual(tiling(720, 1280), (384, 4))
+            self.assertEqual(tiling(1080, 1920), (0, 1))
+            self.assertEqual(tiling(720, 1280, tile_size=256), (256, None))
+            self.assertEqual(tiling(2160, 3840), (1024, None))
+            with patch.object(inference, 'AUTO_TILE_CALIBRATION', False):
+                self.assertEqual(tiling(720, 1280), (0, None))
+                self.assertEqual(tiling(1080, 1920), (1024, None))
+
+    def test_cpu_search_space_is_small(self):
+        """Test that the CPU times a few unbatched candidates and the GPU the full search space"""
+        calibrator = TileCalibrator(self.cache_dir)
+        with patch.object(calibrator, 'time_forward', return_value=0.01) as mock_time_forward:
+            best = calibrator.calibrate(self.upsampler, 1080, 1920)
+        # the whole frame and tiles of 256 and 512
+        self.assertEqual(mock_time_forward.call_count, 3)
+        self.assertEqual({call.args[1] for call in mock_time_forward.call_args_list}, {1})
+        # one forward of the whole frame is as fast as one tile
+        self.assertEqual((best['tile_size'], best['tile_batch_size']), (0, 1))
+        self.assertEqual(calibrator.get_search_space(torch.device('cuda')),
+                         (TileCalibrator.DEFAULT_TILE_SIZES, TileCalibrator.DEFAULT_BATCH_SIZES))
+
+    def test_picks_fastest_configuration_that_fits(self):
+        """Test that out of memory candidates are skipped and the shortest extrapolated frame time wins"""
+        calibrator = TileCalibrator(self.cache_dir, tile_sizes=(16, 32), batch_sizes=(1, 2, 4))
+
+        def time_forward(upsampler, tile_batch_size, tile_height, tile_width):
+            if tile_height == 36 and tile_batch_size == 4:
+                raise RuntimeError('CUDA out of memory')
+            return 0.01 * tile_batch_size * tile_height * tile_width / (1 + tile_batch_size)
+
+        with patch.object(calibrator, 'time_forward', side_effect=time_forward):
+            best = calibrator.calibrate(self.upsampler, 64, 128)
+        self.assertEqual((best['tile_size'], best['tile_batch_size']), (16, 4))
+
+        with patch.object(calibrator, 'time_forward', side_effect=RuntimeError('CUDA out of memory')):
+            with self.assertRaises(RuntimeError):
+                calibrator.calibrate(self.upsampler, 64, 128)
+        with patch.object(calibrator, 'time_forward', side_effect=RuntimeError('shape mismatch')):
+            with self.assertRaisesRegex(RuntimeError, 'shape mismatch'):
+                calibrator.calibrate(self.upsampler, 64, 128)
+
+    def test_unreadable_table_is_replaced(self):
+        """Test that a corrupt table is ignored and entries of other processes are kept on save"""
+        calibrator = TileCalibrator(self.cache_dir, tile_sizes=(16, ), batch_sizes=(1, ), iterations=1,
+                                    buckets=[(40, 70)])
+        with open(calibrator.path, 'w') as f:
+            f.write('{not json')
+        self.assertIn(calibrator.get_tile_config('srvgg', self.upsampler, (40, 70)), [(0, 1), (16, 1)])
+
+        other = TileCalibrator(self.cache_dir)
+        other.save('other/cpu/fp32/40x70', {'tile_size': 256, 'tile_batch_size': 2, 'frame_time': 1.0})
+        calibrator.save('anime/cpu/fp32/40x70', {'tile_size': 16, 'tile_batch_size': 1, 'frame_time': 1.0})
+        with open(calibrator.path) as f:
+            table = json.load(f)
+        self.assertEqual(sorted(table), ['anime/cpu/fp32/40x70', 'other/cpu/fp32/40x70', 'srvgg/cpu/fp32/40x70'])
+        self.assertEqual([name for name in os.listdir(self.cache_dir) if name.endswith('.tmp')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""TorchServe handler service that passes the requests of a TorchServe batch to one predict_fn call.
+
+serve.py starts TorchServe with this handler instead of the one of the SageMaker inference toolkit, which runs
+the requests of a batch one by one. TorchServe module handlers must define exactly one class.
+"""
+import logging
+import traceback
+
+from sagemaker_inference import content_types, utils
+from sagemaker_pytorch_serving_container.handler_service import HandlerService
+
+from request_codec import RequestBatch
+
+logger = logging.getLogger(__name__)
+
+
+class BatchHandlerService(HandlerService):
+    """Handler service of the model server for batches of requests.
+
+    Every request is decoded by input_fn and its prediction encoded by output_fn, as by the toolkit. predict_fn
+    gets the decoded inputs of all the requests as a RequestBatch and returns one prediction per request. A
+    request that fails leaves the others of its batch unaffected.
+    """
+
+    def handle(self, data, context):
+        """Handle a batch of requests
+
+        Args:
+            data (list[dict]): The requests, with their body under 'body'.
+            context: The TorchServe context, with the properties of each request.
+
+        Returns:
+            list: One response per request, the serialized prediction or the error message.
+        """
+        transformer = self._service
+        responses = [None] * len(data)
+        try:
+            transformer.validate_and_initialize(model_dir=context.system_properties.get("model_dir"),
+                                                context=context)
+        except Exception as e:
+            return [self.error_response(context, idx, e) for idx in range(len(data))]
+
+        inputs = RequestBatch()
+        accepts = {}
+        for idx, request in enumerate(data):
+            properties = context.request_processor[idx].get_request_properties()
+            content_type = utils.retrieve_content_type_header(properties)
+            accept = properties.get("Accept") or properties.get("accept")
+            if not accept or accept == content_types.ANY:
+                accept = transformer._environment.default_accept
+            try:
+                body = request.get("body")
+                if content_type in content_types.UTF8_TYPES:
+                    body = body.decode("utf-8")
+                inputs.append(transformer._run_handler_function(transformer._input_fn, body, content_type))
+            except Exception as e:
+                responses[idx] = self.error_response(context, idx, e)
+                continue
+            accepts[idx] = accept
+
+        if not inputs:
+            return responses
+        try:
+            predictions = transformer._run_handler_function(transformer._predict_fn, inputs, transformer._model)
+        except Exception as e:
+            for idx in accepts:
+                responses[idx] = self.error_response(context, idx, e)
+            return responses
+
+        for (idx, accept), prediction in zip(accepts.items(), predictions):
+            try:
+                response = transformer._run_handler_function(transformer._output_fn, prediction, accept)
+            except Exception as e:
+                responses[idx] = self.error_response(context, idx, e)
+                continue
+            response_content_type = accept
+            if isinstance(response, tuple):
+                response, response_content_type = response
+            context.set_response_content_type(idx, response_content_type)
+            responses[idx] = response
+        logger.info(f"Handled a batch of {len(data)} requests")
+        return responses
+
+    @staticmethod
+    def error_response(context, idx, error):
+        """Set the status of a failed request
+
+        Returns:
+            str: The error message and stack trace, the body of the response.
+        """
+        trace = traceback.format_exc()
+        logger.error(f"Request {idx} of the batch failed: {trace}")
+        context.set_response_status(code=500, phrase=utils.remove_crlf(str(error)), idx=idx)
+        return f"{error}\n{trace}"
@@ -0,0 +1,169 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+# (height, width) of the common video resolutions, portrait frames use the transposed buckets
+RESOLUTION_BUCKETS = {
+    '360p': (360, 640),
+    '480p': (480, 854),
+    '720p': (720, 1280),
+    '1080p': (1080, 1920),
+    '1440p': (1440, 2560),
+    '2160p': (2160, 3840),
+}
+COMPILE_BACKENDS = ('none', 'compile', 'trace')
+
+
+def parse_buckets(spec):
+    """Parse a comma separated list of resolution names ('720p') or sizes ('512x512', height x width)"""
+    buckets = []
+    for name in spec.split(','):
+        name = name.strip().lower()
+        if not name:
+            continue
+        if name in RESOLUTION_BUCKETS:
+            buckets.append(RESOLUTION_BUCKETS[name])
+        else:
+            height, width = name.split('x')
+            buckets.append((int(height), int(width)))
+    return buckets
+
+
+class CompiledModelCache(torch.nn.Module):
+    """Run a model through graphs compiled for a small set of input resolution buckets.
+
+    Every frame size is a new static shape for torch.compile or a TorchScript trace, so compiling per frame size
+    would never reuse a graph across jobs. Instead the input is padded (reflecting its border, like
+    Swin2SR.check_image_size) to the smallest bucket it fits in, the graph of that bucket runs, and the output is
+    cropped back to the scaled input size. The compile cost is paid once per (bucket, batch size, dtype), ideally
+    at startup through warm().
+
+    Inputs that fit no bucket, or that would be padded to more than max_padding times their area, run the eager
+    model. Attributes that the cache does not have are looked up on the wrapped model, so it can replace the
+    model wherever its configuration (e.g. window_size or upscale) is read.
+    """
+
+    def __init__(self, model, buckets=None, backend='trace', pad_multiple=1, max_padding=1.5, max_graphs=16):
+        """Initialize the cache
+
+        Args:
+            model (nn.Module): The model, in eval mode.
+            buckets (list[tuple[int]]): (height, width) of the buckets. Default: 480p, 720p and 1080p.
+            backend (str): 'compile' for torch.compile, 'trace' for a frozen TorchScript trace, 'none' to always
+                run the eager model.
+            pad_multiple (int): The bucket sizes are rounded up to a multiple of it, e.g. the window size.
+            max_padding (float): Maximum ratio of the bucket area to the input area.
+            max_graphs (int): Maximum number of compiled graphs. The least recently used traced graphs are
+                dropped, torch.compile runs the eager model for the inputs beyond it.
+        """
+        super().__init__()
+        assert backend in COMPILE_BACKENDS, f'backend should be one of {COMPILE_BACKENDS}.'
+        self.model = model
+        self.train(model.training)
+        self.backend = backend
+        self.pad_multiple = pad_multiple
+        self.max_padding = max_padding
+        self.max_graphs = max_graphs
+        buckets = buckets or parse_buckets('480p,720p,1080p')
+        self.buckets = sorted({(-(-h // pad_multiple) * pad_multiple, -(-w // pad_multiple) * pad_multiple)
+                               for height, width in buckets for h, w in ((height, width), (width, height))},
+                              key=lambda bucket: (bucket[0] * bucket[1], bucket))
+        self._graphs = OrderedDict()
+        self._compiled_keys = set()
+        self._lock = threading.Lock()
+        self._compiled = None
+        if backend == 'compile':
+            # dynamo keeps the graphs of all the wrappers of the model on its code and recompiles per bucket and
+            # batch size, up to cache_size_limit graphs (a global setting, only raised here)
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, max_graphs)
+            self._compiled = torch.compile(model, dynamic=False)
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self._modules['model'], name)
+
+    def get_bucket(self, height, width):
+        """The smallest bucket an input of height x width fits in, None if it fits in none"""
+        for bucket in self.buckets:
+            if bucket[0] >= height and bucket[1] >= width:
+                if bucket[0] * bucket[1] > self.max_padding * height * width:
+                    return None
+                return bucket
+        return None
+
+    def get_graph(self, x):
+        """The compiled graph of the shape, dtype and device of x, compiled on first use
+
+        Traced graphs are kept in a least recently used cache of max_graphs graphs. With torch.compile the
+        compiled model is returned for every input, its graphs are cached and bounded by dynamo.
+        """
+        key = (tuple(x.shape), x.dtype, str(x.device))
+        with self._lock:
+            if key in self._compiled_keys:
+                return self._compiled
+            graph = self._graphs.get(key)
+            if graph is not None:
+                self._graphs.move_to_end(key)
+                return graph
+
+            logger.info(f"Compiling {self.backend} graph for input {tuple(x.shape)} ({x.dtype})")
+            start_time = time.time()
+            with torch.no_grad():
+                if self.backend == 'compile':
+                    graph = self._compiled
+                    graph(x)
+                else:
+                    graph = torch.jit.freeze(torch.jit.trace(self.model, x, check_trace=False))
+                    # the first runs of a frozen graph optimize it
+                    graph(x)
+                    graph(x)
+            logger.info(f"Graph compiled in {time.time() - start_time:.2f} seconds")
+
+            if self.backend == 'compile':
+                self._compiled_keys.add(key)
+                return graph
+            self._graphs[key] = graph
+            while len(self._graphs) > self.max_graphs:
+                self._graphs.popitem(last=False)
+            return graph
+
+    def forward(self, x):
+        if self.backend == 'none' or self.training:
+            return self.model(x)
+        _, _, height, width = x.shape
+        bucket = self.get_bucket(height, width)
+        if bucket is None:
+            return self.model(x)
+
+        pad = (0, bucket[1] - width, 0, bucket[0] - height)
+        # reflection needs a border wider than the padding
+        x = F.pad(x, pad, mode='reflect' if pad[1] < width and pad[3] < height else 'replicate')
+        output = self.get_graph(x)(x)
+        scale = output.shape[-1] // bucket[1]
+        return output[..., :height * scale, :width * scale]
+
+    def warm(self, batch_size=1, channels=3):
+        """Compile the graphs of the buckets, with the dtype and device of the model parameters
+
+        Args:
+            batch_size (int or callable): Batch size of the graphs, or a function of the bucket height and width
+                returning it, e.g. the number of frames of that size that fit in memory.
+            channels (int): Number of input channels.
+        """
+        if self.backend == 'none':
+            return
+        parameter = next(self.model.parameters())
+        for height, width in self.buckets:
+            # the transposed buckets of portrait frames are compiled on first use
+            if height > width:
+                continue
+            size = batch_size(height, width) if callable(batch_size) else batch_size
+            self.get_graph(torch.zeros(size, channels, height, width, dtype=parameter.dtype, device=parameter.device))
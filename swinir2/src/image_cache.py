@@ -0,0 +1,137 @@
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+PARTIAL_PREFIX = '.partial-'
+
+
+class ImageCache:
+    """Size-bounded disk cache of S3 objects, addressed by their bucket, key and ETag.
+
+    An entry is stored in <cache_dir>/<sha256 of the S3 URI>-<ETag>, so objects with the same file name in
+    different jobs never collide, and an object overwritten in S3 (a new ETag) is never served from the cache.
+    The caller revalidates an entry with a conditional GET on its ETag, which transfers no data when the object
+    is unchanged, e.g. for the frames of a retried job.
+
+    Entries are written to a temporary file and renamed, so a crash never leaves a truncated entry behind. The
+    least recently used entries are deleted once the entries exceed max_bytes. Entries left by a previous
+    process are picked up again, ordered by their modification time.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        """Initialize the cache
+
+        Args:
+            cache_dir (str): Directory of the entries, owned by the cache. Created on the first write.
+            max_bytes (int): Maximum bytes of the entries.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # sha256 of the S3 URI -> (ETag, size), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def get_name(s3_uri):
+        return hashlib.sha256(s3_uri.encode()).hexdigest()
+
+    def get_path(self, name, etag):
+        # ETags are quoted hex digests, with a -<parts> suffix for multipart uploads
+        etag = etag.strip('"')
+        return os.path.join(self.cache_dir, f"{name}-{etag}")
+
+    def _load(self):
+        """Index the entries left in the cache directory"""
+        try:
+            files = [entry for entry in os.scandir(self.cache_dir) if entry.is_file()]
+        except FileNotFoundError:
+            return
+        for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+            if entry.name.startswith(PARTIAL_PREFIX):
+                # interrupted write of a previous process
+                os.remove(entry.path)
+                continue
+            name, _, etag = entry.name.partition('-')
+            if len(name) != 64 or not etag:
+                continue
+            if name in self._entries:
+                self._remove(name)
+            size = entry.stat().st_size
+            self._entries[name] = (etag, size)
+            self._bytes += size
+        self._evict_to_budget()
+        logger.info(f"Image cache holds {len(self._entries)} entries, {self._bytes / 1024**2:.1f}MB")
+
+    def get_etag(self, s3_uri):
+        """ETag of the cached entry of an S3 object, None if it is not cached"""
+        with self._lock:
+            entry = self._entries.get(self.get_name(s3_uri))
+            return entry[0] if entry else None
+
+    def get(self, s3_uri, etag):
+        """Content of the cached entry of an S3 object with the ETag, None if it is not cached"""
+        name = self.get_name(s3_uri)
+        etag = etag.strip('"')
+        path = self.get_path(name, etag)
+        with self._lock:
+            if self._entries.get(name, (None,))[0] != etag:
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by another thread in the meantime
+            return None
+        return data
+
+    def put(self, s3_uri, etag, data):
+        """Store the content of a downloaded S3 object, replacing the entry of an older ETag"""
+        name = self.get_name(s3_uri)
+        etag = etag.strip('"')
+        with self._lock:
+            self.misses += 1
+        if len(data) > self.max_bytes:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, prefix=PARTIAL_PREFIX, delete=False) as f:
+            f.write(data)
+        with self._lock:
+            if name in self._entries:
+                self._remove(name)
+            os.replace(f.name, self.get_path(name, etag))
+            self._entries[name] = (etag, len(data))
+            self._bytes += len(data)
+            self._evict_to_budget()
+
+    def _remove(self, name):
+        etag, size = self._entries.pop(name)
+        self._bytes -= size
+        try:
+            os.remove(self.get_path(name, etag))
+        except FileNotFoundError:
+            pass
+
+    def _evict_to_budget(self):
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._entries),
+                'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+    def __len__(self):
+        return len(self._entries)
@@ -3,15 +3,22 @@ import torch.nn as nn
 import json
 from pathlib import Path
 from swinir.load_model import define_model
+from swinir.padding import crop_output, pad_to_multiple
+from swinir.tiling import estimate_tile_memory, select_tile_size, tile_forward
+from compiled_models import CompiledModelCache, parse_buckets
+from image_cache import ImageCache
+from model_registry import ModelRegistry
+from request_codec import (FRAME_CONTENT_TYPES, RequestBatch, decode_frame, encode_frame, parse_content_type,
+                           parse_multipart_frames, serialize_prediction)
+from s3_transport import read_image, write_image
 import numpy as np
 import cv2
 import os
-import boto3
 import io
 import time
 import logging
+from collections.abc import Mapping
 from functools import lru_cache
-from botocore.exceptions import ClientError
 import concurrent.futures
 from typing import List, Dict, Any
 
@@ -19,18 +26,36 @@ from typing import List, Dict, Any
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# S3 client
-s3_client = boto3.client('s3')
-
 # Cache directories
 MODEL_CACHE_DIR = '/tmp/model_cache'
 IMAGE_CACHE_DIR = '/tmp/image_cache'
 os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
 os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
 
-# SwinIR configuration
-scale_factor = 4
-window_size = 8
+# Inputs read from S3 are kept in a disk cache addressed by their S3 key and ETag, so retried frames are
+# revalidated instead of downloaded again. The least recently used inputs are deleted beyond the budget (0: no cache)
+IMAGE_CACHE_BUDGET = int(os.environ.get('IMAGE_CACHE_BUDGET_MB', 1024)) * 1024 * 1024
+image_cache = ImageCache(os.path.join(IMAGE_CACHE_DIR, 's3'), IMAGE_CACHE_BUDGET) if IMAGE_CACHE_BUDGET else None
+
+# WindowAttention backend: 'sdpa' uses the fused F.scaled_dot_product_attention kernels (from torch 2.1 on, older
+# versions use 'math'), 'math' the explicit softmax(QK^T)V of the reference implementation
+SWIN_ATTN_BACKEND = os.environ.get('SWIN_ATTN_BACKEND', 'sdpa').lower()
+# Number of windows attended at once in every Swin2SR block, 0 attends all windows of a frame at once. Chunking
+# caps the attention memory, which lets the tiled inference pick larger tiles.
+SWIN_ATTN_CHUNK_SIZE = int(os.environ.get('SWIN_ATTN_CHUNK_SIZE', 0))
+
+# Tiled inference: frames whose forward would allocate more than the memory budget are split into overlapping
+# window-aligned tiles, SWIN_TILE_BATCH_SIZE tiles per forward. A budget of 0 uses 80% of the free GPU memory
+# and processes whole frames on the CPU.
+SWIN_TILE_MEMORY_BUDGET = int(os.environ.get('SWIN_TILE_MEMORY_BUDGET_MB', 0)) * 1024 * 1024
+SWIN_TILE_OVERLAP = int(os.environ.get('SWIN_TILE_OVERLAP', 32))
+SWIN_TILE_BATCH_SIZE = int(os.environ.get('SWIN_TILE_BATCH_SIZE', 4))
+
+# Frames of the same size and model variant are stacked into forwards of up to SWIN_FRAME_BATCH_SIZE frames,
+# fewer if they do not fit in the memory budget. Stacking only pays off on the GPU, on the CPU one frame per
+# forward is as fast. Reads and writes run on MAX_IO_WORKERS threads.
+SWIN_FRAME_BATCH_SIZE = int(os.environ.get('SWIN_FRAME_BATCH_SIZE', 8 if torch.cuda.is_available() else 1))
+MAX_IO_WORKERS = 4
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -59,17 +84,93 @@ MODEL_VARIANTS = {
     'jpeg_car': {
         'name': 'Swin2SR_ColorJPEG_s126w7_PSNR.pth',
         'description': 'JPEG compression artifact reduction',
-        'scale': 1
+        'scale': 1,
+        # the color checkpoint needs the 3 channel architecture
+        'task': 'color_jpeg_car'
     }
 }
 
 # Default model variant
 DEFAULT_MODEL_VARIANT = 'real_sr'
 
-@lru_cache(maxsize=5)  # Cache up to 5 different models
+# Bytes of model weights kept loaded, least recently used variants are evicted beyond it (0: no limit)
+MODEL_MEMORY_BUDGET = int(os.environ.get('MODEL_MEMORY_BUDGET_MB', 0)) * 1024 * 1024
+
+# Frames are padded into resolution buckets (COMPILE_BUCKETS, e.g. 480p,720p,1080p or 512x512) that each run one
+# graph compiled by COMPILE_BACKEND: 'compile' (torch.compile), 'trace' (frozen TorchScript) or 'none' (eager).
+# With COMPILE_WARMUP the buckets are compiled when a variant is loaded, the default variant is loaded at startup.
+COMPILE_BACKEND = os.environ.get('COMPILE_BACKEND', 'none').lower()
+COMPILE_BUCKETS = parse_buckets(os.environ.get('COMPILE_BUCKETS', '480p,720p,1080p'))
+COMPILE_WARMUP = os.environ.get('COMPILE_WARMUP', 'True').lower() == 'true'
+
+def compile_model(model):
+    """Wrap a model into the compiled graphs of the resolution buckets, compiled now if COMPILE_WARMUP is set"""
+    if COMPILE_BACKEND == 'none':
+        return model
+    # the buckets are window multiples, so the size-dependent masks and padding of the model are fixed per graph
+    model = CompiledModelCache(model, buckets=COMPILE_BUCKETS, backend=COMPILE_BACKEND,
+                               pad_multiple=model.window_size)
+    if COMPILE_WARMUP:
+        model.warm(batch_size=lambda height, width: get_frame_batch_size(model, height, width))
+    return model
+
 def model_fn(model_dir, model_variant=None):
     """
-    Load a SwinIR model with caching for improved performance
+    Get the model registry of a model directory, or one loaded model variant
+
+    Args:
+        model_dir: Directory containing model files
+        model_variant: Model variant to load (one of MODEL_VARIANTS keys), None for the registry of all variants
+
+    Returns:
+        The ModelRegistry with the default variant loaded, or the loaded model of model_variant
+    """
+    models = get_model_registry(model_dir)
+    if model_variant is None:
+        # warm the default variant, the others are loaded when an item first asks for them
+        models[DEFAULT_MODEL_VARIANT]
+        return models
+    return models[resolve_model_variant(model_dir, model_variant)]
+
+@lru_cache(maxsize=None)
+def get_model_registry(model_dir):
+    """Register every model variant of a model directory, each of them is loaded on first use and evicted when
+    the memory budget is exceeded"""
+    logger.info(f"Registering SwinIR model variants from {model_dir}")
+    models = ModelRegistry(memory_budget=MODEL_MEMORY_BUDGET)
+    for model_variant in MODEL_VARIANTS:
+        # items asking for a variant without a model file are routed to the default variant
+        if resolve_model_variant(model_dir, model_variant) != model_variant:
+            continue
+        models.register(model_variant, lambda model_variant=model_variant: load_model(model_dir, model_variant))
+    return models
+
+def resolve_model_variant(model_dir, model_variant):
+    """The variant serving a requested variant: the default one for no, unknown or missing variants"""
+    if model_variant is None:
+        return DEFAULT_MODEL_VARIANT
+    if model_variant not in MODEL_VARIANTS:
+        logger.warning(f"Unknown model variant '{model_variant}'. Using default: {DEFAULT_MODEL_VARIANT}")
+        return DEFAULT_MODEL_VARIANT
+    model_path = os.path.join(model_dir, MODEL_VARIANTS[model_variant]['name'])
+    if not os.path.exists(model_path):
+        logger.warning(f"Model file {model_path} not found. Using default model.")
+        return DEFAULT_MODEL_VARIANT
+    return model_variant
+
+def route_model_variant(model, model_variant):
+    """The registered variant serving an item, None if model is a single model serving every item"""
+    if not isinstance(model, Mapping):
+        return None
+    if model_variant not in model:
+        if model_variant is not None:
+            logger.warning(f"Model variant '{model_variant}' not available. Using default: {DEFAULT_MODEL_VARIANT}")
+        return DEFAULT_MODEL_VARIANT
+    return model_variant
+
+def load_model(model_dir, model_variant=None):
+    """
+    Load a SwinIR model
 
     Args:
         model_dir: Directory containing model files
@@ -78,39 +179,50 @@ def model_fn(model_dir, model_variant=None):
     Returns:
         Loaded model
     """
-    # Use default model variant if none specified
-    if model_variant is None or model_variant not in MODEL_VARIANTS:
-        if model_variant is not None and model_variant not in MODEL_VARIANTS:
-            logger.warning(f"Unknown model variant '{model_variant}'. Using default: {DEFAULT_MODEL_VARIANT}")
-        model_variant = DEFAULT_MODEL_VARIANT
-
-    # Get model configuration
+    model_variant = resolve_model_variant(model_dir, model_variant)
     model_config = MODEL_VARIANTS[model_variant]
-    model_name = model_config['name']
-    model_scale = model_config['scale']
-
-    # Check if model file exists, if not, use the default model
-    model_path = os.path.join(model_dir, model_name)
-    if not os.path.exists(model_path):
-        logger.warning(f"Model file {model_path} not found. Using default model.")
-        model_variant = DEFAULT_MODEL_VARIANT
-        model_config = MODEL_VARIANTS[model_variant]
-        model_name = model_config['name']
-        model_scale = model_config['scale']
-        model_path = os.path.join(model_dir, model_name)
+    model_path = os.path.join(model_dir, model_config['name'])
 
     logger.info(f"Loading SwinIR model variant: {model_variant} ({model_config['description']})")
     logger.info(f"Model path: {model_path}")
 
     # Load the model
-    model = define_model(model_path, model_variant, model_scale)
+    model = define_model(model_path, model_config.get('task', model_variant), model_config['scale'],
+                         cache_dir=MODEL_CACHE_DIR)
     model = model.to(device)
     model.eval()
+    # evaluate the relative position bias MLPs once instead of in every forward
+    model.freeze_attention()
+    model.set_attn_backend(SWIN_ATTN_BACKEND)
+    model.set_attn_chunk_size(SWIN_ATTN_CHUNK_SIZE)
+    model = compile_model(model)
 
     return model
 
+def get_tile_memory_budget():
+    """Bytes a forward may allocate before frames are tiled, None to never tile"""
+    if SWIN_TILE_MEMORY_BUDGET:
+        return SWIN_TILE_MEMORY_BUDGET
+    if device.type == 'cuda':
+        free_memory, _ = torch.cuda.mem_get_info(device)
+        return int(free_memory * 0.8)
+    return None
+
 def input_fn(request_body, request_content_type):
-    if request_content_type == "application/json":
+    """Deserialize a request: JSON with file paths, an inline frame (image/png, image/jpeg, application/x-npy) or a
+    multipart/form-data batch of inline frames. Inline frames are upscaled into the response body, in the format
+    they were sent in."""
+    content_type, _ = parse_content_type(request_content_type)
+    if content_type in FRAME_CONTENT_TYPES:
+        logger.info("Received inline image request")
+        return [{'image': decode_frame(request_body, content_type, cv2.IMREAD_COLOR), 'output_format': content_type,
+                 'job_id': 'inline', 'batch_id': 0}]
+    if content_type == "multipart/form-data":
+        fields, frames = parse_multipart_frames(request_body, request_content_type, cv2.IMREAD_COLOR)
+        logger.info(f"Received inline batch request with {len(frames)} images")
+        return [{'job_id': 'inline', **fields, 'batch_id': i, 'image': frame['image'],
+                 'output_format': frame['output_format']} for i, frame in enumerate(frames)]
+    if content_type == "application/json":
         data = json.loads(request_body)
         # Support both single image and batch processing
         if isinstance(data, list):
@@ -122,103 +234,45 @@ def input_fn(request_body, request_content_type):
     raise ValueError("Unsupported content type: {}".format(request_content_type))
 
 
-def download_from_s3(s3_uri, local_path):
-    """Download a file from S3 to a local path with caching"""
-    # Check if file already exists in cache
-    if os.path.exists(local_path):
-        logger.info(f"Using cached file: {local_path}")
-        return local_path
+def output_fn(prediction, accept):
+    """Serialize a prediction, inline outputs are returned as images instead of JSON"""
+    return serialize_prediction(prediction, prediction if isinstance(prediction, list) else [prediction])
 
-    try:
-        # Parse S3 URI
-        if s3_uri.startswith('s3://'):
-            parts = s3_uri[5:].split('/', 1)
-            bucket = parts[0]
-            key = parts[1] if len(parts) > 1 else ''
-        else:
-            # Assume it's a local file
-            return s3_uri
-
-        # Create directory if it doesn't exist
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-
-        # Download file
-        logger.info(f"Downloading {s3_uri} to {local_path}")
-        start_time = time.time()
-        s3_client.download_file(bucket, key, local_path)
-        elapsed = time.time() - start_time
-        logger.info(f"Download completed in {elapsed:.2f} seconds")
-
-        return local_path
-    except ClientError as e:
-        logger.error(f"Error downloading file from S3: {e}")
-        raise
-
-def upload_to_s3(local_path, s3_uri):
-    """Upload a file from a local path to S3"""
-    try:
-        # Parse S3 URI
-        if s3_uri.startswith('s3://'):
-            parts = s3_uri[5:].split('/', 1)
-            bucket = parts[0]
-            key = parts[1] if len(parts) > 1 else ''
-        else:
-            # If not an S3 URI, just return the local path
-            return local_path
-
-        # Upload file
-        logger.info(f"Uploading {local_path} to {s3_uri}")
-        start_time = time.time()
-        s3_client.upload_file(local_path, bucket, key)
-        elapsed = time.time() - start_time
-        logger.info(f"Upload completed in {elapsed:.2f} seconds")
 
-        return s3_uri
-    except ClientError as e:
-        logger.error(f"Error uploading file to S3: {e}")
-        raise
+def predict_fn(input_data_batch, model):
+    """Process a batch of images with SwinIR model, stacking frames of the same size and variant into batched
+    forwards. model is the ModelRegistry of model_fn, which routes every item to its model_variant, or a single
+    model serving every item.
+
+    A RequestBatch holds the items of the requests that the model server batched, they are processed together
+    and one prediction is returned per request."""
+    if isinstance(input_data_batch, RequestBatch):
+        results = predict_items([item for request in input_data_batch for item in request], model)
+        predictions = []
+        for request in input_data_batch:
+            request_results, results = results[:len(request)], results[len(request):]
+            predictions.append(request_results[0] if len(request) == 1 else request_results)
+        return predictions
+
+    results = predict_items(input_data_batch, model)
+
+    # For a single image, return its result directly
+    if len(input_data_batch) == 1:
+        return results[0]
+    return results
 
+def predict_items(input_items, model):
+    """Process the items of one or more requests with process_batch
 
-def predict_fn(input_data_batch, model):
-    """Process a batch of images with SwinIR model using parallel processing"""
+    Returns:
+        list[dict]: One result per input item, the error of the batch for every item if it failed.
+    """
     start_time = time.time()
-    batch_size = len(input_data_batch)
+    batch_size = len(input_items)
     logger.info(f"Processing batch of {batch_size} images")
 
-    # For small batches, process sequentially
-    if batch_size == 1:
-        result = process_single_image(input_data_batch[0], model)
-        elapsed = time.time() - start_time
-        logger.info(f"Processed 1 image in {elapsed:.2f} seconds")
-        return result
-
-    # For larger batches, use parallel processing
-    results = []
-    max_workers = min(batch_size, 4)  # Limit max workers to avoid GPU memory issues
-
     try:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # Submit all tasks
-            future_to_item = {
-                executor.submit(process_single_image, item, model): item 
-                for item in input_data_batch
-            }
-
-            # Collect results as they complete
-            for future in concurrent.futures.as_completed(future_to_item):
-                item = future_to_item[future]
-                try:
-                    result = future.result()
-                    results.append(result)
-                    logger.info(f"Completed processing for job_id: {item.get('job_id', 'unknown')}")
-                except Exception as e:
-                    logger.error(f"Error processing item {item.get('job_id', 'unknown')}: {e}")
-                    results.append({
-                        "status": 500,
-                        "error": str(e),
-                        "job_id": item.get('job_id', 'unknown'),
-                        "batch_id": item.get('batch_id', 'unknown')
-                    })
+        results = process_batch(input_items, model)
     except Exception as e:
         logger.error(f"Error in batch processing: {e}")
         return [{
@@ -226,112 +280,188 @@ def predict_fn(input_data_batch, model):
             "error": f"Batch processing error: {str(e)}",
             "job_id": "batch",
             "batch_id": "batch"
-        }]
+        }] * batch_size
 
     elapsed = time.time() - start_time
     logger.info(f"Processed {len(results)} images in {elapsed:.2f} seconds ({elapsed/len(results):.2f} seconds per image)")
-
     return results
 
-def process_single_image(input_item, model):
-    """Process a single image with SwinIR model"""
-    # Extract input parameters
-    input_file_path = input_item['input_file_path']
-    output_file_path = input_item['output_file_path']
-    job_id = input_item['job_id']
-    batch_id = input_item['batch_id']
+def process_batch(input_items, model):
+    """Process a list of images with batched forwards.
+
+    The frames are downloaded and read on a thread pool, grouped by (shape, model variant, tile size), stacked
+    along the batch dimension and pushed through one forward per group (split into chunks of at most
+    get_frame_batch_size frames). The model of a variant is looked up in the registry once per group, which
+    loads it on first use. The outputs are split per item and written on the thread pool again.
+
+    Returns:
+        list[dict]: One result per input item, in the order of the input items.
+    """
+    results = [None] * len(input_items)
+    max_workers = min(len(input_items), MAX_IO_WORKERS)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        frames = list(executor.map(read_input, input_items))
+
+        groups = {}
+        for index, (item, frame) in enumerate(zip(input_items, frames)):
+            if isinstance(frame, dict):
+                # reading failed, frame is the error result
+                results[index] = frame
+                continue
+            key = (frame.shape, route_model_variant(model, item.get('model_variant')), item.get('tile_size'))
+            groups.setdefault(key, []).append(index)
+
+        write_futures = {}
+        for (shape, model_variant, tile_size), indices in groups.items():
+            try:
+                variant_model = model if model_variant is None else model[model_variant]
+                frame_batch_size = get_frame_batch_size(variant_model, shape[1], shape[2])
+            except Exception as e:
+                logger.error(f"Error loading model variant {model_variant}: {e}")
+                for index in indices:
+                    item = input_items[index]
+                    results[index] = {"status": 500, "error": str(e), "job_id": item['job_id'],
+                                      "batch_id": item['batch_id']}
+                continue
+            logger.info(f"Processing {len(indices)} frames of size {shape[1]}x{shape[2]} "
+                        f"with {model_variant or 'the given model'} in batches of {frame_batch_size}")
+            for i in range(0, len(indices), frame_batch_size):
+                chunk = indices[i:i + frame_batch_size]
+                try:
+                    img_lq = torch.from_numpy(np.stack([frames[index] for index in chunk])).to(device)
+                    outputs = enhance(variant_model, img_lq, tile_size)
+                except Exception as e:
+                    logger.error(f"Error processing image: {e}")
+                    for index in chunk:
+                        item = input_items[index]
+                        results[index] = {"status": 500, "error": str(e), "job_id": item['job_id'],
+                                          "batch_id": item['batch_id']}
+                    continue
+                for index, output in zip(chunk, outputs):
+                    write_futures[executor.submit(write_output, input_items[index], output)] = index
+
+        for future in concurrent.futures.as_completed(write_futures):
+            index = write_futures[future]
+            item = input_items[index]
+            try:
+                results[index] = future.result()
+                logger.info(f"Completed processing for job_id: {item.get('job_id', 'unknown')}")
+            except Exception as e:
+                logger.error(f"Error processing item {item.get('job_id', 'unknown')}: {e}")
+                results[index] = {"status": 500, "error": str(e), "job_id": item.get('job_id', 'unknown'),
+                                  "batch_id": item.get('batch_id', 'unknown')}
 
-    # Get model variant if specified
-    model_variant = input_item.get('model_variant', None)
+    return results
 
-    # Handle S3 paths
-    is_s3_input = input_file_path.startswith('s3://')
-    is_s3_output = output_file_path.startswith('s3://')
+def get_frame_batch_size(model, height, width):
+    """Number of frames of a size stacked into one forward, bounded by the memory budget of the forwards"""
+    memory_budget = get_tile_memory_budget()
+    if not memory_budget:
+        return SWIN_FRAME_BATCH_SIZE
+    frame_memory = estimate_tile_memory(model, height, width)
+    return max(1, min(SWIN_FRAME_BATCH_SIZE, memory_budget // frame_memory))
 
-    # Create local file paths for caching
-    imgname, extension = os.path.splitext(os.path.basename(input_file_path))
-    local_input_path = os.path.join(IMAGE_CACHE_DIR, f"{imgname}{extension}")
-    local_output_path = os.path.join(IMAGE_CACHE_DIR, f"{imgname}_upscaled{extension}")
+def read_input(input_item):
+    """Download and read the input image of an item.
 
-    # Download from S3 if needed
-    if is_s3_input:
-        try:
-            input_file_path = download_from_s3(input_file_path, local_input_path)
-        except Exception as e:
-            logger.error(f"Failed to download input file: {e}")
-            return {"status": 500, "error": str(e), "job_id": job_id, "batch_id": batch_id}
+    Returns:
+        np.ndarray: The image as a float32 CHW-RGB array, or the error result of the item if it failed.
+    """
+    job_id = input_item['job_id']
+    batch_id = input_item['batch_id']
 
-    # Read the image
+    # Read the image, S3 objects are decoded in memory and inline frames were decoded by input_fn
     try:
-        img_lq = cv2.imread(input_file_path, cv2.IMREAD_COLOR)
-        if img_lq is None:
-            raise ValueError(f"Failed to read image from {input_file_path}")
+        if 'image' in input_item:
+            img_lq = input_item['image']
+            # npy frames may come in another channel layout, bring them to the BGR of cv2.IMREAD_COLOR
+            if img_lq.ndim == 3 and img_lq.shape[2] == 1:
+                img_lq = img_lq[:, :, 0]
+            if img_lq.ndim == 2:
+                img_lq = cv2.cvtColor(img_lq, cv2.COLOR_GRAY2BGR)
+            elif img_lq.shape[2] == 4:
+                img_lq = cv2.cvtColor(img_lq, cv2.COLOR_BGRA2BGR)
+            elif img_lq.shape[2] != 3:
+                raise ValueError(f"Unsupported frame shape: {img_lq.shape}")
+        else:
+            input_file_path = input_item['input_file_path']
+            img_lq = read_image(input_file_path, cv2.IMREAD_COLOR, cache=image_cache)
+            if img_lq is None:
+                raise ValueError(f"Failed to read image from {input_file_path}")
         img_lq = img_lq.astype(np.float32) / 255.
     except Exception as e:
         logger.error(f"Error reading image: {e}")
         return {"status": 500, "error": str(e), "job_id": job_id, "batch_id": batch_id}
 
-    # Process the image
-    try:
-        img_lq = np.transpose(img_lq if img_lq.shape[2] == 1 else img_lq[:, :, [2, 1, 0]], (2, 0, 1))  # HCW-BGR to CHW-RGB
-        img_lq = torch.from_numpy(img_lq).float().unsqueeze(0).to(device)  # CHW-RGB to NCHW-RGB
-
-        with torch.no_grad():
-            # pad input image to be a multiple of window_size
-            _, _, h_old, w_old = img_lq.size()
-            h_pad = (h_old // window_size + 1) * window_size - h_old
-            w_pad = (w_old // window_size + 1) * window_size - w_old
-            img_lq = torch.cat([img_lq, torch.flip(img_lq, [2])], 2)[:, :, :h_old + h_pad, :]
-            img_lq = torch.cat([img_lq, torch.flip(img_lq, [3])], 3)[:, :, :, :w_old + w_pad]
-            logger.info(f"Image input size: {img_lq.shape}")
+    return np.ascontiguousarray(np.transpose(img_lq[:, :, [2, 1, 0]], (2, 0, 1)))  # HCW-BGR to CHW-RGB
+
+def enhance(model, img_lq, tile_size=None):
+    """Run the model on a batch of frames of the same size.
 
+    Args:
+        model: The SwinIR model.
+        img_lq (Tensor): Frames of shape (N, C, H, W) on the model device.
+        tile_size (int): Tile size, None to pick it from the memory budget.
+
+    Returns:
+        np.ndarray: Output frames of shape (N, H * scale, W * scale, C) as uint8 HWC-BGR.
+    """
+    with torch.no_grad():
+        n, _, h_old, w_old = img_lq.size()
+        tile_size = tile_size or select_tile_size(
+            model, h_old, w_old, get_tile_memory_budget(), SWIN_TILE_BATCH_SIZE, SWIN_TILE_OVERLAP)
+        if tile_size:
+            # accumulate the tiles on the CPU, the output is copied there anyway
+            logger.info(f"Image input size: {img_lq.shape}, using tiles of {tile_size} pixels")
+            output = tile_forward(model, img_lq, tile_size, tile_overlap=SWIN_TILE_OVERLAP,
+                                  batch_size=SWIN_TILE_BATCH_SIZE, output_device=torch.device('cpu'))
+        elif isinstance(model, CompiledModelCache):
+            # the compiled model pads the frames into its resolution bucket
+            logger.info(f"Image input size: {img_lq.shape}")
             output = model(img_lq)
-            output = output[..., :h_old * scale_factor, :w_old * scale_factor]
+        else:
+            # pad the frames once to the next multiple of the window size, the model then does not pad them again
+            img_lq = pad_to_multiple(img_lq, model.window_size)
+            logger.info(f"Image input size: {img_lq.shape}")
 
-            output = output.data.squeeze().float().cpu().clamp_(0, 1).numpy()
-            if output.ndim == 3:
-                output = np.transpose(output[[2, 1, 0], :, :], (1, 2, 0))  # CHW-RGB to HCW-BGR
-            output = (output * 255.0).round().astype(np.uint8)  # float32 to uint8
-    except Exception as e:
-        logger.error(f"Error processing image: {e}")
-        return {"status": 500, "error": str(e), "job_id": job_id, "batch_id": batch_id}
+            output = crop_output(model(img_lq), h_old, w_old, model.upscale)
+
+        # float32 to uint8 on the model device, before the copy to the CPU
+        output = output.float().clamp_(0, 1).mul_(255.0).round_().to(torch.uint8)
+        if output.shape[1] == 3:
+            output = output[:, [2, 1, 0]]  # RGB to BGR
+        return output.permute(0, 2, 3, 1).cpu().numpy()  # NCHW to NHWC
+
+def write_output(input_item, output):
+    """Write an output image to the output path of the item, S3 objects are encoded in memory and uploaded.
+    Inline frames are encoded into the result, to be returned in the response body."""
+    job_id = input_item['job_id']
+    batch_id = input_item['batch_id']
 
-    # Save the output locally
     try:
-        cv2.imwrite(local_output_path, output)
-        logger.info(f"Saved output to {local_output_path}")
+        if 'output_file_path' in input_item:
+            output_file_path = write_image(input_item['output_file_path'], output)
+            logger.info(f"Saved output to {output_file_path}")
+            result = {"output_file_path": output_file_path}
+        else:
+            result = {"image": encode_frame(output, input_item['output_format']),
+                      "content_type": input_item['output_format']}
     except Exception as e:
         logger.error(f"Error saving output image: {e}")
         return {"status": 500, "error": str(e), "job_id": job_id, "batch_id": batch_id}
 
-    # Upload to S3 if needed
-    if is_s3_output:
-        try:
-            output_file_path = upload_to_s3(local_output_path, output_file_path)
-        except Exception as e:
-            logger.error(f"Failed to upload output file: {e}")
-            return {"status": 500, "error": str(e), "job_id": job_id, "batch_id": batch_id}
-    elif local_output_path != output_file_path:
-        # Copy to the specified output path if different from cache path
-        try:
-            import shutil
-            shutil.copy2(local_output_path, output_file_path)
-            logger.info(f"Copied output to {output_file_path}")
-        except Exception as e:
-            logger.error(f"Error copying output file: {e}")
-            return {"status": 500, "error": str(e), "job_id": job_id, "batch_id": batch_id}
-
-    # Clean up GPU memory
-    torch.cuda.empty_cache()
-    logger.info("Torch cache cleared")
-
     return {
         "status": 200,
-        "output_file_path": output_file_path,
+        **result,
         "job_id": job_id,
         "batch_id": batch_id
     }
 
+def process_single_image(input_item, model):
+    """Process a single image with SwinIR model"""
+    return process_batch([input_item], model)[0]
+
 
 if __name__ == "__main__":
     # Configure logging
@@ -1,11 +1,56 @@
 import glob
+import hashlib
 import numpy as np
 import os
 import torch
 
 from .network_swin2sr import Swin2SR as net
 
-def define_model(model_path, task, scale):
+try:
+    from safetensors.torch import load_file as load_safetensors
+    from safetensors.torch import save_file as save_safetensors
+except ImportError:
+    load_safetensors = save_safetensors = None
+
+
+def load_cached_state_dict(model_path, param_key, cache_dir=None):
+    """Load the weights of a checkpoint through a safetensors weight cache.
+
+    The first load writes the weights under param_key (or the whole checkpoint if the key is missing) to
+    cache_dir as a safetensors file. Later loads memory-map it, which skips unpickling and shares the pages
+    between the worker processes of a node. The cache file name contains the size and mtime of the checkpoint.
+    Without cache_dir or the safetensors package the checkpoint is loaded with torch.load.
+    """
+    cache_path = None
+    if cache_dir is not None and save_safetensors is not None:
+        stat = os.stat(model_path)
+        digest = hashlib.sha1(
+            f'{os.path.abspath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}:{param_key}'.encode()).hexdigest()[:12]
+        name = os.path.splitext(os.path.basename(model_path))[0]
+        cache_path = os.path.join(cache_dir, f'{name}.{digest}.safetensors')
+        if os.path.exists(cache_path):
+            try:
+                return load_safetensors(cache_path)
+            except Exception as error:
+                print(f'Ignoring unreadable weight cache {cache_path}: {error}')
+
+    pretrained_model = torch.load(model_path, map_location='cpu')
+    state_dict = pretrained_model[param_key] if param_key in pretrained_model.keys() else pretrained_model
+
+    if cache_path is not None:
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            save_safetensors({k: v.clone().contiguous() for k, v in state_dict.items()}, tmp_path)
+            os.replace(tmp_path, cache_path)
+        except Exception as error:
+            print(f'Failed to write weight cache {cache_path}: {error}')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return state_dict
+
+
+def define_model(model_path, task, scale, cache_dir=None):
     # 001 classical image sr
     if task == 'classical_sr':
         model = net(upscale=scale, in_chans=3, img_size=128, window_size=8,
@@ -58,8 +103,12 @@ def define_model(model_path, task, scale):
                     mlp_ratio=2, upsampler='', resi_connection='1conv')
         param_key_g = 'params'
 
-    pretrained_model = torch.load(model_path)
-    model.load_state_dict(pretrained_model[param_key_g] if param_key_g in pretrained_model.keys() else pretrained_model, strict=True)
+    state_dict = load_cached_state_dict(model_path, param_key_g, cache_dir)
+    try:
+        # take over the memory-mapped tensors instead of copying them
+        model.load_state_dict(state_dict, strict=True, assign=True)
+    except TypeError:
+        model.load_state_dict(state_dict, strict=True)
 
     return model
 
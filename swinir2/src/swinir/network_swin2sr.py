@@ -4,6 +4,9 @@
 # -----------------------------------------------------------------------------------
 
 import math
+import threading
+from collections import OrderedDict
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -11,6 +14,8 @@ import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 
+from .padding import pad_to_multiple
+
 
 class Mlp(nn.Module):
     def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.):
@@ -60,6 +65,131 @@ def window_reverse(windows, window_size, H, W):
     x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, H, W, -1)
     return x
 
+
+def calculate_mask(x_size, window_size, shift_size):
+    """
+    Args:
+        x_size (tuple[int]): Height and width of the feature map
+        window_size (int): Window size
+        shift_size (int): Shift size for SW-MSA
+    Returns:
+        attn_mask: (num_windows, window_size*window_size, window_size*window_size)
+    """
+    # calculate attention mask for SW-MSA
+    H, W = x_size
+    img_mask = torch.zeros((1, H, W, 1))  # 1 H W 1
+    h_slices = (slice(0, -window_size),
+                slice(-window_size, -shift_size),
+                slice(-shift_size, None))
+    w_slices = (slice(0, -window_size),
+                slice(-window_size, -shift_size),
+                slice(-shift_size, None))
+    cnt = 0
+    for h in h_slices:
+        for w in w_slices:
+            img_mask[:, h, w, :] = cnt
+            cnt += 1
+
+    mask_windows = window_partition(img_mask, window_size)  # nW, window_size, window_size, 1
+    mask_windows = mask_windows.view(-1, window_size * window_size)
+    attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
+    attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+
+    return attn_mask
+
+
+def calculate_window_index(x_size, window_size, shift_size):
+    """
+    Args:
+        x_size (tuple[int]): Height and width of the feature map
+        window_size (int): Window size
+        shift_size (int): Shift size for SW-MSA
+    Returns:
+        partition_index: (H*W) index of the flattened feature map that gathers the cyclically shifted windows,
+            x.index_select(1, partition_index) equals window_partition(torch.roll(x, -shift_size)) for x of (B, H*W, C)
+        reverse_index: (H*W) inverse of partition_index, which gathers the windows back into the unshifted feature map
+    """
+    H, W = x_size
+    h = torch.arange(H).view(H // window_size, 1, window_size, 1)
+    w = torch.arange(W).view(1, W // window_size, 1, window_size)
+    partition_index = (((h + shift_size) % H) * W + (w + shift_size) % W).reshape(-1)
+    reverse_index = torch.empty_like(partition_index)
+    reverse_index[partition_index] = torch.arange(H * W)
+    return partition_index, reverse_index
+
+
+class AttnMaskCache:
+    r""" Bounded LRU cache of SW-MSA attention masks shared by all blocks.
+    Every shifted block of every RSTB needs the same mask for a given feature size, so it is built and copied
+    to the device once per (H, W, window_size, shift_size, device) instead of once per block and frame.
+    The cached masks are shared and must not be modified in place.
+    Args:
+        maxsize (int): Maximum number of cached masks. Default: 32
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._masks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, x_size, window_size, shift_size, device):
+        key = (x_size[0], x_size[1], window_size, shift_size, str(torch.device(device)))
+        with self._lock:
+            attn_mask = self._masks.get(key)
+            if attn_mask is not None:
+                self._masks.move_to_end(key)
+                self.hits += 1
+                return attn_mask
+            self.misses += 1
+
+        attn_mask = self.calculate(x_size, window_size, shift_size, device)
+        with self._lock:
+            self._masks[key] = attn_mask
+            self._masks.move_to_end(key)
+            while len(self._masks) > self.maxsize:
+                self._masks.popitem(last=False)
+        return attn_mask
+
+    def calculate(self, x_size, window_size, shift_size, device):
+        return calculate_mask(x_size, window_size, shift_size).to(device)
+
+    def clear(self):
+        with self._lock:
+            self._masks.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._masks), 'maxsize': self.maxsize}
+
+    def __len__(self):
+        return len(self._masks)
+
+
+class WindowIndexCache(AttnMaskCache):
+    r""" Bounded LRU cache of the gather indices that fuse the cyclic shift with the window partition and reverse.
+    One index_select replaces torch.roll, the permute copy of window_partition, and again the permute copy of
+    window_reverse and the reverse torch.roll, which each copy the whole feature map in every block.
+    Args:
+        maxsize (int): Maximum number of cached indices. Default: 32
+    """
+
+    def calculate(self, x_size, window_size, shift_size, device):
+        return tuple(index.to(device) for index in calculate_window_index(x_size, window_size, shift_size))
+
+
+attn_mask_cache = AttnMaskCache()
+window_index_cache = WindowIndexCache()
+
+# F.scaled_dot_product_attention was added in torch 2.0, but before 2.1 its memory efficient kernel takes no
+# attn_mask. Every Swin2SR attention has a mask (the relative position bias), so on torch 2.0 it always falls back
+# to the math kernel and saves no memory, the 'sdpa' backend is only used from torch 2.1 on.
+TORCH_VERSION = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2])
+SDPA_AVAILABLE = hasattr(F, 'scaled_dot_product_attention') and TORCH_VERSION >= (2, 1)
+ATTN_BACKENDS = ('math', 'sdpa')
+
 class WindowAttention(nn.Module):
     r""" Window based multi-head self attention (W-MSA) module with relative position bias.
     It supports both of shifted and non-shifted window.
@@ -132,6 +262,52 @@ class WindowAttention(nn.Module):
         self.proj_drop = nn.Dropout(proj_drop)
         self.softmax = nn.Softmax(dim=-1)
 
+        # 'math' computes the attention step by step, 'sdpa' uses F.scaled_dot_product_attention if available
+        self.attn_backend = 'math'
+
+        # input independent terms precomputed by freeze() for inference
+        self.register_buffer("frozen_qkv_bias", None, persistent=False)
+        self.register_buffer("frozen_logit_scale", None, persistent=False)
+        self.register_buffer("frozen_relative_position_bias", None, persistent=False)
+
+    def get_qkv_bias(self):
+        if self.q_bias is None:
+            return None
+        return torch.cat((self.q_bias, torch.zeros_like(self.v_bias, requires_grad=False), self.v_bias))
+
+    def get_logit_scale(self):
+        return torch.clamp(self.logit_scale, max=torch.log(torch.tensor(1. / 0.01)).to(self.logit_scale.device)).exp()
+
+    def get_relative_position_bias(self):
+        relative_position_bias_table = self.cpb_mlp(self.relative_coords_table).view(-1, self.num_heads)
+        relative_position_bias = relative_position_bias_table[self.relative_position_index.view(-1)].view(
+            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
+        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        relative_position_bias = 16 * torch.sigmoid(relative_position_bias)
+        return relative_position_bias.unsqueeze(0)  # 1, nH, Wh*Ww, Wh*Ww
+
+    @property
+    def frozen(self):
+        return self.frozen_relative_position_bias is not None
+
+    @torch.no_grad()
+    def freeze(self):
+        """Evaluate the cpb_mlp bias, the clamped logit_scale exponent and the qkv bias once, so that they are
+        not recomputed in every forward. They go stale if the weights change, train() unfreezes."""
+        self.frozen_qkv_bias = self.get_qkv_bias()
+        self.frozen_logit_scale = self.get_logit_scale()
+        self.frozen_relative_position_bias = self.get_relative_position_bias()
+
+    def unfreeze(self):
+        self.frozen_qkv_bias = None
+        self.frozen_logit_scale = None
+        self.frozen_relative_position_bias = None
+
+    def train(self, mode=True):
+        if mode:
+            self.unfreeze()
+        return super().train(mode)
+
     def forward(self, x, mask=None):
         """
         Args:
@@ -139,24 +315,29 @@ class WindowAttention(nn.Module):
             mask: (0/-inf) mask with shape of (num_windows, Wh*Ww, Wh*Ww) or None
         """
         B_, N, C = x.shape
-        qkv_bias = None
-        if self.q_bias is not None:
-            qkv_bias = torch.cat((self.q_bias, torch.zeros_like(self.v_bias, requires_grad=False), self.v_bias))
+        if self.frozen:
+            qkv_bias = self.frozen_qkv_bias
+            logit_scale = self.frozen_logit_scale
+            relative_position_bias = self.frozen_relative_position_bias
+        else:
+            qkv_bias = self.get_qkv_bias()
+            logit_scale = self.get_logit_scale()
+            relative_position_bias = self.get_relative_position_bias()
         qkv = F.linear(input=x, weight=self.qkv.weight, bias=qkv_bias)
         qkv = qkv.reshape(B_, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
+        if self.attn_backend == 'sdpa' and SDPA_AVAILABLE:
+            x = self.sdpa_attention(q, k, v, logit_scale, relative_position_bias, mask)
+            x = x.transpose(1, 2).reshape(B_, N, C)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x
+
         # cosine attention
         attn = (F.normalize(q, dim=-1) @ F.normalize(k, dim=-1).transpose(-2, -1))
-        logit_scale = torch.clamp(self.logit_scale, max=torch.log(torch.tensor(1. / 0.01)).to(self.logit_scale.device)).exp()
         attn = attn * logit_scale
-
-        relative_position_bias_table = self.cpb_mlp(self.relative_coords_table).view(-1, self.num_heads)
-        relative_position_bias = relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-        relative_position_bias = 16 * torch.sigmoid(relative_position_bias)
-        attn = attn + relative_position_bias.unsqueeze(0)
+        attn = attn + relative_position_bias
 
         if mask is not None:
             nW = mask.shape[0]
@@ -173,6 +354,34 @@ class WindowAttention(nn.Module):
         x = self.proj_drop(x)
         return x
 
+    def sdpa_attention(self, q, k, v, logit_scale, relative_position_bias, mask=None):
+        """Cosine attention through F.scaled_dot_product_attention, which fuses the matmuls, softmax and
+        dropout instead of materializing every intermediate (num_windows*B, nH, N, N) tensor.
+        The logit scale is folded into q (times sqrt(head_dim) to undo the default 1/sqrt(head_dim) scaling),
+        the relative position bias and the mask into one additive attn_mask.
+        Args:
+            q, k, v: (num_windows*B, nH, N, head_dim)
+            logit_scale: (nH, 1, 1)
+            relative_position_bias: (1, nH, N, N)
+            mask: (0/-inf) mask with shape of (num_windows, N, N) or None
+        Returns:
+            x: (num_windows*B, nH, N, head_dim)
+        """
+        B_, nH, N, head_dim = q.shape
+        q = F.normalize(q, dim=-1) * (logit_scale * math.sqrt(head_dim))
+        k = F.normalize(k, dim=-1)
+        attn_mask = relative_position_bias.to(q.dtype)
+        if mask is not None:
+            nW = mask.shape[0]
+            # fold the windows into the heads, so that the mask broadcasts over the batch of a 4D attention,
+            # which the fused kernels handle much better than an extra batch dimension
+            attn_mask = (attn_mask + mask.unsqueeze(1).to(q.dtype)).view(1, nW * nH, N, N)
+            q, k, v = (t.reshape(B_ // nW, nW * nH, N, head_dim) for t in (q, k, v))
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask,
+                                           dropout_p=self.attn_drop.p if self.training else 0.)
+        # the fused kernels may return strides of another layout, which the window fold cannot view
+        return x.reshape(B_, nH, N, head_dim)
+
     def extra_repr(self) -> str:
         return f'dim={self.dim}, window_size={self.window_size}, ' \
                f'pretrained_window_size={self.pretrained_window_size}, num_heads={self.num_heads}'
@@ -241,29 +450,12 @@ class SwinTransformerBlock(nn.Module):
             attn_mask = None
 
         self.register_buffer("attn_mask", attn_mask)
+        # number of windows per WindowAttention call, 0 attends all windows at once
+        self.attn_chunk_size = 0
         
     def calculate_mask(self, x_size):
         # calculate attention mask for SW-MSA
-        H, W = x_size
-        img_mask = torch.zeros((1, H, W, 1))  # 1 H W 1
-        h_slices = (slice(0, -self.window_size),
-                    slice(-self.window_size, -self.shift_size),
-                    slice(-self.shift_size, None))
-        w_slices = (slice(0, -self.window_size),
-                    slice(-self.window_size, -self.shift_size),
-                    slice(-self.shift_size, None))
-        cnt = 0
-        for h in h_slices:
-            for w in w_slices:
-                img_mask[:, h, w, :] = cnt
-                cnt += 1
-
-        mask_windows = window_partition(img_mask, self.window_size)  # nW, window_size, window_size, 1
-        mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-        attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-        attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
-
-        return attn_mask        
+        return calculate_mask(x_size, self.window_size, self.shift_size)
 
     def forward(self, x, x_size):
         H, W = x_size
@@ -271,34 +463,22 @@ class SwinTransformerBlock(nn.Module):
         #assert L == H * W, "input feature has wrong size"
 
         shortcut = x
-        x = x.view(B, H, W, C)
 
-        # cyclic shift
-        if self.shift_size > 0:
-            shifted_x = torch.roll(x, shifts=(-self.shift_size, -self.shift_size), dims=(1, 2))
-        else:
-            shifted_x = x
-
-        # partition windows
-        x_windows = window_partition(shifted_x, self.window_size)  # nW*B, window_size, window_size, C
+        # cyclic shift and partition windows in one gather
+        partition_index, reverse_index = window_index_cache.get(x_size, self.window_size, self.shift_size, x.device)
+        x_windows = x.index_select(1, partition_index)  # B, nW*window_size*window_size, C
         x_windows = x_windows.view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C
 
         # W-MSA/SW-MSA (to be compatible for testing on images whose shapes are the multiple of window size
         if self.input_resolution == x_size:
-            attn_windows = self.attn(x_windows, mask=self.attn_mask)  # nW*B, window_size*window_size, C
+            attn_windows = self.window_attention(x_windows, mask=self.attn_mask)  # nW*B, window_size*window_size, C
         else:
-            attn_windows = self.attn(x_windows, mask=self.calculate_mask(x_size).to(x.device))
+            # the mask of an unshifted block is all zeros
+            mask = attn_mask_cache.get(x_size, self.window_size, self.shift_size, x.device) if self.shift_size > 0 else None
+            attn_windows = self.window_attention(x_windows, mask=mask)
             
-        # merge windows
-        attn_windows = attn_windows.view(-1, self.window_size, self.window_size, C)
-        shifted_x = window_reverse(attn_windows, self.window_size, H, W)  # B H' W' C
-
-        # reverse cyclic shift
-        if self.shift_size > 0:
-            x = torch.roll(shifted_x, shifts=(self.shift_size, self.shift_size), dims=(1, 2))
-        else:
-            x = shifted_x
-        x = x.view(B, H * W, C)
+        # merge windows and reverse cyclic shift in one gather
+        x = attn_windows.view(B, H * W, C).index_select(1, reverse_index)
         x = shortcut + self.drop_path(self.norm1(x))
 
         # FFN
@@ -306,6 +486,32 @@ class SwinTransformerBlock(nn.Module):
 
         return x
 
+    def window_attention(self, x_windows, mask=None):
+        """Run WindowAttention over chunks of attn_chunk_size windows, writing the results into one preallocated
+        output, so that the qkv and attention scores are only materialized for one chunk at a time.
+        Args:
+            x_windows: (num_windows*B, N, C)
+            mask: (0/-inf) mask with shape of (num_windows, N, N) or None
+        """
+        num_windows = x_windows.shape[0]
+        chunk_size = self.attn_chunk_size
+        if not chunk_size or chunk_size >= num_windows:
+            return self.attn(x_windows, mask=mask)
+
+        attn_windows = torch.empty_like(x_windows)
+        for start in range(0, num_windows, chunk_size):
+            end = min(start + chunk_size, num_windows)
+            chunk_mask = None
+            if mask is not None:
+                # window i of the batch uses the mask of window i % nW
+                nW = mask.shape[0]
+                if start % nW + end - start <= nW:
+                    chunk_mask = mask[start % nW:start % nW + end - start]
+                else:
+                    chunk_mask = mask[torch.arange(start, end, device=mask.device) % nW]
+            attn_windows[start:end] = self.attn(x_windows[start:end], mask=chunk_mask)
+        return attn_windows
+
     def extra_repr(self) -> str:
         return f"dim={self.dim}, input_resolution={self.input_resolution}, num_heads={self.num_heads}, " \
                f"window_size={self.window_size}, shift_size={self.shift_size}, mlp_ratio={self.mlp_ratio}"
@@ -884,12 +1090,40 @@ class Swin2SR(nn.Module):
     def no_weight_decay_keywords(self):
         return {'relative_position_bias_table'}
 
+    def freeze_attention(self):
+        """Precompute the input independent terms of every WindowAttention for inference, see
+        WindowAttention.freeze. Call it after loading the weights, train() reverts it."""
+        for module in self.modules():
+            if isinstance(module, WindowAttention):
+                module.freeze()
+        return self
+
+    def unfreeze_attention(self):
+        for module in self.modules():
+            if isinstance(module, WindowAttention):
+                module.unfreeze()
+        return self
+
+    def set_attn_backend(self, attn_backend):
+        """Select how every WindowAttention computes the attention, 'math' or 'sdpa'. 'sdpa' falls back to
+        'math' when F.scaled_dot_product_attention is not available or older than torch 2.1."""
+        assert attn_backend in ATTN_BACKENDS, f'attn_backend should be one of {ATTN_BACKENDS}.'
+        for module in self.modules():
+            if isinstance(module, WindowAttention):
+                module.attn_backend = attn_backend
+        return self
+
+    def set_attn_chunk_size(self, chunk_size):
+        """Attend at most chunk_size windows at once in every SwinTransformerBlock, which bounds the peak memory
+        of the attention by the chunk size instead of the number of windows of the image. 0 disables chunking."""
+        assert chunk_size >= 0, 'chunk_size should be non-negative.'
+        for module in self.modules():
+            if isinstance(module, SwinTransformerBlock):
+                module.attn_chunk_size = chunk_size
+        return self
+
     def check_image_size(self, x):
-        _, _, h, w = x.size()
-        mod_pad_h = (self.window_size - h % self.window_size) % self.window_size
-        mod_pad_w = (self.window_size - w % self.window_size) % self.window_size
-        x = F.pad(x, (0, mod_pad_w, 0, mod_pad_h), 'reflect')
-        return x
+        return pad_to_multiple(x, self.window_size)
 
     def forward_features(self, x):
         x_size = (x.shape[2], x.shape[3])
@@ -0,0 +1,33 @@
+import torch.nn.functional as F
+
+
+def get_padding(height, width, multiple):
+    """Minimal bottom and right padding that makes height x width a multiple of multiple, (0, 0) if it is one"""
+    return -height % multiple, -width % multiple
+
+
+def pad_to_multiple(img, multiple):
+    """Pad frames at the bottom and right to the next multiple of multiple, in one copy.
+
+    The border is reflected, as Swin2SR.check_image_size does, so a frame padded here goes through the model
+    without being padded again. Frames that are already a multiple are returned as they are. Reflection needs a
+    border wider than the padding, smaller frames repeat their last row or column instead.
+
+    Args:
+        img (Tensor): Frames of shape (N, C, H, W).
+        multiple (int): The multiple, e.g. the window size of the model.
+
+    Returns:
+        Tensor: Frames of shape (N, C, H + pad_h, W + pad_w).
+    """
+    height, width = img.shape[-2:]
+    pad_h, pad_w = get_padding(height, width, multiple)
+    if not pad_h and not pad_w:
+        return img
+    mode = 'reflect' if pad_h < height and pad_w < width else 'replicate'
+    return F.pad(img, (0, pad_w, 0, pad_h), mode=mode)
+
+
+def crop_output(output, height, width, scale):
+    """Crop the output of padded frames back to the input height x width times the model scale"""
+    return output[..., :height * scale, :width * scale]
@@ -0,0 +1,188 @@
+import logging
+
+import torch
+
+from .network_swin2sr import SwinTransformerBlock
+from .padding import crop_output, pad_to_multiple
+
+logger = logging.getLogger(__name__)
+
+# Number of float32 feature maps of embed_dim channels alive at the peak of a SwinTransformerBlock, besides the
+# mlp_ratio wide hidden layer: input, shortcut, shifted and partitioned windows, qkv (3), normalized q/k,
+# attention output and its projection
+BLOCK_FEATURE_MAPS = 12
+# Number of float32 attention score maps per head: scores, masked scores and softmax
+ATTENTION_MAPS = 3
+# Number of float32 feature maps alive in the reconstruction convolutions at the output resolution
+RECONSTRUCTION_MAPS = 3
+# Number of channels of the reconstruction convolutions at the output resolution
+UPSAMPLER_FEATURES = {'pixelshuffle': 64, 'pixelshuffle_aux': 64, 'pixelshuffle_hf': 64, 'nearest+conv': 64,
+                      'pixelshuffledirect': 3, '': 3}
+
+
+def get_model_config(model):
+    """Window size, scale, embedding dim, maximum number of heads, mlp ratio, upsampler and attention chunk size of
+    a Swin2SR model"""
+    blocks = [m for m in model.modules() if isinstance(m, SwinTransformerBlock)]
+    return {
+        'window_size': model.window_size,
+        'scale': model.upscale,
+        'embed_dim': model.embed_dim,
+        'num_heads': max((block.num_heads for block in blocks), default=1),
+        'mlp_ratio': model.mlp_ratio,
+        'upsampler': model.upsampler,
+        'attn_chunk_size': max((block.attn_chunk_size for block in blocks), default=0),
+    }
+
+
+def estimate_tile_memory(model, tile_height, tile_width, batch_size=1):
+    """Estimate the peak bytes a forward of batch_size tiles allocates.
+
+    The estimate adds the float32 activations of one SwinTransformerBlock, the attention scores of every window
+    (window_size**2 per pixel and head, for one chunk of windows with chunked attention) and the reconstruction
+    features at the output resolution. Blocks run one after the other, so the depth of the model does not
+    matter. On the CPU it is within 5% of the peak resident memory of a real_sr forward at 64 and 128 pixel
+    tiles.
+    """
+    config = get_model_config(model)
+    window_area = config['window_size'] ** 2
+    per_pixel = config['embed_dim'] * (BLOCK_FEATURE_MAPS + 2 * config['mlp_ratio'])
+    per_pixel += RECONSTRUCTION_MAPS * config['scale'] ** 2 * UPSAMPLER_FEATURES.get(config['upsampler'], 64)
+    pixels = batch_size * tile_height * tile_width
+    attention_pixels = pixels
+    if config['attn_chunk_size']:
+        attention_pixels = min(pixels, config['attn_chunk_size'] * window_area)
+    attention = ATTENTION_MAPS * config['num_heads'] * window_area * attention_pixels
+    return int((pixels * per_pixel + attention) * 4)
+
+
+def select_tile_size(model, height, width, memory_budget, batch_size=1, tile_overlap=32):
+    """Pick the largest window-aligned tile size whose batched forward fits in the memory budget.
+
+    Args:
+        model (Swin2SR): The model.
+        height (int): Height of the input frame.
+        width (int): Width of the input frame.
+        memory_budget (int): Bytes a forward may allocate. None or 0 disables tiling.
+        batch_size (int): Number of tiles per forward.
+        tile_overlap (int): Overlap between neighbouring tiles in input pixels.
+
+    Returns:
+        int: Tile size, or None if the whole frame fits in the budget in a single forward.
+    """
+    if not memory_budget:
+        return None
+    window_size = model.window_size
+    padded_height = -(-height // window_size) * window_size
+    padded_width = -(-width // window_size) * window_size
+    if estimate_tile_memory(model, padded_height, padded_width) <= memory_budget:
+        return None
+
+    # the tiles have to be larger than their overlap to make progress
+    min_tile = max(-(-2 * tile_overlap // window_size) * window_size, 2 * window_size)
+    tile_size = max(padded_height, padded_width)
+    while tile_size > min_tile:
+        tile_memory = estimate_tile_memory(model, min(tile_size, padded_height), min(tile_size, padded_width),
+                                           batch_size)
+        if tile_memory <= memory_budget:
+            break
+        tile_size -= window_size
+    else:
+        tile_size = min_tile
+        logger.warning(f"No tile size fits in the memory budget of {memory_budget / 1024**2:.0f}MB, "
+                       f"using the minimum tile size {tile_size}")
+    return tile_size
+
+
+def get_tile_starts(length, tile_size, tile_overlap, window_size):
+    """Window-aligned start offsets of the tiles covering length pixels, the last tile ends at length"""
+    if length <= tile_size:
+        return [0]
+    stride = max((tile_size - tile_overlap) // window_size * window_size, window_size)
+    starts = list(range(0, length - tile_size, stride))
+    return starts + [length - tile_size]
+
+
+def get_blend_weights(starts, tile_size, length, scale, device):
+    """Per-tile 1D output weights that cross-fade linearly over the overlap with the neighbouring tiles.
+
+    The descending ramp of a tile and the ascending ramp of the next one cover the same output pixels and
+    sum to one, so the tiles only need to be normalized where more than two of them overlap.
+    """
+    weights = []
+    for i, start in enumerate(starts):
+        end = min(start + tile_size, length)
+        weight = torch.ones((end - start) * scale, device=device)
+        overlap = (starts[i - 1] + tile_size - start) * scale if i > 0 else 0
+        if overlap > 0:
+            weight[:overlap] = (torch.arange(overlap, device=device) + 0.5) / overlap
+        overlap = (end - starts[i + 1]) * scale if i < len(starts) - 1 else 0
+        if overlap > 0:
+            weight[-overlap:] = (torch.arange(overlap, 0, -1, device=device) - 0.5) / overlap
+        weights.append(weight)
+    return weights
+
+
+def tile_forward(model, img, tile_size, tile_overlap=32, batch_size=1, output_device=None):
+    """Run Swin2SR on overlapping window-aligned tiles and blend them into the output frame.
+
+    The frame is padded to a multiple of the window size and split into tiles of tile_size (a multiple of the
+    window size), so every tile has the same shape and needs no padding in the model: batch_size tiles go
+    through one forward and all tiles share one cached attention mask. The tile outputs are accumulated with
+    weights that cross-fade over the overlap, which hides the seams of the windows at the tile borders.
+
+    Args:
+        model (Swin2SR): The model.
+        img (Tensor): Input frames of shape (N, C, H, W).
+        tile_size (int): Tile size in input pixels, rounded down to a multiple of the window size.
+        tile_overlap (int): Overlap between neighbouring tiles in input pixels.
+        batch_size (int): Number of tiles per forward.
+        output_device (torch.device): Device of the output frame, e.g. the CPU to keep a large output off
+            the GPU. Default: the device of img.
+
+    Returns:
+        Tensor: Output frames of shape (N, C, H * scale, W * scale).
+    """
+    window_size = model.window_size
+    scale = model.upscale
+    output_device = output_device or img.device
+    n, _, h_old, w_old = img.size()
+
+    # pad the frame to a multiple of the window size, as a whole frame forward does
+    img = pad_to_multiple(img, window_size)
+    _, _, height, width = img.size()
+
+    tile_size = max(tile_size // window_size * window_size, window_size)
+    tile_overlap = min(tile_overlap, tile_size // 2)
+    starts_y = get_tile_starts(height, tile_size, tile_overlap, window_size)
+    starts_x = get_tile_starts(width, tile_size, tile_overlap, window_size)
+    weights_y = get_blend_weights(starts_y, tile_size, height, scale, output_device)
+    weights_x = get_blend_weights(starts_x, tile_size, width, scale, output_device)
+    tile_height = min(tile_size, height)
+    tile_width = min(tile_size, width)
+
+    tiles = [(i, j) for i in range(len(starts_y)) for j in range(len(starts_x))]
+    output = None
+    tiles_per_forward = max(batch_size // n, 1)
+    for k in range(0, len(tiles), tiles_per_forward):
+        batch = tiles[k:k + tiles_per_forward]
+        tile_input = torch.cat([
+            img[:, :, starts_y[i]:starts_y[i] + tile_height, starts_x[j]:starts_x[j] + tile_width] for i, j in batch
+        ])
+        tile_output = model(tile_input).to(output_device, torch.float32)
+        if output is None:
+            output = torch.zeros(n, tile_output.shape[1], height * scale, width * scale, device=output_device)
+        for b, (i, j) in enumerate(batch):
+            y, x = starts_y[i] * scale, starts_x[j] * scale
+            weight = weights_y[i][:, None] * weights_x[j][None, :]
+            output[:, :, y:y + tile_height * scale, x:x + tile_width * scale] += tile_output[b * n:(b + 1) * n] * weight
+
+    # normalize where more than two tiles overlap, the weights are separable along the rows and the columns
+    norm_y = torch.zeros(height * scale, device=output_device)
+    norm_x = torch.zeros(width * scale, device=output_device)
+    for start, weight in zip(starts_y, weights_y):
+        norm_y[start * scale:start * scale + weight.numel()] += weight
+    for start, weight in zip(starts_x, weights_x):
+        norm_x[start * scale:start * scale + weight.numel()] += weight
+    output /= norm_y[:, None] * norm_x[None, :]
+    return crop_output(output, h_old, w_old, scale)
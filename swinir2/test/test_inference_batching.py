@@ -0,0 +1,99 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+import cv2
+import torch
+from unittest.mock import patch
+
+# Add the src directory to the path so we can import the inference module
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import inference
+from request_codec import RequestBatch
+from swinir.network_swin2sr import Swin2SR
+
+
+def create_model():
+    """Create a small randomly initialized x4 Swin2SR"""
+    torch.manual_seed(0)
+    return Swin2SR(upscale=4, in_chans=3, img_size=16, window_size=8, img_range=1., depths=[2], embed_dim=12,
+                   num_heads=[2], mlp_ratio=2, upsampler='pixelshuffledirect', resi_connection='1conv').eval()
+
+
+class TestInferenceBatching(unittest.TestCase):
+    """Test cases for the batched multi-frame inference"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.items = []
+        for i, (height, width) in enumerate([(20, 28), (20, 28), (17, 24), (20, 28)]):
+            input_path = os.path.join(self.tmp_dir, f'frame_{i}.png')
+            cv2.imwrite(input_path, rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+            self.items.append({
+                'input_file_path': input_path,
+                'output_file_path': os.path.join(self.tmp_dir, f'frame_{i}_out.png'),
+                'job_id': 'job',
+                'batch_id': i
+            })
+
+    def test_frames_of_one_size_share_a_forward(self):
+        """Test that same-size frames are stacked into one forward and match frame by frame processing"""
+        model = create_model()
+        expected = []
+        for item in self.items:
+            result = inference.process_single_image(item, model)
+            self.assertEqual(result['status'], 200)
+            expected.append(cv2.imread(item['output_file_path'], cv2.IMREAD_UNCHANGED))
+            os.remove(item['output_file_path'])
+
+        batch_sizes = []
+        forward = model.forward
+        with patch.object(model, 'forward', side_effect=lambda x: batch_sizes.append(len(x)) or forward(x)), \
+                patch.object(inference, 'SWIN_FRAME_BATCH_SIZE', 8), \
+                patch('torch.cuda.empty_cache') as mock_empty_cache:
+            results = inference.predict_fn(self.items, model)
+
+        self.assertEqual(sorted(batch_sizes), [1, 3])
+        mock_empty_cache.assert_not_called()
+        self.assertEqual([result['batch_id'] for result in results], [0, 1, 2, 3])
+        for item, result, expected_output in zip(self.items, results, expected):
+            self.assertEqual(result['status'], 200)
+            output = cv2.imread(item['output_file_path'], cv2.IMREAD_UNCHANGED)
+            self.assertEqual(output.shape, expected_output.shape)
+            np.testing.assert_allclose(output, expected_output, atol=1)
+
+    def test_frame_batches_are_bounded(self):
+        """Test that a group is split into forwards of at most SWIN_FRAME_BATCH_SIZE frames and errors stay per item"""
+        model = create_model()
+        self.items[2]['input_file_path'] = os.path.join(self.tmp_dir, 'missing.png')
+        batch_sizes = []
+        forward = model.forward
+        with patch.object(model, 'forward', side_effect=lambda x: batch_sizes.append(len(x)) or forward(x)), \
+                patch.object(inference, 'SWIN_FRAME_BATCH_SIZE', 2):
+            results = inference.predict_fn(self.items, model)
+
+        self.assertEqual(batch_sizes, [2, 1])
+        self.assertEqual([result['status'] for result in results], [200, 200, 500, 200])
+
+    def test_batched_requests_share_a_forward(self):
+        """Test that the items of the requests batched by the model server are stacked into shared forwards and
+        split back into one prediction per request"""
+        model = create_model()
+        self.items[2]['input_file_path'] = os.path.join(self.tmp_dir, 'missing.png')
+        requests = RequestBatch([[self.items[0]], [self.items[1], self.items[2]], [self.items[3]]])
+        batch_sizes = []
+        forward = model.forward
+        with patch.object(model, 'forward', side_effect=lambda x: batch_sizes.append(len(x)) or forward(x)), \
+                patch.object(inference, 'SWIN_FRAME_BATCH_SIZE', 8):
+            predictions = inference.predict_fn(requests, model)
+
+        self.assertEqual(batch_sizes, [3])
+        self.assertEqual(len(predictions), 3)
+        self.assertEqual(predictions[0]['status'], 200)
+        self.assertEqual([result['status'] for result in predictions[1]], [200, 500])
+        self.assertEqual(predictions[2]['batch_id'], 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+import io
+import os
+import json
+import tempfile
+import numpy as np
+import cv2
+
+# Add the src directory to the path so we can import the inference module
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import inference
+from request_codec import encode_multipart, parse_multipart
+from test_inference_batching import create_model
+
+
+class TestInlineRequests(unittest.TestCase):
+    """Test cases for frames sent and returned in the request and response bodies"""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.img = rng.integers(0, 256, (20, 28, 3), dtype=np.uint8)
+        self.model = create_model()
+
+    def upscale(self, img):
+        """Upscale a BGR frame by its file path, as a reference"""
+        path = os.path.join(tempfile.mkdtemp(), 'frame.png')
+        cv2.imwrite(path, img)
+        result = inference.process_single_image({'input_file_path': path, 'output_file_path': path,
+                                                 'job_id': 'job', 'batch_id': 0}, self.model)
+        self.assertEqual(result['status'], 200)
+        return cv2.imread(path, cv2.IMREAD_UNCHANGED)
+
+    def test_inline_frame_request(self):
+        """Test that PNG and npy request bodies are upscaled into a response body of the same format"""
+        expected = self.upscale(self.img)
+
+        items = inference.input_fn(bytearray(cv2.imencode('.png', self.img)[1]), 'image/png')
+        body, content_type = inference.output_fn(inference.predict_fn(items, self.model), 'application/json')
+        self.assertEqual(content_type, 'image/png')
+        np.testing.assert_array_equal(cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_UNCHANGED),
+                                      expected)
+
+        # a BGRA npy frame is upscaled as its BGR channels
+        buffer = io.BytesIO()
+        np.save(buffer, np.dstack([self.img, np.full(self.img.shape[:2], 255, dtype=np.uint8)]))
+        items = inference.input_fn(bytearray(buffer.getvalue()), 'application/x-npy')
+        body, content_type = inference.output_fn(inference.predict_fn(items, self.model), None)
+        self.assertEqual(content_type, 'application/x-npy')
+        np.testing.assert_array_equal(np.load(io.BytesIO(body)), expected)
+
+    def test_gray_npy_frames(self):
+        """Test that (H, W) and (H, W, 1) npy frames are upscaled like a gray PNG, as BGR"""
+        gray = cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY)
+        items = inference.input_fn(bytearray(cv2.imencode('.png', gray)[1]), 'image/png')
+        body, _ = inference.output_fn(inference.predict_fn(items, self.model), None)
+        expected = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        self.assertEqual(expected.shape, (80, 112, 3))
+
+        for frame in (gray, gray[:, :, None]):
+            buffer = io.BytesIO()
+            np.save(buffer, frame)
+            items = inference.input_fn(bytearray(buffer.getvalue()), 'application/x-npy')
+            result = inference.predict_fn(items, self.model)
+            self.assertEqual(result['status'], 200)
+            body, _ = inference.output_fn(result, None)
+            np.testing.assert_array_equal(np.load(io.BytesIO(body)), expected)
+
+    def test_multipart_batch_request(self):
+        """Test that a multipart batch is answered with the results and one part per upscaled frame"""
+        expected = self.upscale(self.img)
+        body, content_type = encode_multipart([
+            ('job_id', 'text/plain', b'job-1', None),
+            ('a', 'image/png', cv2.imencode('.png', self.img)[1].tobytes(), 'a.png'),
+            ('b', 'image/png', cv2.imencode('.png', self.img)[1].tobytes(), 'b.png'),
+        ])
+        items = inference.input_fn(bytearray(body), content_type)
+        self.assertEqual([(item['job_id'], item['batch_id']) for item in items], [('job-1', 0), ('job-1', 1)])
+        body, content_type = inference.output_fn(inference.predict_fn(items, self.model), 'application/json')
+
+        self.assertTrue(content_type.startswith('multipart/form-data; boundary='))
+        parts = parse_multipart(body, content_type)
+        self.assertEqual([headers.get_filename() for headers, _ in parts], [None, '0.png', '1.png'])
+        results = json.loads(bytes(parts[0][1]))
+        self.assertEqual([result['status'] for result in results], [200, 200])
+        for _, part in parts[1:]:
+            np.testing.assert_array_equal(cv2.imdecode(np.frombuffer(part, dtype=np.uint8), cv2.IMREAD_UNCHANGED),
+                                          expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
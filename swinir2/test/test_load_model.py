@@ -0,0 +1,41 @@
+import unittest
+import os
+import tempfile
+import torch
+from unittest.mock import patch
+
+# Add the src directory to the path so we can import the swinir package
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from swinir.load_model import define_model
+from swinir.network_swin2sr import Swin2SR
+
+
+class TestLoadModel(unittest.TestCase):
+    """Test cases for the swinir model loading"""
+
+    def test_weight_cache(self):
+        """Test that define_model writes a safetensors weight cache once and then loads it without torch.load"""
+        model_dir = tempfile.mkdtemp()
+        cache_dir = os.path.join(model_dir, 'cache')
+        torch.manual_seed(0)
+        model = Swin2SR(upscale=4, in_chans=3, img_size=64, window_size=8, img_range=1., depths=[6, 6, 6, 6],
+                        embed_dim=60, num_heads=[6, 6, 6, 6], mlp_ratio=2, upsampler='pixelshuffledirect',
+                        resi_connection='1conv')
+        model_path = os.path.join(model_dir, 'lightweight.pth')
+        torch.save({'params': model.state_dict()}, model_path)
+
+        first = define_model(model_path, 'lightweight_sr', 4, cache_dir=cache_dir)
+        self.assertEqual(len([name for name in os.listdir(cache_dir) if name.endswith('.safetensors')]), 1)
+        with patch('torch.load', side_effect=AssertionError('checkpoint should not be unpickled')):
+            cached = define_model(model_path, 'lightweight_sr', 4, cache_dir=cache_dir)
+
+        img = torch.rand(1, 3, 16, 16)
+        with torch.no_grad():
+            expected = model.eval()(img)
+            torch.testing.assert_close(first.eval()(img), expected)
+            torch.testing.assert_close(cached.eval()(img), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
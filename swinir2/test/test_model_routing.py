@@ -0,0 +1,78 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+import cv2
+import torch
+from unittest.mock import patch
+
+# Add the src directory to the path so we can import the inference module
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import inference
+from swinir.network_swin2sr import Swin2SR
+
+
+def create_model(model_path, task, scale, cache_dir=None):
+    """Stand-in for define_model, a small randomly initialized Swin2SR per task"""
+    torch.manual_seed(0)
+    model = Swin2SR(upscale=scale, in_chans=3, img_size=16, window_size=8, img_range=1., depths=[2], embed_dim=12,
+                    num_heads=[2], mlp_ratio=2, upsampler='pixelshuffledirect', resi_connection='1conv')
+    model.task = task
+    return model
+
+
+class TestModelRouting(unittest.TestCase):
+    """Test cases for the per-item model variant routing"""
+
+    def setUp(self):
+        self.model_dir = tempfile.mkdtemp()
+        for model_variant in ('real_sr', 'lightweight_sr', 'jpeg_car'):
+            open(os.path.join(self.model_dir, inference.MODEL_VARIANTS[model_variant]['name']), 'wb').close()
+
+        input_path = os.path.join(self.model_dir, 'frame.png')
+        cv2.imwrite(input_path, np.random.default_rng(0).integers(0, 256, (16, 24, 3), dtype=np.uint8))
+        self.items = [{
+            'input_file_path': input_path,
+            'output_file_path': os.path.join(self.model_dir, f'frame_{i}_out.png'),
+            'job_id': 'job',
+            'batch_id': i,
+            'model_variant': model_variant
+        } for i, model_variant in enumerate(['lightweight_sr', None, 'real_sr', 'classical_sr', 'unknown',
+                                             'lightweight_sr'])]
+
+    @patch('inference.define_model', side_effect=create_model)
+    def test_variants_load_on_first_use(self, mock_define_model):
+        """Test that model_fn registers the available variants and only loads the default one"""
+        models = inference.model_fn(self.model_dir)
+        self.assertEqual(sorted(models), ['jpeg_car', 'lightweight_sr', 'real_sr'])
+        self.assertEqual(models.loaded, ['real_sr'])
+        mock_define_model.assert_called_once()
+
+        # the color JPEG checkpoint is loaded into the color architecture
+        self.assertEqual(inference.model_fn(self.model_dir, 'jpeg_car').task, 'color_jpeg_car')
+        self.assertIs(inference.model_fn(self.model_dir, 'classical_sr'), models['real_sr'])
+
+    @patch('inference.define_model', side_effect=create_model)
+    def test_items_are_routed_to_their_variant(self, mock_define_model):
+        """Test that every item is processed by its variant, with one forward per variant"""
+        models = inference.model_fn(self.model_dir)
+        forwards = []
+        for model_variant in ('real_sr', 'lightweight_sr'):
+            model = models[model_variant]
+            forward = model.forward
+            model.forward = lambda x, model_variant=model_variant, forward=forward: (
+                forwards.append((model_variant, len(x))) or forward(x))
+
+        with patch.object(inference, 'SWIN_FRAME_BATCH_SIZE', 8):
+            results = inference.predict_fn(self.items, models)
+
+        self.assertEqual([result['status'] for result in results], [200] * 6)
+        # missing and unknown variants fall back to the default variant
+        self.assertEqual(sorted(forwards), [('lightweight_sr', 2), ('real_sr', 4)])
+        self.assertEqual(sorted(models.loaded), ['lightweight_sr', 'real_sr'])
+        self.assertEqual(mock_define_model.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
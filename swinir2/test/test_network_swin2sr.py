@@ -0,0 +1,157 @@
+import unittest
+import os
+import torch
+import torch.nn.functional as F
+from unittest.mock import patch
+
+# Add the src directory to the path so we can import the swinir package
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from swinir import network_swin2sr
+from swinir.network_swin2sr import (AttnMaskCache, Swin2SR, SwinTransformerBlock, WindowAttention, attn_mask_cache,
+                                    calculate_mask, calculate_window_index, window_index_cache, window_partition)
+
+
+def create_model(**kwargs):
+    """Create a small randomly initialized Swin2SR"""
+    torch.manual_seed(0)
+    options = dict(upscale=2, in_chans=3, img_size=16, window_size=4, img_range=1., depths=[2, 2], embed_dim=12,
+                   num_heads=[2, 2], mlp_ratio=2, upsampler='pixelshuffledirect', resi_connection='1conv')
+    options.update(kwargs)
+    return Swin2SR(**options).eval()
+
+
+class TestSwin2SR(unittest.TestCase):
+    """Test cases for the Swin2SR network"""
+
+    def setUp(self):
+        attn_mask_cache.clear()
+        window_index_cache.clear()
+
+    def test_mask_cache_shared_by_blocks_and_frames(self):
+        """Test that all shifted blocks and frames of the same size share one cached mask"""
+        model = create_model()
+        shifted_blocks = [m for m in model.modules() if isinstance(m, SwinTransformerBlock) and m.shift_size > 0]
+        self.assertEqual(len(shifted_blocks), 2)
+
+        with torch.no_grad():
+            first = model(torch.rand(1, 3, 24, 20))
+            model(torch.rand(1, 3, 24, 20))
+        self.assertEqual(first.shape, (1, 3, 48, 40))
+        self.assertEqual(attn_mask_cache.stats(), {'hits': 3, 'misses': 1, 'size': 1, 'maxsize': 32})
+
+        # the training resolution uses the registered buffer
+        with torch.no_grad():
+            model(torch.rand(1, 3, 16, 16))
+        self.assertEqual(attn_mask_cache.misses, 1)
+
+    def test_cached_mask_matches_calculated_mask(self):
+        """Test that the cached mask equals the mask of the block and that the cache is bounded"""
+        cache = AttnMaskCache(maxsize=2)
+        block = SwinTransformerBlock(dim=12, input_resolution=(16, 16), num_heads=2, window_size=4, shift_size=2)
+
+        mask = cache.get((24, 20), 4, 2, 'cpu')
+        torch.testing.assert_close(mask, block.calculate_mask((24, 20)))
+        self.assertIs(cache.get((24, 20), 4, 2, torch.device('cpu')), mask)
+        cache.get((8, 8), 4, 2, 'cpu')
+        cache.get((12, 8), 4, 2, 'cpu')
+        self.assertEqual(len(cache), 2)
+        self.assertIsNot(cache.get((24, 20), 4, 2, 'cpu'), mask)
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+    def test_unshifted_block_needs_no_mask(self):
+        """Test that the all-zero mask of unshifted windows does not change the attention"""
+        torch.testing.assert_close(calculate_mask((8, 8), 4, 0), torch.zeros(4, 16, 16))
+        block = SwinTransformerBlock(dim=12, input_resolution=(16, 16), num_heads=2, window_size=4, shift_size=0)
+        x = torch.rand(4, 16, 12)
+        with torch.no_grad():
+            torch.testing.assert_close(block.attn(x), block.attn(x, mask=torch.zeros(4, 16, 16)))
+
+    def test_frozen_attention_matches_original(self):
+        """Test that freezing the attention terms keeps the output and is reverted by train()"""
+        model = create_model()
+        img = torch.rand(1, 3, 24, 20)
+        state_keys = set(model.state_dict())
+        with torch.no_grad():
+            expected = model(img)
+            model.freeze_attention()
+            attentions = [m for m in model.modules() if isinstance(m, WindowAttention)]
+            self.assertTrue(attentions and all(m.frozen for m in attentions))
+            torch.testing.assert_close(model(img), expected, rtol=1e-5, atol=1e-6)
+        self.assertEqual(set(model.state_dict()), state_keys)
+
+        # frozen terms are not recomputed, so patching the MLP has no effect until unfrozen
+        with patch.object(WindowAttention, 'get_relative_position_bias', side_effect=AssertionError):
+            with torch.no_grad():
+                model(img)
+
+        model.train()
+        self.assertFalse(any(m.frozen for m in attentions))
+        model.eval()
+        with torch.no_grad():
+            torch.testing.assert_close(model(img), expected)
+
+    def test_sdpa_backend_matches_math(self):
+        """Test that the fused attention backend matches the explicit attention, shifted and batched"""
+        model = create_model()
+        img = torch.rand(2, 3, 24, 20)
+        with torch.no_grad():
+            expected = model(img)
+            torch.testing.assert_close(model.set_attn_backend('sdpa')(img), expected, rtol=1e-4, atol=1e-5)
+            model.freeze_attention()
+            torch.testing.assert_close(model(img), expected, rtol=1e-4, atol=1e-5)
+        with self.assertRaises(AssertionError):
+            model.set_attn_backend('flash')
+
+    def test_sdpa_shifted_block_non_contiguous(self):
+        """Test the fused attention of a shifted block on a non-contiguous batch, with a fused kernel output
+        whose strides are not contiguous"""
+        block = SwinTransformerBlock(dim=12, input_resolution=(16, 16), num_heads=2, window_size=4,
+                                     shift_size=2).eval()
+        x = torch.rand(24 * 20, 2, 12).transpose(0, 1)
+        self.assertFalse(x.is_contiguous())
+        with torch.no_grad():
+            expected = block(x.contiguous(), (24, 20))
+            block.attn.attn_backend = 'sdpa'
+            sdpa = F.scaled_dot_product_attention
+
+            def strided_sdpa(*args, **kwargs):
+                return sdpa(*args, **kwargs).transpose(1, 2).contiguous().transpose(1, 2)
+
+            with patch.object(network_swin2sr, 'SDPA_AVAILABLE', True), \
+                    patch.object(F, 'scaled_dot_product_attention', side_effect=strided_sdpa) as fused:
+                torch.testing.assert_close(block(x, (24, 20)), expected, rtol=1e-4, atol=1e-5)
+        fused.assert_called_once()
+
+    def test_chunked_attention_matches_whole(self):
+        """Test that attending the windows in chunks gives the output of attending all of them at once"""
+        model = create_model()
+        img = torch.rand(2, 3, 24, 20)
+        with torch.no_grad():
+            expected = model(img)
+            # 30 windows per frame: chunks within a frame, across both frames and an uneven last chunk
+            for chunk_size in (1, 7, 15, 16, 100):
+                for attn_backend in ('math', 'sdpa'):
+                    model.set_attn_chunk_size(chunk_size).set_attn_backend(attn_backend)
+                    torch.testing.assert_close(model(img), expected, rtol=1e-4, atol=1e-5)
+
+    def test_window_index_matches_roll_and_partition(self):
+        """Test that the gather indices shift and partition the windows like torch.roll and window_partition"""
+        x = torch.rand(2, 12, 20, 5)
+        for shift_size in (0, 2):
+            partition_index, reverse_index = calculate_window_index((12, 20), 4, shift_size)
+            windows = window_partition(torch.roll(x, shifts=(-shift_size, -shift_size), dims=(1, 2)), 4)
+            torch.testing.assert_close(x.view(2, 240, 5).index_select(1, partition_index).view(-1, 4, 4, 5), windows,
+                                       rtol=0, atol=0)
+            torch.testing.assert_close(windows.reshape(2, 240, 5).index_select(1, reverse_index), x.view(2, 240, 5),
+                                       rtol=0, atol=0)
+
+        # the indices are shared by the blocks of one shift size
+        model = create_model()
+        with torch.no_grad():
+            model(torch.rand(1, 3, 24, 20))
+        self.assertEqual(window_index_cache.stats(), {'hits': 2, 'misses': 2, 'size': 2, 'maxsize': 32})
+
+
+if __name__ == '__main__':
+    unittest.main()
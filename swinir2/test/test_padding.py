@@ -0,0 +1,58 @@
+import unittest
+import os
+import torch
+import torch.nn.functional as F
+from unittest.mock import patch
+
+# Add the src directory to the path so we can import the inference module
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import inference
+from swinir.network_swin2sr import Swin2SR
+from swinir.padding import crop_output, get_padding, pad_to_multiple
+
+
+def create_model(upscale, upsampler):
+    """Create a small randomly initialized Swin2SR"""
+    torch.manual_seed(0)
+    return Swin2SR(upscale=upscale, in_chans=3, img_size=16, window_size=8, img_range=1., depths=[2], embed_dim=12,
+                   num_heads=[2], mlp_ratio=2, upsampler=upsampler, resi_connection='1conv').eval()
+
+
+class TestPadding(unittest.TestCase):
+    """Test cases for the padding of frames to the window size"""
+
+    def test_minimal_padding(self):
+        """Test that frames are padded to the next window multiple only, by reflection"""
+        self.assertEqual(get_padding(16, 24, 8), (0, 0))
+        self.assertEqual(get_padding(17, 23, 8), (7, 1))
+
+        img = torch.rand(2, 3, 16, 24)
+        self.assertIs(pad_to_multiple(img, 8), img)
+        img = torch.rand(2, 3, 17, 23)
+        torch.testing.assert_close(pad_to_multiple(img, 8), F.pad(img, (0, 1, 0, 7), mode='reflect'))
+        # frames smaller than the padding repeat their border
+        img = torch.rand(1, 3, 3, 16)
+        torch.testing.assert_close(pad_to_multiple(img, 8), F.pad(img, (0, 0, 0, 5), mode='replicate'))
+        self.assertEqual(crop_output(torch.rand(1, 3, 48, 64), 5, 7, 4).shape, (1, 3, 20, 28))
+
+    def test_enhance_pads_once_and_crops_with_model_scale(self):
+        """Test that enhance runs the model on the minimal padded size and crops with the scale of the model"""
+        for upscale, upsampler in [(1, ''), (4, 'pixelshuffledirect')]:
+            model = create_model(upscale, upsampler)
+            shapes = []
+            forward = model.forward
+            for height, width in [(16, 24), (17, 23)]:
+                img = torch.rand(1, 3, height, width)
+                with patch.object(model, 'forward', side_effect=lambda x: shapes.append(x.shape[2:]) or forward(x)), \
+                        patch.object(inference, 'SWIN_TILE_MEMORY_BUDGET', 0):
+                    output = inference.enhance(model, img)
+                self.assertEqual(output.shape, (1, height * upscale, width * upscale, 3))
+                with torch.no_grad():
+                    expected = (model(img).clamp(0, 1) * 255).round().to(torch.uint8)[:, [2, 1, 0]]
+                torch.testing.assert_close(torch.from_numpy(output), expected.permute(0, 2, 3, 1))
+            self.assertEqual(shapes, [(16, 24), (24, 24)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import os
+import torch
+from unittest.mock import MagicMock, patch
+
+# Add the src directory to the path so we can import the swinir package
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import inference
+from compiled_models import CompiledModelCache
+from swinir.network_swin2sr import Swin2SR
+from swinir.tiling import estimate_tile_memory
+
+
+def create_model():
+    """Create a small randomly initialized Swin2SR"""
+    torch.manual_seed(0)
+    model = Swin2SR(upscale=2, in_chans=3, img_size=16, window_size=4, img_range=1., depths=[2, 2], embed_dim=12,
+                    num_heads=[2, 2], mlp_ratio=2, upsampler='pixelshuffledirect', resi_connection='1conv').eval()
+    return model.freeze_attention()
+
+
+class TestCompiledSwin2SR(unittest.TestCase):
+    """Test cases for the shape-bucketed compiled Swin2SR"""
+
+    def test_traced_bucket_matches_eager(self):
+        """Test that a frame padded into its bucket gives the eager output, with the masks of the bucket size"""
+        network = create_model()
+        model = CompiledModelCache(network, buckets=[(22, 37)], backend='trace', pad_multiple=network.window_size)
+        self.assertEqual(model.buckets, [(24, 40), (40, 24)])
+        with torch.no_grad():
+            for height, width in [(24, 40), (22, 37), (21, 38)]:
+                img = torch.rand(1, 3, height, width)
+                # Swin2SR.check_image_size pads to the same window multiple by reflection
+                torch.testing.assert_close(model(img), network(img))
+        self.assertEqual(len(model._graphs), 1)
+        # the configuration of the network is read through the cache
+        self.assertEqual(estimate_tile_memory(model, 24, 40), estimate_tile_memory(network, 24, 40))
+
+    def test_compile_model_warms_buckets(self):
+        """Test that the server wraps the model into the compiled cache and warms it"""
+        with patch.object(inference, 'COMPILE_BACKEND', 'trace'), \
+                patch.object(inference, 'COMPILE_BUCKETS', [(16, 24)]), \
+                patch.object(inference, 'SWIN_TILE_MEMORY_BUDGET', 0), \
+                patch.object(inference, 'SWIN_FRAME_BATCH_SIZE', 2):
+            model = inference.compile_model(create_model())
+        self.assertIsInstance(model, CompiledModelCache)
+        self.assertEqual(list(model._graphs), [((2, 3, 16, 24), torch.float32, 'cpu')])
+
+        with patch.object(inference, 'COMPILE_BACKEND', 'none'):
+            self.assertIsInstance(inference.compile_model(create_model()), Swin2SR)
+
+
+    def test_compile_graphs_are_cached_by_dynamo(self):
+        """Test that the model is wrapped by torch.compile once for all buckets, which leaves its graphs to dynamo"""
+        network = create_model()
+        with patch('torch.compile', return_value=MagicMock(wraps=network)) as mock_compile, \
+                torch._dynamo.config.patch(cache_size_limit=8):
+            model = CompiledModelCache(network, buckets=[(8, 16), (16, 24)], backend='compile', max_graphs=32)
+            self.assertEqual(torch._dynamo.config.cache_size_limit, 32)
+        compiled = mock_compile.return_value
+        with torch.no_grad():
+            model.warm(batch_size=2)
+            model(torch.rand(2, 3, 16, 24))
+        mock_compile.assert_called_once_with(network, dynamic=False)
+        # one run per warmed bucket and one for the frame, the cache keeps no graphs of its own
+        self.assertEqual(compiled.call_count, 3)
+        self.assertEqual(len(model._graphs), 0)
+        self.assertIs(model.get_graph(torch.rand(2, 3, 8, 16)), compiled)
+
+if __name__ == '__main__':
+    unittest.main()
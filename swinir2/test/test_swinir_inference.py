@@ -171,81 +171,6 @@ class TestInference(unittest.TestCase):
         with self.assertRaises(ValueError):
             inference.input_fn(b'some data', 'application/unsupported')
 
-    @patch('boto3.client')
-    @patch('os.path.exists')
-    def test_download_from_s3_cached(self, mock_exists, mock_boto3_client):
-        """Test download_from_s3 when the file is already cached"""
-        # Setup mocks
-        mock_exists.return_value = True
-        mock_s3 = MagicMock()
-        mock_boto3_client.return_value = mock_s3
-        
-        # Call the function
-        local_path = inference.download_from_s3('bucket', 'key', '/tmp/cache')
-        
-        # Assertions
-        self.assertEqual(local_path, '/tmp/cache/key')
-        mock_exists.assert_called_with('/tmp/cache/key')
-        mock_boto3_client.assert_not_called()
-
-    @patch('boto3.client')
-    @patch('os.path.exists')
-    @patch('os.makedirs')
-    def test_download_from_s3_not_cached(self, mock_makedirs, mock_exists, mock_boto3_client):
-        """Test download_from_s3 when the file is not cached"""
-        # Setup mocks
-        mock_exists.return_value = False
-        mock_s3 = MagicMock()
-        mock_boto3_client.return_value = mock_s3
-        
-        # Call the function
-        local_path = inference.download_from_s3('bucket', 'key', '/tmp/cache')
-        
-        # Assertions
-        self.assertEqual(local_path, '/tmp/cache/key')
-        mock_exists.assert_called_with('/tmp/cache/key')
-        mock_boto3_client.assert_called_with('s3')
-        mock_s3.download_file.assert_called_with('bucket', 'key', '/tmp/cache/key')
-        
-        # Test with a key that has a path
-        mock_exists.reset_mock()
-        mock_boto3_client.reset_mock()
-        mock_s3.reset_mock()
-        mock_makedirs.reset_mock()
-        
-        local_path = inference.download_from_s3('bucket', 'path/to/key', '/tmp/cache')
-        
-        self.assertEqual(local_path, '/tmp/cache/path/to/key')
-        mock_makedirs.assert_called_with('/tmp/cache/path/to', exist_ok=True)
-        mock_s3.download_file.assert_called_with('bucket', 'path/to/key', '/tmp/cache/path/to/key')
-
-    @patch('boto3.client')
-    def test_upload_to_s3(self, mock_boto3_client):
-        """Test upload_to_s3"""
-        # Setup mocks
-        mock_s3 = MagicMock()
-        mock_boto3_client.return_value = mock_s3
-        
-        # Call the function
-        inference.upload_to_s3('/tmp/local/file.jpg', 'bucket', 'key.jpg')
-        
-        # Assertions
-        mock_boto3_client.assert_called_with('s3')
-        mock_s3.upload_file.assert_called_with('/tmp/local/file.jpg', 'bucket', 'key.jpg')
-        
-        # Test with content_type
-        mock_boto3_client.reset_mock()
-        mock_s3.reset_mock()
-        
-        inference.upload_to_s3('/tmp/local/file.jpg', 'bucket', 'key.jpg', 'image/jpeg')
-        
-        mock_s3.upload_file.assert_called_with(
-            '/tmp/local/file.jpg', 
-            'bucket', 
-            'key.jpg',
-            ExtraArgs={'ContentType': 'image/jpeg'}
-        )
-
     @patch('inference.process_single_image')
     def test_predict_fn_single_image(self, mock_process_single):
         """Test predict_fn with a single image"""
@@ -328,11 +253,10 @@ class TestInference(unittest.TestCase):
             self.assertEqual(res, mock_results[i].tobytes())
 
     @patch('cv2.imread')
-    @patch('inference.download_from_s3')
-    @patch('inference.upload_to_s3')
+    @patch('inference.write_image')
     @patch('cv2.imwrite')
     @patch('torch.from_numpy')
-    def test_process_single_image(self, mock_torch_from_numpy, mock_imwrite, mock_upload, mock_download, mock_imread):
+    def test_process_single_image(self, mock_torch_from_numpy, mock_imwrite, mock_upload, mock_imread):
         """Test process_single_image"""
         # Setup mocks
         mock_model = MagicMock()
@@ -383,10 +307,9 @@ class TestInference(unittest.TestCase):
         mock_upload.assert_called()
 
     @patch('cv2.imread')
-    @patch('inference.download_from_s3')
-    @patch('inference.upload_to_s3')
+    @patch('inference.write_image')
     @patch('cv2.imwrite')
-    def test_process_single_image_error_handling(self, mock_imwrite, mock_upload, mock_download, mock_imread):
+    def test_process_single_image_error_handling(self, mock_imwrite, mock_upload, mock_imread):
         """Test process_single_image error handling"""
         # Setup mocks
         mock_model = MagicMock()
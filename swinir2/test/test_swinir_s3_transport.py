@@ -0,0 +1,62 @@
+import unittest
+import os
+import numpy as np
+import cv2
+import boto3
+import torch
+from unittest.mock import patch
+from moto import mock_aws
+
+# Add the src directory to the path so we can import the inference module
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+import inference
+import s3_transport
+from swinir.network_swin2sr import Swin2SR
+
+
+@mock_aws
+class TestS3Transport(unittest.TestCase):
+    """Test cases for the in-memory S3 frame transport of the SwinIR server"""
+
+    def setUp(self):
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+        # the shared client is created inside the moto mock
+        s3_transport._s3_client = None
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        self.s3.create_bucket(Bucket='frames')
+        img = np.random.default_rng(0).integers(0, 256, (16, 24, 3), dtype=np.uint8)
+        self.s3.put_object(Bucket='frames', Key='job/frame_0001.png', Body=cv2.imencode('.png', img)[1].tobytes())
+
+    def tearDown(self):
+        s3_transport._s3_client = None
+
+    def test_frames_go_from_s3_to_s3_in_memory(self):
+        """Test that frames are decoded from and encoded to S3 objects without temporary files"""
+        torch.manual_seed(0)
+        model = Swin2SR(upscale=2, in_chans=3, img_size=16, window_size=8, img_range=1., depths=[2], embed_dim=12,
+                        num_heads=[2], mlp_ratio=2, upsampler='pixelshuffledirect', resi_connection='1conv').eval()
+        items = [{
+            'input_file_path': 's3://frames/job/frame_0001.png',
+            'output_file_path': f's3://frames/out/frame_0001_{i}.jpg',
+            'job_id': 'job',
+            'batch_id': i
+        } for i in range(2)]
+
+        with patch('cv2.imread') as mock_imread, patch('cv2.imwrite') as mock_imwrite:
+            results = inference.predict_fn(items, model)
+            mock_imread.assert_not_called()
+            mock_imwrite.assert_not_called()
+
+        self.assertEqual([result['status'] for result in results], [200, 200])
+        for item in items:
+            response = self.s3.get_object(Bucket='frames', Key=item['output_file_path'][len('s3://frames/'):])
+            # the format follows the extension of the output path
+            self.assertEqual(response['ContentType'], 'image/jpeg')
+            output = cv2.imdecode(np.frombuffer(response['Body'].read(), dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+            self.assertEqual(output.shape, (32, 48, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+import os
+import torch
+import torch.nn.functional as F
+
+# Add the src directory to the path so we can import the swinir package
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from swinir.network_swin2sr import Swin2SR
+from swinir.tiling import estimate_tile_memory, get_tile_starts, select_tile_size, tile_forward
+
+
+class NearestUpsampler(torch.nn.Module):
+    """Pixel-wise stand-in for Swin2SR, so that any tiling has to reproduce the whole frame output exactly"""
+
+    def __init__(self, upscale=2, window_size=4):
+        super().__init__()
+        self.upscale = upscale
+        self.window_size = window_size
+        self.shapes = []
+
+    def forward(self, x):
+        self.shapes.append(tuple(x.shape))
+        return F.interpolate(x, scale_factor=self.upscale, mode='nearest')
+
+
+def create_model():
+    """Create a small randomly initialized Swin2SR"""
+    torch.manual_seed(0)
+    return Swin2SR(upscale=2, in_chans=3, img_size=16, window_size=4, img_range=1., depths=[2, 2], embed_dim=12,
+                   num_heads=[2, 2], mlp_ratio=2, upsampler='pixelshuffledirect', resi_connection='1conv').eval()
+
+
+class TestTiling(unittest.TestCase):
+    """Test cases for the tiled Swin2SR inference"""
+
+    def test_tile_starts_are_window_aligned(self):
+        """Test that the tiles start at window multiples and cover the frame"""
+        self.assertEqual(get_tile_starts(40, 64, 8, 4), [0])
+        starts = get_tile_starts(100, 24, 6, 4)
+        self.assertEqual(starts, [0, 16, 32, 48, 64, 76])
+        self.assertTrue(all(start % 4 == 0 for start in starts))
+
+    def test_blended_tiles_reproduce_frame(self):
+        """Test that the overlapping tiles blend into exactly the whole frame output"""
+        img = torch.rand(2, 3, 37, 50)
+        expected = F.interpolate(img, scale_factor=2, mode='nearest')
+        for tile_size, tile_overlap, batch_size in [(16, 4, 1), (24, 8, 4), (20, 10, 3), (64, 8, 2)]:
+            model = NearestUpsampler()
+            output = tile_forward(model, img, tile_size, tile_overlap=tile_overlap, batch_size=batch_size)
+            torch.testing.assert_close(output, expected)
+            # every forward gets tiles of one window-aligned shape
+            self.assertEqual(len({shape[1:] for shape in model.shapes}), 1)
+            self.assertTrue(all(size % 4 == 0 for size in model.shapes[0][2:]))
+            self.assertTrue(all(shape[0] <= max(batch_size, 2) for shape in model.shapes))
+
+    def test_single_tile_matches_whole_frame(self):
+        """Test that a tile covering the frame gives the whole frame Swin2SR output"""
+        model = create_model()
+        img = torch.rand(1, 3, 21, 30)
+        with torch.no_grad():
+            output = tile_forward(model, img, 64)
+            # both pad the frame to the window multiple by reflection
+            torch.testing.assert_close(output, model(img))
+
+            # more overlap brings the tiled output closer to the whole frame one
+            errors = [(tile_forward(model, img, 16, tile_overlap=overlap, batch_size=4) - output).abs().mean()
+                      for overlap in (0, 8)]
+        self.assertLess(errors[1], errors[0])
+
+    def test_tile_size_fits_memory_budget(self):
+        """Test that the selected tile size is the largest window multiple within the budget"""
+        model = create_model()
+        self.assertIsNone(select_tile_size(model, 1080, 1920, None))
+        frame_memory = estimate_tile_memory(model, 1080, 1920)
+        self.assertIsNone(select_tile_size(model, 1080, 1920, frame_memory))
+
+        budget = frame_memory // 10
+        tile_size = select_tile_size(model, 1080, 1920, budget, batch_size=2)
+        self.assertEqual(tile_size % model.window_size, 0)
+        self.assertLessEqual(estimate_tile_memory(model, tile_size, tile_size, 2), budget)
+        next_size = tile_size + model.window_size
+        self.assertGreater(estimate_tile_memory(model, next_size, next_size, 2), budget)
+
+        # chunked attention only holds the scores of one chunk of windows
+        model.set_attn_chunk_size(16)
+        self.assertLess(estimate_tile_memory(model, 1080, 1920), frame_memory)
+        self.assertGreaterEqual(select_tile_size(model, 1080, 1920, budget, batch_size=2), tile_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,444 @@
+import os
+import time
+import json
+import argparse
+import statistics
+import tempfile
+from datetime import datetime
+
+import matplotlib.pyplot as plt
+import numpy as np
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+# Add the realesrgan and swinir2 src directories to the path so we can import the model helpers
+import sys
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(REPO_DIR, 'realesrgan', 'src'))
+sys.path.insert(1, os.path.join(REPO_DIR, 'swinir2', 'src'))
+import patch_torchvision
+from compiled_models import CompiledModelCache
+from basicsr.archs.rrdbnet_arch import RRDBNet
+from realesrgan.realesrgan import RealESRGANer
+from realesrgan.realesrgan.archs.srvgg_arch import SRVGGNetCompact
+from swinir.network_swin2sr import (Swin2SR, SwinTransformerBlock, WindowAttention, calculate_mask, calculate_window_index,
+                                    window_partition, window_reverse)
+
+
+class InferenceBenchmark:
+    """Benchmark the model inference helpers on synthetic frames with randomly initialized weights"""
+
+    def __init__(self, output_dir=None, iterations=3, device=None):
+        """Initialize the benchmark"""
+        self.iterations = iterations
+        self.device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.metrics = {}
+        self.model_dir = tempfile.mkdtemp(prefix='inference_benchmark_')
+
+        # Set default output directory
+        if output_dir is None:
+            self.output_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+        else:
+            self.output_dir = output_dir
+
+        # Create output directory if it doesn't exist
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def create_realesrgan_upsampler(self, num_feat=64, num_conv=16, **kwargs):
+        """Create a RealESRGANer around an SRVGGNetCompact (the anime video architecture)"""
+        torch.manual_seed(0)
+        model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=num_feat, num_conv=num_conv, upscale=4,
+                                act_type='prelu')
+        model_path = os.path.join(self.model_dir, f'srvgg_{num_feat}_{num_conv}.pth')
+        if not os.path.exists(model_path):
+            torch.save({'params': model.state_dict()}, model_path)
+
+        options = {'tile': 0, 'tile_pad': 10, 'pre_pad': 0, 'half': False, 'device': self.device}
+        options.update(kwargs)
+        return RealESRGANer(scale=4, model_path=model_path, model=model, **options)
+
+    def create_frame(self, height, width):
+        """Create a random 8-bit BGR frame"""
+        rng = np.random.default_rng(0)
+        return rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+    def time_call(self, fn):
+        """Run fn once to warm up, then return the mean wall time over the configured iterations"""
+        fn()
+        times = []
+        for _ in range(self.iterations):
+            if self.device.type == 'cuda':
+                torch.cuda.synchronize()
+            start_time = time.perf_counter()
+            fn()
+            if self.device.type == 'cuda':
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - start_time)
+        return statistics.mean(times)
+
+    def benchmark_tile_batching(self, height=270, width=480, tile_size=64, batch_sizes=(1, 4, 16), **model_kwargs):
+        """Compare the per-frame time of batched tile inference against one forward per tile"""
+        img = self.create_frame(height, width)
+        results = []
+        for tile_batch_size in batch_sizes:
+            upsampler = self.create_realesrgan_upsampler(tile=tile_size, tile_batch_size=tile_batch_size,
+                                                         **model_kwargs)
+            frame_time = self.time_call(lambda: upsampler.enhance(img))
+            results.append({
+                'height': height,
+                'width': width,
+                'tile_size': tile_size,
+                'tile_batch_size': tile_batch_size,
+                'frame_time': frame_time
+            })
+            print(f"  tile={tile_size} batch={tile_batch_size}: {frame_time:.3f} seconds per frame")
+
+        baseline = results[0]['frame_time']
+        for result in results:
+            result['speedup'] = baseline / result['frame_time']
+
+        self.metrics['tile_batching'] = results
+        return results
+
+    def benchmark_tile_blending(self, height=540, width=960, tile_sizes=(128, 256, 512, 1024),
+                                blend_modes=(('crop', 10), ('linear', 4), ('cosine', 4)), **model_kwargs):
+        """Compare cropped tile padding against feathered tile blending with a smaller overlap.
+
+        Reports the share of the computed tile pixels that are cropped away or blended over, the wall time and
+        the PSNR against the untiled output for every tile size and (tile_blend, tile_pad) pair.
+        """
+        img = self.create_frame(height, width)
+        reference, _ = self.create_realesrgan_upsampler(**model_kwargs).enhance(img)
+        results = []
+        for tile_size in tile_sizes:
+            for tile_blend, tile_pad in blend_modes:
+                upsampler = self.create_realesrgan_upsampler(tile=tile_size, tile_pad=tile_pad, tile_blend=tile_blend,
+                                                             **model_kwargs)
+                tile_height = min(tile_size + 2 * tile_pad, height)
+                tile_width = min(tile_size + 2 * tile_pad, width)
+                tiles = upsampler.get_tile_grid(height, width, tile_height, tile_width)
+                computed_pixels = len(tiles) * tile_height * tile_width
+
+                frame_time = self.time_call(lambda: upsampler.enhance(img))
+                output, _ = upsampler.enhance(img)
+                mse = np.mean((output.astype(np.float64) - reference.astype(np.float64))**2)
+                psnr = float('inf') if mse == 0 else 10 * np.log10(255.0**2 / mse)
+                results.append({
+                    'height': height,
+                    'width': width,
+                    'tile_size': tile_size,
+                    'tile_blend': tile_blend,
+                    'tile_pad': tile_pad,
+                    'tiles': len(tiles),
+                    'discarded_ratio': 1 - height * width / computed_pixels,
+                    'frame_time': frame_time,
+                    'psnr': psnr
+                })
+                print(f"  tile={tile_size} {tile_blend} pad={tile_pad}: "
+                      f"{results[-1]['discarded_ratio']:.1%} discarded, {frame_time:.3f} seconds per frame, "
+                      f"{psnr:.2f} dB")
+
+        self.metrics['tile_blending'] = results
+        return results
+
+    def benchmark_weight_loading(self, num_block=23, half=False):
+        """Compare the cold-start time of a RealESRGANer loading the pickle checkpoint against the safetensors
+        weight cache (the RealESRGAN_x4plus architecture by default)"""
+        torch.manual_seed(0)
+        model_path = os.path.join(self.model_dir, f'rrdbnet_{num_block}.pth')
+        if not os.path.exists(model_path):
+            model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=num_block, num_grow_ch=32, scale=4)
+            torch.save({'params_ema': model.state_dict()}, model_path)
+        cache_dir = tempfile.mkdtemp(prefix='weight_cache_', dir=self.model_dir)
+
+        def create_model():
+            return RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=num_block, num_grow_ch=32, scale=4)
+
+        def load(weight_cache_dir):
+            RealESRGANer(scale=4, model_path=model_path, model=create_model(), half=half, device=self.device,
+                         weight_cache_dir=weight_cache_dir)
+
+        # the first load with a cache directory converts the checkpoint, time_call uses it as warm-up
+        results = {
+            'num_block': num_block,
+            'half': half,
+            'checkpoint_bytes': os.path.getsize(model_path),
+            # building the randomly initialized network is part of both cold starts
+            'model_init_time': self.time_call(create_model),
+            'pickle_load_time': self.time_call(lambda: load(None)),
+            'cached_load_time': self.time_call(lambda: load(cache_dir))
+        }
+        results['speedup'] = results['pickle_load_time'] / results['cached_load_time']
+        print(f"  network init: {results['model_init_time']:.3f} seconds, "
+              f"pickle checkpoint: {results['pickle_load_time']:.3f} seconds, "
+              f"safetensors cache: {results['cached_load_time']:.3f} seconds ({results['speedup']:.2f}x)")
+
+        self.metrics['weight_loading'] = results
+        return results
+
+    def measure_memory(self, fn):
+        """Peak bytes allocated by fn, from the CUDA allocator or from the allocations and frees of the CPU profiler"""
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats(self.device)
+            baseline = torch.cuda.memory_allocated(self.device)
+            fn()
+            torch.cuda.synchronize()
+            return torch.cuda.max_memory_allocated(self.device) - baseline
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+            fn()
+        changes = sorted((event.time_range.start, event.self_cpu_memory_usage) for event in prof.events()
+                         if event.self_cpu_memory_usage)
+        peak = used = 0
+        for _, change in changes:
+            used += change
+            peak = max(peak, used)
+        return peak
+
+    def benchmark_window_attention(self, height=270, width=480, embed_dim=180, num_heads=6, window_size=8,
+                                   layers=36, backends=('math', 'sdpa')):
+        """Compare the Swin2SR WindowAttention backends on the shifted windows of one frame.
+
+        The attention of a single layer is timed and multiplied by the number of attention layers of the model
+        (36 for the 6x6 RSTB real_sr/classical_sr variants) for the per-frame attention time.
+        """
+        torch.manual_seed(0)
+        attention = WindowAttention(embed_dim, window_size=(window_size, window_size), num_heads=num_heads)
+        attention = attention.to(self.device).eval()
+        attention.freeze()
+        padded_height = -(-height // window_size) * window_size
+        padded_width = -(-width // window_size) * window_size
+        mask = calculate_mask((padded_height, padded_width), window_size, window_size // 2).to(self.device)
+        x = torch.rand(mask.shape[0], window_size * window_size, embed_dim, device=self.device)
+
+        results = []
+        for attn_backend in backends:
+            attention.attn_backend = attn_backend
+            with torch.no_grad():
+                layer_time = self.time_call(lambda: attention(x, mask=mask))
+                memory = self.measure_memory(lambda: attention(x, mask=mask))
+            results.append({
+                'height': height,
+                'width': width,
+                'windows': mask.shape[0],
+                'attn_backend': attn_backend,
+                'layer_time': layer_time,
+                'frame_attention_time': layer_time * layers,
+                'memory_bytes': memory
+            })
+            print(f"  {attn_backend}: {layer_time * layers:.3f} seconds of attention per frame, "
+                  f"{memory / 1024**2:.1f}MB per layer")
+
+        self.metrics['window_attention'] = results
+        return results
+
+    def benchmark_attention_chunking(self, height=270, width=480, embed_dim=180, num_heads=6, window_size=8,
+                                     layers=36, chunk_sizes=(0, 1024, 256, 64, 16), attn_backend='sdpa'):
+        """Plot peak memory against throughput of a shifted Swin2SR block attending its windows in chunks.
+
+        A chunk size of 0 attends all windows of the frame at once. The block time is multiplied by the number of
+        blocks of the model (36 for the real_sr/classical_sr variants) for the frame rate.
+        """
+        torch.manual_seed(0)
+        block = SwinTransformerBlock(embed_dim, input_resolution=(64, 64), num_heads=num_heads,
+                                     window_size=window_size, shift_size=window_size // 2, mlp_ratio=2)
+        block = block.to(self.device).eval()
+        block.attn.freeze()
+        block.attn.attn_backend = attn_backend
+        x_size = (-(-height // window_size) * window_size, -(-width // window_size) * window_size)
+        x = torch.rand(1, x_size[0] * x_size[1], embed_dim, device=self.device)
+
+        results = []
+        for chunk_size in chunk_sizes:
+            block.attn_chunk_size = chunk_size
+            with torch.no_grad():
+                block_time = self.time_call(lambda: block(x, x_size))
+                memory = self.measure_memory(lambda: block(x, x_size))
+            results.append({
+                'height': height,
+                'width': width,
+                'chunk_size': chunk_size,
+                'block_time': block_time,
+                'frames_per_second': 1 / (block_time * layers),
+                'memory_bytes': memory
+            })
+            print(f"  chunk size {chunk_size}: {1 / (block_time * layers):.4f} frames/s, "
+                  f"{memory / 1024**2:.1f}MB peak per block")
+
+        plt.figure(figsize=(8, 6))
+        plt.plot([r['memory_bytes'] / 1024**2 for r in results], [r['frames_per_second'] for r in results], 'o-')
+        for r in results:
+            plt.annotate(str(r['chunk_size'] or 'all'), (r['memory_bytes'] / 1024**2, r['frames_per_second']))
+        plt.xlabel('Peak Memory per Block (MB)')
+        plt.ylabel('Throughput (frames/s)')
+        plt.title(f'Swin2SR Attention Chunk Size ({width}x{height}, {attn_backend})')
+        plt.tight_layout()
+        plt.savefig(os.path.join(self.output_dir, 'attention_chunking.png'))
+        plt.close()
+
+        self.metrics['attention_chunking'] = results
+        return results
+
+    def benchmark_window_partition(self, height=270, width=480, embed_dim=180, window_size=8, layers=36):
+        """Compare torch.roll + window_partition / window_reverse + torch.roll against the fused index gathers.
+
+        One shifted partition and reverse round trip is timed and multiplied by the number of blocks of the model
+        (36 for the real_sr/classical_sr variants) for the per-frame time.
+        """
+        H, W = -(-height // window_size) * window_size, -(-width // window_size) * window_size
+        shift_size = window_size // 2
+        partition_index, reverse_index = (index.to(self.device)
+                                          for index in calculate_window_index((H, W), window_size, shift_size))
+        x = torch.rand(1, H * W, embed_dim, device=self.device)
+
+        def roll_partition():
+            shifted_x = torch.roll(x.view(1, H, W, embed_dim), shifts=(-shift_size, -shift_size), dims=(1, 2))
+            windows = window_partition(shifted_x, window_size)
+            shifted_x = window_reverse(windows, window_size, H, W)
+            return torch.roll(shifted_x, shifts=(shift_size, shift_size), dims=(1, 2)).view(1, H * W, embed_dim)
+
+        def gather_partition():
+            windows = x.index_select(1, partition_index)
+            return windows.index_select(1, reverse_index)
+
+        results = []
+        for method, fn in (('roll', roll_partition), ('gather', gather_partition)):
+            round_trip_time = self.time_call(fn)
+            results.append({
+                'height': height,
+                'width': width,
+                'method': method,
+                'round_trip_time': round_trip_time,
+                'frame_time': round_trip_time * layers
+            })
+        for result in results:
+            result['speedup'] = results[0]['frame_time'] / result['frame_time']
+            print(f"  {result['method']}: {result['frame_time']:.3f} seconds per frame, "
+                  f"speedup {result['speedup']:.2f}x")
+
+        self.metrics['window_partition'] = results
+        return results
+
+    def benchmark_frame_batching(self, height=90, width=160, num_frames=8, batch_sizes=(1, 4, 8), **model_kwargs):
+        """Compare the frame rate of Swin2SR forwards on stacked same-size frames against one forward per frame.
+
+        The model defaults to the lightweight_sr architecture with random weights.
+        """
+        torch.manual_seed(0)
+        options = dict(upscale=4, in_chans=3, img_size=64, window_size=8, img_range=1., depths=[6, 6, 6, 6],
+                       embed_dim=60, num_heads=[6, 6, 6, 6], mlp_ratio=2, upsampler='pixelshuffledirect',
+                       resi_connection='1conv')
+        options.update(model_kwargs)
+        model = Swin2SR(**options).to(self.device).eval()
+        model.freeze_attention()
+        frames = torch.rand(num_frames, 3, height, width, device=self.device)
+
+        def run(batch_size):
+            with torch.no_grad():
+                for i in range(0, num_frames, batch_size):
+                    model(frames[i:i + batch_size])
+
+        results = []
+        for batch_size in batch_sizes:
+            total_time = self.time_call(lambda: run(batch_size))
+            results.append({
+                'height': height,
+                'width': width,
+                'batch_size': batch_size,
+                'frames_per_second': num_frames / total_time
+            })
+        for result in results:
+            result['speedup'] = result['frames_per_second'] / results[0]['frames_per_second']
+            print(f"  batch size {result['batch_size']}: {result['frames_per_second']:.2f} frames/s, "
+                  f"speedup {result['speedup']:.2f}x")
+
+        self.metrics['frame_batching'] = results
+        return results
+
+    def benchmark_compiled_models(self, height=350, width=620, bucket=(360, 640), backends=('none', 'trace', 'compile'),
+                                  num_feat=64, num_conv=16):
+        """Compare the eager SRVGGNetCompact against the graphs compiled for the resolution bucket of the frame.
+
+        The first forward, which compiles the graph of the bucket, is reported separately from the steady state.
+        """
+        torch.manual_seed(0)
+        network = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=num_feat, num_conv=num_conv, upscale=4,
+                                  act_type='prelu').to(self.device).eval()
+        img = torch.rand(1, 3, height, width, device=self.device)
+
+        results = []
+        for backend in backends:
+            model = CompiledModelCache(network, buckets=[bucket], backend=backend)
+            with torch.no_grad():
+                start_time = time.perf_counter()
+                model(img)
+                compile_time = time.perf_counter() - start_time
+                frame_time = self.time_call(lambda: model(img))
+            results.append({
+                'height': height,
+                'width': width,
+                'backend': backend,
+                'compile_time': compile_time,
+                'frame_time': frame_time
+            })
+        for result in results:
+            result['speedup'] = results[0]['frame_time'] / result['frame_time']
+            print(f"  {result['backend']}: {result['frame_time']:.3f} seconds per frame "
+                  f"(first frame {result['compile_time']:.1f} seconds), speedup {result['speedup']:.2f}x")
+
+        self.metrics['compiled_models'] = results
+        return results
+
+    def generate_report(self):
+        """Save the collected benchmark metrics as a JSON report"""
+        if not self.metrics:
+            print("No benchmark results available. Run benchmarks first.")
+            return
+
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        report_file = os.path.join(self.output_dir, f"inference_benchmark_{timestamp}.json")
+        report = {
+            'timestamp': timestamp,
+            'device': str(self.device),
+            'iterations': self.iterations,
+            'results': self.metrics
+        }
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        print(f"Benchmark report saved to {report_file}")
+        return report_file
+
+
+def main():
+    """Main function to run inference benchmarks from command line"""
+    parser = argparse.ArgumentParser(description='Benchmark the super-resolution inference helpers')
+    parser.add_argument('--output-dir', type=str, help='Directory to save benchmark results')
+    parser.add_argument('--iterations', type=int, default=3, help='Timed iterations per configuration')
+    parser.add_argument('--height', type=int, default=270, help='Input frame height')
+    parser.add_argument('--width', type=int, default=480, help='Input frame width')
+    parser.add_argument('--tile-size', type=int, default=64, help='Tile size for the tile batching benchmark')
+    args = parser.parse_args()
+
+    benchmark = InferenceBenchmark(output_dir=args.output_dir, iterations=args.iterations)
+    print("Benchmarking batched tile inference...")
+    benchmark.benchmark_tile_batching(height=args.height, width=args.width, tile_size=args.tile_size)
+    print("Benchmarking feathered tile blending...")
+    benchmark.benchmark_tile_blending(height=args.height, width=args.width)
+    print("Benchmarking model cold start...")
+    benchmark.benchmark_weight_loading()
+    print("Benchmarking Swin2SR window attention backends...")
+    benchmark.benchmark_window_attention(height=args.height, width=args.width)
+    print("Benchmarking Swin2SR chunked window attention...")
+    benchmark.benchmark_attention_chunking(height=args.height, width=args.width)
+    print("Benchmarking Swin2SR window partition...")
+    benchmark.benchmark_window_partition(height=args.height, width=args.width)
+    print("Benchmarking Swin2SR multi-frame batching...")
+    benchmark.benchmark_frame_batching()
+    print("Benchmarking shape-bucketed compiled models...")
+    benchmark.benchmark_compiled_models()
+    benchmark.generate_report()
+
+
+if __name__ == '__main__':
+    main()
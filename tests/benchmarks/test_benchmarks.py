@@ -27,3 +27,108 @@ def test_benchmark_pipeline():
     assert results[0]['video_name'] == 'test_video.mp4'
     assert results[0]['model'] == 'realesrgan'
     assert results[0]['total_time'] > 0
+
+def test_benchmark_tile_batching(tmp_path):
+    """Test that the tile batching benchmark runs and reports a speedup per batch size."""
+    from benchmark_inference import InferenceBenchmark
+
+    benchmark = InferenceBenchmark(output_dir=str(tmp_path), iterations=1)
+    results = benchmark.benchmark_tile_batching(height=40, width=56, tile_size=16, batch_sizes=(1, 4),
+                                                num_feat=8, num_conv=2)
+
+    assert [r['tile_batch_size'] for r in results] == [1, 4]
+    assert results[0]['speedup'] == 1.0
+    assert all(r['frame_time'] > 0 for r in results)
+    assert benchmark.generate_report() is not None
+
+
+def test_benchmark_tile_blending(tmp_path):
+    """Test that the tile blending benchmark reports the discarded pixels per tile size and blend mode."""
+    from benchmark_inference import InferenceBenchmark
+
+    benchmark = InferenceBenchmark(output_dir=str(tmp_path), iterations=1)
+    results = benchmark.benchmark_tile_blending(height=40, width=56, tile_sizes=(16, 64),
+                                                blend_modes=(('crop', 4), ('cosine', 2)), num_feat=8, num_conv=2)
+
+    assert [(r['tile_size'], r['tile_blend']) for r in results] == [(16, 'crop'), (16, 'cosine'), (64, 'crop'),
+                                                                     (64, 'cosine')]
+    assert results[0]['discarded_ratio'] > results[1]['discarded_ratio'] > 0
+    assert results[2]['discarded_ratio'] == 0
+    assert all(r['frame_time'] > 0 for r in results)
+
+
+def test_benchmark_weight_loading(tmp_path):
+    """Test that the weight loading benchmark compares the pickle checkpoint against the weight cache."""
+    from benchmark_inference import InferenceBenchmark
+
+    benchmark = InferenceBenchmark(output_dir=str(tmp_path), iterations=1)
+    results = benchmark.benchmark_weight_loading(num_block=1)
+
+    assert results['pickle_load_time'] > 0
+    assert results['cached_load_time'] > 0
+    assert results['speedup'] == results['pickle_load_time'] / results['cached_load_time']
+
+
+def test_benchmark_window_attention(tmp_path):
+    """Test that the window attention benchmark reports time and memory of every backend."""
+    from benchmark_inference import InferenceBenchmark
+
+    benchmark = InferenceBenchmark(output_dir=str(tmp_path), iterations=1)
+    results = benchmark.benchmark_window_attention(height=20, width=28, embed_dim=12, num_heads=2, window_size=4,
+                                                   layers=2)
+
+    assert [r['attn_backend'] for r in results] == ['math', 'sdpa']
+    assert all(r['windows'] == 5 * 7 for r in results)
+    assert all(r['frame_attention_time'] == 2 * r['layer_time'] > 0 for r in results)
+    assert all(r['memory_bytes'] >= 0 for r in results)
+
+
+def test_benchmark_attention_chunking(tmp_path):
+    """Test that the attention chunking benchmark reports and plots every chunk size."""
+    from benchmark_inference import InferenceBenchmark
+
+    benchmark = InferenceBenchmark(output_dir=str(tmp_path), iterations=1)
+    results = benchmark.benchmark_attention_chunking(height=20, width=28, embed_dim=12, num_heads=2,
+                                                     window_size=4, layers=2, chunk_sizes=(0, 8, 2))
+
+    assert [r['chunk_size'] for r in results] == [0, 8, 2]
+    assert all(r['frames_per_second'] > 0 and r['memory_bytes'] > 0 for r in results)
+    assert (tmp_path / 'attention_chunking.png').exists()
+
+
+def test_benchmark_window_partition(tmp_path):
+    """Test that the window partition benchmark compares the roll and gather round trips."""
+    from benchmark_inference import InferenceBenchmark
+
+    benchmark = InferenceBenchmark(output_dir=str(tmp_path), iterations=1)
+    results = benchmark.benchmark_window_partition(height=20, width=28, embed_dim=12, window_size=4, layers=2)
+
+    assert [r['method'] for r in results] == ['roll', 'gather']
+    assert results[0]['speedup'] == 1.0
+    assert all(r['frame_time'] == 2 * r['round_trip_time'] > 0 for r in results)
+
+
+def test_benchmark_frame_batching(tmp_path):
+    """Test that the frame batching benchmark reports the frame rate of every batch size."""
+    from benchmark_inference import InferenceBenchmark
+
+    benchmark = InferenceBenchmark(output_dir=str(tmp_path), iterations=1)
+    results = benchmark.benchmark_frame_batching(height=16, width=24, num_frames=4, batch_sizes=(1, 4),
+                                                 depths=[2], embed_dim=12, num_heads=[2])
+
+    assert [r['batch_size'] for r in results] == [1, 4]
+    assert results[0]['speedup'] == 1.0
+    assert all(r['frames_per_second'] > 0 for r in results)
+
+
+def test_benchmark_compiled_models(tmp_path):
+    """Test that the compiled model benchmark compares the eager and traced bucket graphs."""
+    from benchmark_inference import InferenceBenchmark
+
+    benchmark = InferenceBenchmark(output_dir=str(tmp_path), iterations=1)
+    results = benchmark.benchmark_compiled_models(height=30, width=40, bucket=(32, 40), backends=('none', 'trace'),
+                                                  num_feat=8, num_conv=2)
+
+    assert [r['backend'] for r in results] == ['none', 'trace']
+    assert results[0]['speedup'] == 1.0
+    assert all(r['frame_time'] > 0 and r['compile_time'] > 0 for r in results)